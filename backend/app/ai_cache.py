@@ -0,0 +1,188 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Any, List
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.database import SessionLocal
+from app.models import AiParseCache
+from app.preprocessing import normalize_text
+from app.config import OPENAI_MODEL, CACHE_SIZE, AI_CACHE_TTL_SECONDS, AI_CACHE_MAX_ENTRIES, AI_CACHE_EVICT_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Process-local counters; the hit_count column holds the shared totals
+_stats_lock = threading.Lock()
+AI_CACHE_STATS = {
+    'hits': 0,
+    'local_hits': 0,
+    'misses': 0,
+    'stored': 0,
+    'evicted': 0
+}
+
+# Small in-process LRU in front of the shared table: {cache_key: (stored_at, result)}
+_local_cache: "OrderedDict[str, Any]" = OrderedDict()
+_local_lock = threading.Lock()
+_last_eviction = 0.0
+
+def _record(stat: str, amount: int) -> None:
+    with _stats_lock:
+        AI_CACHE_STATS[stat] += amount
+
+def make_ai_cache_key(text: str, prompt_version: str, model: str = OPENAI_MODEL) -> str:
+    """Key a raw wine text by its normalized form, the model and the prompt version."""
+    normalized = ' '.join(normalize_text(text or '').lower().split())
+    return hashlib.sha256(f"{model}\x1f{prompt_version}\x1f{normalized}".encode('utf-8')).hexdigest()
+
+def _local_get(key: str):
+    with _local_lock:
+        item = _local_cache.get(key)
+        if item is None:
+            return None
+        stored_at, result = item
+        if time.time() - stored_at > AI_CACHE_TTL_SECONDS:
+            del _local_cache[key]
+            return None
+        _local_cache.move_to_end(key)
+        return result
+
+def _local_put(key: str, result: Dict[str, Any]) -> None:
+    with _local_lock:
+        _local_cache[key] = (time.time(), result)
+        _local_cache.move_to_end(key)
+        while len(_local_cache) > CACHE_SIZE:
+            _local_cache.popitem(last=False)
+
+def get_cached_ai_results(texts: List[str], prompt_version: str) -> Dict[str, Dict[str, Any]]:
+    """Return cached AI results for the given raw texts, keyed by text."""
+    # Texts that differ only in case or spacing share a key; every one of them gets the hit
+    keys: Dict[str, List[str]] = {}
+    for text in set(texts):
+        keys.setdefault(make_ai_cache_key(text, prompt_version), []).append(text)
+    found = {}
+    remaining = {}
+    for key, key_texts in keys.items():
+        result = _local_get(key)
+        if result is None:
+            remaining[key] = key_texts
+            continue
+        for text in key_texts:
+            found[text] = result
+    _record('local_hits', len(keys) - len(remaining))
+    if remaining:
+        db = SessionLocal()
+        try:
+            cutoff = datetime.utcnow() - timedelta(seconds=AI_CACHE_TTL_SECONDS)
+            rows = db.query(AiParseCache).filter(
+                AiParseCache.cache_key.in_(list(remaining)),
+                AiParseCache.date_created >= cutoff
+            ).all()
+            for row in rows:
+                for text in remaining.pop(row.cache_key, []):
+                    found[text] = row.result
+                _local_put(row.cache_key, row.result)
+            if rows:
+                db.query(AiParseCache).filter(AiParseCache.cache_key.in_([row.cache_key for row in rows])).update(
+                    {AiParseCache.hit_count: AiParseCache.hit_count + 1, AiParseCache.last_hit: datetime.utcnow()},
+                    synchronize_session=False
+                )
+                db.commit()
+            _record('hits', len(rows))
+        except Exception as e:
+            logger.error(f"Error reading AI cache: {str(e)}")
+            db.rollback()
+        finally:
+            db.close()
+    _record('misses', len(remaining))
+    return found
+
+def store_ai_results(results: Dict[str, Dict[str, Any]], prompt_version: str) -> None:
+    """Cache successful AI results keyed by raw text. Empty (failed) results are never stored.
+    Texts that share a key are stored once, since one upsert can't touch the same row twice."""
+    rows = {}
+    now = datetime.utcnow()
+    for text, result in results.items():
+        if not result:
+            continue
+        key = make_ai_cache_key(text, prompt_version)
+        _local_put(key, result)
+        rows[key] = {
+            'cache_key': key,
+            'model': OPENAI_MODEL,
+            'prompt_version': prompt_version,
+            'result': result,
+            'hit_count': 0,
+            'date_created': now,
+            'last_hit': now
+        }
+    if not rows:
+        return
+    db = SessionLocal()
+    try:
+        stmt = pg_insert(AiParseCache.__table__).values(list(rows.values()))
+        # A re-parse after expiry refreshes the entry instead of conflicting with it
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['cache_key'],
+            set_={'result': stmt.excluded.result, 'date_created': stmt.excluded.date_created, 'last_hit': stmt.excluded.last_hit}
+        )
+        db.execute(stmt)
+        db.commit()
+        _record('stored', len(rows))
+    except Exception as e:
+        logger.error(f"Error writing AI cache: {str(e)}")
+        db.rollback()
+    finally:
+        db.close()
+    _maybe_evict()
+
+def _maybe_evict() -> None:
+    global _last_eviction
+    now = time.monotonic()
+    if now - _last_eviction < AI_CACHE_EVICT_INTERVAL:
+        return
+    _last_eviction = now
+    evict_ai_cache()
+
+def evict_ai_cache() -> int:
+    """Delete expired entries, then the least recently hit entries beyond AI_CACHE_MAX_ENTRIES."""
+    db = SessionLocal()
+    try:
+        cutoff = datetime.utcnow() - timedelta(seconds=AI_CACHE_TTL_SECONDS)
+        deleted = db.query(AiParseCache).filter(AiParseCache.date_created < cutoff).delete(synchronize_session=False)
+        oldest_kept = db.query(AiParseCache.last_hit).order_by(AiParseCache.last_hit.desc()).offset(AI_CACHE_MAX_ENTRIES).limit(1).scalar()
+        if oldest_kept is not None:
+            deleted += db.query(AiParseCache).filter(AiParseCache.last_hit <= oldest_kept).delete(synchronize_session=False)
+        db.commit()
+        _record('evicted', deleted)
+        if deleted:
+            logger.info(f"Evicted {deleted} AI cache entries")
+        return deleted
+    except Exception as e:
+        logger.error(f"Error evicting AI cache: {str(e)}")
+        db.rollback()
+        return 0
+    finally:
+        db.close()
+
+def get_ai_cache_stats() -> Dict[str, Any]:
+    """Return hit/miss counters for this process plus shared cache totals."""
+    with _stats_lock:
+        stats = dict(AI_CACHE_STATS)
+    hits = stats['hits'] + stats['local_hits']
+    lookups = hits + stats['misses']
+    stats['hit_rate'] = hits / lookups if lookups else 0.0
+    stats['local_entries'] = len(_local_cache)
+    db = SessionLocal()
+    try:
+        entries, total_hits = db.query(func.count(AiParseCache.cache_key), func.coalesce(func.sum(AiParseCache.hit_count), 0)).one()
+        stats['entries'] = entries
+        stats['total_hits'] = int(total_hits)
+    except Exception as e:
+        logger.error(f"Error reading AI cache stats: {str(e)}")
+    finally:
+        db.close()
+    return stats
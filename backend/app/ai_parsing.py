@@ -1,23 +1,31 @@
 import os
 import json
-from typing import List, Dict, Any, Optional
-from functools import lru_cache
+import math
+import time
+import hashlib
+from typing import List, Dict, Any, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import openai
-from app.config import OPENAI_API_KEY, OPENAI_MODEL, BATCH_SIZE, CACHE_SIZE
+from app.config import (
+    OPENAI_API_KEY, OPENAI_MODEL, AI_MAX_CONCURRENCY, AI_REQUEST_TIMEOUT,
+    AI_PACKED_MODE, AI_PACK_MAX_ITEMS, AI_PACK_TOKEN_BUDGET, AI_PACK_COMPLETION_TOKENS_PER_ITEM,
+    AI_MAX_RETRIES, AI_BACKOFF_MAX, MIN_CONFIDENCE_THRESHOLD
+)
+from app.ai_cache import get_cached_ai_results, store_ai_results, make_ai_cache_key
+from app.ai_scheduler import AI_SCHEDULER, AiBudget, AiBudgetExceeded
 
 # Initialize OpenAI client
 openai.api_key = OPENAI_API_KEY
+# Retries are handled by AI_SCHEDULER, which shares rate limits across all workers
+openai.max_retries = 0
 
-@lru_cache(maxsize=CACHE_SIZE)
-def parse_wine_text(text: str) -> Dict[str, Any]:
-    """Parse a single wine text using OpenAI API."""
-    try:
-        response = openai.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": """You are a wine list parser. Extract structured data from wine descriptions.
-                Return a JSON object with these fields:
-                - producer: The wine producer/winery name
+# Longest a single scheduled call can legitimately take: every attempt timing out plus the backoff between them
+AI_CALL_DEADLINE = AI_REQUEST_TIMEOUT * (AI_MAX_RETRIES + 1) + AI_BACKOFF_MAX * AI_MAX_RETRIES
+
+# Shared pool bounding concurrent AI requests across all parses in this process
+AI_EXECUTOR = ThreadPoolExecutor(max_workers=AI_MAX_CONCURRENCY, thread_name_prefix="ai-parse")
+
+AI_FIELD_DESCRIPTIONS = """- producer: The wine producer/winery name
                 - cuvee: The wine name/cuvee
                 - vintage: The vintage year (or NV/N.V. for non-vintage)
                 - price: The price with currency
@@ -29,53 +37,277 @@ def parse_wine_text(text: str) -> Dict[str, Any]:
                 - designation: Special designations (e.g., Grand Cru)
                 - classification: Wine classification (e.g., AOC, DOCG)
                 - sub_type: Sub-type (e.g., Brut, Sec for sparkling)
-                - type: The wine type (red, white, rosé, sparkling)
+                - type: The wine type (red, white, rosé, sparkling)"""
+
+AI_FIELDS = [
+    'producer', 'cuvee', 'vintage', 'price', 'bottle_size', 'grape_variety', 'country',
+    'region', 'subregion', 'designation', 'classification', 'sub_type', 'type'
+]
+
+# Descriptions may carry fields the rules already extracted and the subset still needed
+AI_ROUTING_INSTRUCTIONS = """A description may be followed by "|| Known: {...} || Extract: field, field".
+                When it is, the known fields are already correct: use them only as context and return
+                just the fields listed after Extract."""
+
+AI_SYSTEM_PROMPT = f"""You are a wine list parser. Extract structured data from wine descriptions.
+                Return a JSON object with these fields:
+                {AI_FIELD_DESCRIPTIONS}
+                {AI_ROUTING_INSTRUCTIONS}
                 
-                Only include fields that you are confident about. Return null for uncertain fields."""},
+                Only include fields that you are confident about. Return null for uncertain fields."""
+
+AI_PACKED_SYSTEM_PROMPT = f"""You are a wine list parser. Extract structured data from wine descriptions.
+                You will receive several numbered wine descriptions, one per line, as "[index] description".
+                Return a JSON object {{"results": [...]}} with exactly one object per description, each with
+                an "index" key holding the description's number and these fields:
+                {AI_FIELD_DESCRIPTIONS}
+                {AI_ROUTING_INSTRUCTIONS}
+                
+                Only include fields that you are confident about. Return null for uncertain fields."""
+
+def _with_confidence(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Add base confidence scores for every non-null AI-extracted field."""
+    confidence = {}
+    for field in result:
+        if result[field] is not None:
+            confidence[field] = 0.8  # Base confidence for AI-extracted fields
+    result['field_confidence'] = confidence
+    return result
+
+# Changes whenever either prompt changes, so cached results from an older prompt are not reused
+AI_PROMPT_VERSION = hashlib.sha1((AI_SYSTEM_PROMPT + AI_PACKED_SYSTEM_PROMPT).encode('utf-8')).hexdigest()[:12]
+
+# Result marker for texts skipped because the AI budget ran out; never cached
+AI_BUDGET_EXCEEDED = {'ai_budget_exceeded': True}
+
+def _parse_wine_text_uncached(text: str, budget: Optional[AiBudget] = None) -> Optional[Dict[str, Any]]:
+    """Parse a single wine text using OpenAI API. Returns None on failure."""
+    try:
+        estimated = estimate_tokens(AI_SYSTEM_PROMPT + text) + AI_PACK_COMPLETION_TOKENS_PER_ITEM
+        response = AI_SCHEDULER.call(lambda: openai.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[
+                {"role": "system", "content": AI_SYSTEM_PROMPT},
                 {"role": "user", "content": f"Parse this wine description: {text}"}
             ],
             temperature=0.1,  # Low temperature for consistent outputs
-            response_format={"type": "json_object"}
-        )
+            response_format={"type": "json_object"},
+            timeout=AI_REQUEST_TIMEOUT
+        ), estimated, budget)
         
-        # Parse the response
+        # Parse the response and add confidence scores
         result = json.loads(response.choices[0].message.content)
+        return _with_confidence(result)
         
-        # Add confidence scores
-        confidence = {}
-        for field in result:
-            if result[field] is not None:
-                confidence[field] = 0.8  # Base confidence for AI-extracted fields
-        
-        result['field_confidence'] = confidence
-        return result
-        
+    except AiBudgetExceeded:
+        return AI_BUDGET_EXCEEDED
     except Exception as e:
         print(f"Error in AI parsing: {str(e)}")
-        return {}
+        return None
+
+def parse_wine_text(text: str, budget: Optional[AiBudget] = None) -> Dict[str, Any]:
+    """Parse a single wine text using OpenAI API, through the shared AI cache."""
+    cached = get_cached_ai_results([text], AI_PROMPT_VERSION)
+    if text in cached:
+        return cached[text]
+    result = _parse_wine_text_uncached(text, budget)
+    if result is None or result is AI_BUDGET_EXCEEDED:
+        return result or {}  # Failures are not cached, so a transient error doesn't stick
+    store_ai_results({text: result}, AI_PROMPT_VERSION)
+    return result
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate (~4 characters per token) for packing decisions."""
+    return len(text) // 4 + 1
+
+def pack_texts(texts: List[str], token_budget: int = AI_PACK_TOKEN_BUDGET, max_items: int = AI_PACK_MAX_ITEMS) -> List[List[int]]:
+    """Greedily group text indices into packs whose prompt plus expected completion fits the token budget."""
+    base_tokens = estimate_tokens(AI_PACKED_SYSTEM_PROMPT)
+    packs = []
+    current = []
+    used = base_tokens
+    for i, text in enumerate(texts):
+        cost = estimate_tokens(text) + AI_PACK_COMPLETION_TOKENS_PER_ITEM
+        if current and (used + cost > token_budget or len(current) >= max_items):
+            packs.append(current)
+            current = []
+            used = base_tokens
+        current.append(i)
+        used += cost
+    if current:
+        packs.append(current)
+    return packs
+
+def split_packed_response(content: str, count: int) -> List[Optional[Dict[str, Any]]]:
+    """Split a packed JSON response into per-item results; items that are missing or malformed are None."""
+    results: List[Optional[Dict[str, Any]]] = [None] * count
+    try:
+        data = json.loads(content)
+    except (TypeError, ValueError):
+        return results
+    # Accept {"results": [...]}, a bare list, or an object keyed by index
+    if isinstance(data, dict):
+        items = data.get('results', data.get('items'))
+        if items is None:
+            items = [dict(v, index=k) for k, v in data.items() if isinstance(v, dict)]
+    else:
+        items = data
+    if not isinstance(items, list):
+        return results
+    for position, item in enumerate(items):
+        if not isinstance(item, dict):
+            continue
+        item = dict(item)
+        index = item.pop('index', position if len(items) == count else None)
+        try:
+            index = int(index)
+        except (TypeError, ValueError):
+            continue
+        if 0 <= index < count and results[index] is None:
+            results[index] = _with_confidence(item)
+    return results
 
-def parse_wine_batch(texts: List[str]) -> List[Dict[str, Any]]:
-    """Parse a batch of wine texts using OpenAI API."""
+def parse_wine_texts_packed(texts: List[str], budget: Optional[AiBudget] = None) -> List[Optional[Dict[str, Any]]]:
+    """Parse several wine texts in one request; returns one result per text (None where the reply was unusable)."""
+    lines = '\n'.join(f"[{i}] {text}" for i, text in enumerate(texts))
+    try:
+        estimated = estimate_tokens(AI_PACKED_SYSTEM_PROMPT + lines) + AI_PACK_COMPLETION_TOKENS_PER_ITEM * len(texts)
+        response = AI_SCHEDULER.call(lambda: openai.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[
+                {"role": "system", "content": AI_PACKED_SYSTEM_PROMPT},
+                {"role": "user", "content": f"Parse these wine descriptions:\n{lines}"}
+            ],
+            temperature=0.1,
+            response_format={"type": "json_object"},
+            timeout=AI_REQUEST_TIMEOUT * 2  # Longer completion than a single entry
+        ), estimated, budget)
+        return split_packed_response(response.choices[0].message.content, len(texts))
+    except AiBudgetExceeded:
+        return [AI_BUDGET_EXCEEDED] * len(texts)
+    except Exception as e:
+        print(f"Error in packed AI parsing: {str(e)}")
+        return [None] * len(texts)
+
+def _collect(futures: List[Any], timeout: float, default: Any) -> List[Any]:
+    """Wait for futures under one deadline for the whole batch: timeout per call, for as many rounds
+    of AI_MAX_CONCURRENCY calls as the batch needs. Calls still pending at the deadline are cancelled."""
+    # The client enforces the per-request timeout; this only guards against a hung worker
+    # (timeout allows for rate-limit waits and retries)
+    deadline = time.monotonic() + timeout * math.ceil(len(futures) / AI_MAX_CONCURRENCY)
     results = []
-    for i in range(0, len(texts), BATCH_SIZE):
-        batch = texts[i:i + BATCH_SIZE]
-        for text in batch:
-            result = parse_wine_text(text)
-            results.append(result)
+    for future in futures:
+        try:
+            results.append(future.result(timeout=max(0.0, deadline - time.monotonic())))
+        except FutureTimeoutError:
+            print("Error in AI parsing: request timed out")
+            future.cancel()  # Frees the slot if the call hasn't started yet
+            results.append(default)
     return results
 
-def parse_wine_entries(entries: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    """Parse a list of wine entries using AI."""
-    # Extract raw text from entries
-    texts = [entry.get('raw_text', '') for entry in entries]
+def parse_wine_batch(texts: List[str], packed: bool = False, budget: Optional[AiBudget] = None) -> List[Dict[str, Any]]:
+    """Parse a batch of wine texts using OpenAI API, up to AI_MAX_CONCURRENCY requests at a time.
+    Cached texts are served from the shared AI cache. In packed mode several texts share one
+    request; items the model drops or garbles fall back to a single-entry request.
+    Calls are rate limited and retried by AI_SCHEDULER and charged to budget; texts the budget
+    can't cover come back as {'ai_budget_exceeded': True}. Results are returned in input order."""
+    parsed: Dict[str, Optional[Dict[str, Any]]] = dict(get_cached_ai_results(texts, AI_PROMPT_VERSION))
+    # The same wine (texts equal up to case and spacing, i.e. one cache key) is sent once
+    same_wine: Dict[str, List[str]] = {}
+    for text in dict.fromkeys(texts):
+        if text not in parsed:
+            same_wine.setdefault(make_ai_cache_key(text, AI_PROMPT_VERSION), []).append(text)
+    pending = [group[0] for group in same_wine.values()]
+    fresh: Dict[str, Optional[Dict[str, Any]]] = {}
+    
+    if packed and pending:
+        packs = pack_texts(pending)
+        pack_futures = [AI_EXECUTOR.submit(parse_wine_texts_packed, [pending[i] for i in pack], budget) for pack in packs]
+        for pack, pack_results in zip(packs, _collect(pack_futures, AI_CALL_DEADLINE * 2, None)):
+            for i, result in zip(pack, pack_results or [None] * len(pack)):
+                fresh[pending[i]] = result
+        # Budget refusals aren't retried one by one; the budget is just as exhausted for single requests
+        pending = [text for text in pending if fresh.get(text) is None]
+        if pending:
+            print(f"Packed AI parsing fell back to single requests for {len(pending)} entries")
+    
+    # Single-entry requests (and per-item fallback for anything the packed replies didn't cover)
+    if pending:
+        futures = [AI_EXECUTOR.submit(_parse_wine_text_uncached, text, budget) for text in pending]
+        for text, result in zip(pending, _collect(futures, AI_CALL_DEADLINE, None)):
+            fresh[text] = result
+    
+    store_ai_results({text: result for text, result in fresh.items() if result and result is not AI_BUDGET_EXCEEDED}, AI_PROMPT_VERSION)
+    for group in same_wine.values():
+        for text in group[1:]:
+            fresh[text] = fresh.get(group[0])
+    parsed.update(fresh)
+    return [parsed.get(text) or {} for text in texts]
+
+def route_entry_fields(entry: Dict[str, Any], threshold: float = MIN_CONFIDENCE_THRESHOLD,
+                       thresholds: Optional[Dict[str, float]] = None) -> Tuple[Dict[str, Any], List[str]]:
+    """Split an entry's fields into those already extracted with confidence (returned as
+    context) and those that are missing or below their threshold (to ask the model for).
+    thresholds gives per-field bars; fields without one use threshold."""
+    values = entry.get('extracted') or entry
+    confidence = entry.get('field_confidence') or {}
+    thresholds = thresholds or {}
+    known = {}
+    wanted = []
+    for field in AI_FIELDS:
+        value = values.get(field)
+        if value and confidence.get(field, 0) >= thresholds.get(field, threshold):
+            known[field] = value
+        else:
+            wanted.append(field)
+    return known, wanted
+
+def build_routed_text(text: str, known: Dict[str, Any], wanted: List[str]) -> str:
+    """Describe one routed request. The known fields and requested fields are part of the text,
+    so they are also part of its cache key."""
+    return f"{text} || Known: {json.dumps(known, ensure_ascii=False, sort_keys=True)} || Extract: {', '.join(wanted)}"
+
+def parse_wine_entries(entries: List[Dict[str, Any]], packed: bool = AI_PACKED_MODE, budget: Optional[AiBudget] = None,
+                       routed: bool = False, field_thresholds: Optional[Dict[str, float]] = None) -> List[Dict[str, Any]]:
+    """Parse a list of wine entries using AI (several entries per request in packed mode),
+    charging the calls to budget if given.
+    In routed mode entries whose row_confidence clears MIN_CONFIDENCE_THRESHOLD skip AI
+    (flagged ai_skipped), and the rest only ask for their missing or low-confidence fields
+    (below field_thresholds, or MIN_CONFIDENCE_THRESHOLD for fields it doesn't list)."""
+    texts = []
+    wanted_fields: List[Optional[List[str]]] = []
+    for entry in entries:
+        text = entry.get('raw_text', '')
+        if not routed:
+            texts.append(text)
+            wanted_fields.append(None)
+            continue
+        known, wanted = route_entry_fields(entry, thresholds=field_thresholds)
+        if entry.get('row_confidence', 0) >= MIN_CONFIDENCE_THRESHOLD or not wanted:
+            texts.append(None)
+            wanted_fields.append([])
+            continue
+        texts.append(build_routed_text(text, known, wanted))
+        wanted_fields.append(wanted)
     
     # Parse texts using AI
-    parsed_results = parse_wine_batch(texts)
+    to_send = [text for text in texts if text is not None]
+    sent_results = iter(parse_wine_batch(to_send, packed=packed, budget=budget) if to_send else [])
+    parsed_results = [next(sent_results) if text is not None else None for text in texts]
     
     # Merge results with original entries
     enriched_entries = []
-    for entry, parsed in zip(entries, parsed_results):
+    for entry, parsed, wanted in zip(entries, parsed_results, wanted_fields):
         enriched = entry.copy()
+        if parsed is None:
+            enriched['ai_skipped'] = True
+            enriched_entries.append(enriched)
+            continue
+        if wanted and not parsed.get('ai_budget_exceeded'):
+            # The model may volunteer fields it wasn't asked for; the known ones stay as extracted
+            parsed = {field: value for field, value in parsed.items() if field in wanted or field == 'field_confidence'}
+            if 'field_confidence' in parsed:
+                parsed['field_confidence'] = {f: c for f, c in parsed['field_confidence'].items() if f in wanted}
         
         # Update fields with AI results if they exist
         for field, value in parsed.items():
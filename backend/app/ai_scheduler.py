@@ -0,0 +1,251 @@
+import logging
+import random
+import threading
+import time
+from datetime import date
+from typing import Any, Callable, Dict, Optional
+import openai
+from sqlalchemy import update as sa_update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.database import SessionLocal
+from app.models import AiTokenUsage
+from app.config import (
+    AI_REQUESTS_PER_MINUTE, AI_TOKENS_PER_MINUTE, AI_RATE_LIMIT_PROCESSES, AI_MAX_RETRIES, AI_BACKOFF_BASE, AI_BACKOFF_MAX,
+    AI_UPLOAD_TOKEN_BUDGET, AI_RESTAURANT_DAILY_TOKEN_BUDGET
+)
+
+logger = logging.getLogger(__name__)
+
+class AiBudgetExceeded(Exception):
+    """Raised when an AI call would exceed the upload or restaurant token budget."""
+
+class TokenBucket:
+    """Token bucket refilled continuously at capacity_per_minute; acquire blocks until enough tokens are free."""
+    def __init__(self, capacity_per_minute: float):
+        self.capacity = float(capacity_per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount: float) -> None:
+        # A single request larger than the bucket waits for a full bucket rather than forever
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(min(wait, 1.0))
+
+    def adjust(self, amount: float) -> None:
+        """Correct an earlier estimate: positive amounts debit more tokens, negative ones refund."""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+class AiBudget:
+    """Token budget for one upload (or interactive action), also charged against the restaurant's daily budget.
+
+    Restaurant reservations are made atomically on the shared daily ledger row (a
+    conditional upsert that only adds the tokens if they fit), so concurrent workers
+    can't overspend it between them; settling corrects the ledger to the actual usage.
+    """
+    def __init__(self, restaurant_id: Optional[str] = None, upload_tokens: Optional[int] = AI_UPLOAD_TOKEN_BUDGET,
+                 restaurant_daily_tokens: Optional[int] = AI_RESTAURANT_DAILY_TOKEN_BUDGET):
+        self.restaurant_id = restaurant_id
+        self.upload_tokens = upload_tokens
+        self.restaurant_daily_tokens = restaurant_daily_tokens
+        self.day = date.today()  # Ledger day, fixed so a reservation and its settlement hit the same row
+        self.used = 0
+        self.reserved = 0
+        self.exceeded = 0  # Calls refused for lack of budget
+        self.lock = threading.Lock()
+        self.restaurant_used = get_restaurant_token_usage(restaurant_id, self.day) if restaurant_id else 0
+
+    def reserve(self, tokens: int) -> bool:
+        with self.lock:
+            committed = self.used + self.reserved + tokens
+            if self.upload_tokens is not None and committed > self.upload_tokens:
+                self.exceeded += 1
+                return False
+            self.reserved += tokens
+        if self.restaurant_id and self.restaurant_daily_tokens is not None:
+            total = reserve_restaurant_tokens(self.restaurant_id, tokens, self.restaurant_daily_tokens, self.day)
+            with self.lock:
+                if total is None:
+                    self.reserved -= tokens
+                    self.exceeded += 1
+                    return False
+                self.restaurant_used = total
+        return True
+
+    def _charges_ledger(self) -> bool:
+        return bool(self.restaurant_id) and self.restaurant_daily_tokens is not None
+
+    def settle(self, reserved: int, actual: int) -> None:
+        with self.lock:
+            self.reserved -= reserved
+            self.used += actual
+        if self._charges_ledger():
+            total = adjust_restaurant_tokens(self.restaurant_id, actual - reserved, 1, self.day)
+        elif self.restaurant_id and actual:
+            total = adjust_restaurant_tokens(self.restaurant_id, actual, 1, self.day, create=True)
+        else:
+            return
+        if total is not None:
+            with self.lock:
+                self.restaurant_used = total
+
+    def release(self, reserved: int) -> None:
+        with self.lock:
+            self.reserved -= reserved
+        if self._charges_ledger() and reserved:
+            adjust_restaurant_tokens(self.restaurant_id, -reserved, 0, self.day)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            'used_tokens': self.used,
+            'upload_budget': self.upload_tokens,
+            'restaurant_used_today': self.restaurant_used,
+            'restaurant_daily_budget': self.restaurant_daily_tokens,
+            'calls_refused': self.exceeded
+        }
+
+def get_restaurant_token_usage(restaurant_id: str, day: Optional[date] = None) -> int:
+    """Tokens the restaurant has spent (or reserved) on AI today."""
+    db = SessionLocal()
+    try:
+        row = db.query(AiTokenUsage).filter_by(restaurant_id=restaurant_id, usage_date=day or date.today()).first()
+        return row.tokens if row else 0
+    except Exception as e:
+        logger.error(f"Error reading AI token usage: {str(e)}")
+        return 0
+    finally:
+        db.close()
+
+def reserve_restaurant_tokens(restaurant_id: str, tokens: int, limit: int, day: Optional[date] = None) -> Optional[int]:
+    """Add tokens to the restaurant's ledger for the day only if the total stays within limit, in one statement.
+    Returns the new total, or None if the reservation doesn't fit (or the ledger can't be reached)."""
+    if tokens > limit:
+        return None
+    table = AiTokenUsage.__table__
+    db = SessionLocal()
+    try:
+        stmt = pg_insert(table).values(restaurant_id=restaurant_id, usage_date=day or date.today(), tokens=tokens, requests=0)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['restaurant_id', 'usage_date'],
+            set_={'tokens': table.c.tokens + tokens},
+            where=table.c.tokens + tokens <= limit
+        ).returning(table.c.tokens)
+        total = db.execute(stmt).scalar()
+        db.commit()
+        return total
+    except Exception as e:
+        # Refuse rather than spend against a ledger nobody can see
+        logger.error(f"Error reserving AI tokens: {str(e)}")
+        db.rollback()
+        return None
+    finally:
+        db.close()
+
+def adjust_restaurant_tokens(restaurant_id: str, tokens: int, requests: int, day: Optional[date] = None,
+                             create: bool = False) -> Optional[int]:
+    """Add tokens (negative to refund a reservation) and requests to the restaurant's ledger for the day.
+    Returns the new total. create inserts the day's row if there is none."""
+    table = AiTokenUsage.__table__
+    usage_date = day or date.today()
+    db = SessionLocal()
+    try:
+        if create:
+            stmt = pg_insert(table).values(restaurant_id=restaurant_id, usage_date=usage_date, tokens=tokens, requests=requests)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['restaurant_id', 'usage_date'],
+                set_={'tokens': table.c.tokens + tokens, 'requests': table.c.requests + requests}
+            )
+        else:
+            stmt = sa_update(table).where(
+                table.c.restaurant_id == restaurant_id, table.c.usage_date == usage_date
+            ).values(tokens=table.c.tokens + tokens, requests=table.c.requests + requests)
+        total = db.execute(stmt.returning(table.c.tokens)).scalar()
+        db.commit()
+        return total
+    except Exception as e:
+        logger.error(f"Error recording AI token usage: {str(e)}")
+        db.rollback()
+        return None
+    finally:
+        db.close()
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    status_code = getattr(error, 'status_code', None)
+    return status_code is not None and (status_code == 429 or status_code >= 500)
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+class AiScheduler:
+    """Shared gate for every AI request in the process: requests-per-minute and tokens-per-minute
+    buckets, jittered exponential backoff on 429/5xx, and budget accounting.
+
+    The buckets are per process, so by default each holds an equal share of the account
+    limits (divided by AI_RATE_LIMIT_PROCESSES); together the processes stay within them.
+    """
+    def __init__(self, requests_per_minute: float = AI_REQUESTS_PER_MINUTE / AI_RATE_LIMIT_PROCESSES,
+                 tokens_per_minute: float = AI_TOKENS_PER_MINUTE / AI_RATE_LIMIT_PROCESSES):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.stats = {'calls': 0, 'retries': 0, 'failures': 0, 'budget_refusals': 0}
+        self.stats_lock = threading.Lock()
+
+    def _count(self, stat: str) -> None:
+        with self.stats_lock:
+            self.stats[stat] += 1
+
+    def call(self, request: Callable[[], Any], estimated_tokens: int, budget: Optional[AiBudget] = None) -> Any:
+        """Run request() once capacity is available, retrying transient errors.
+        Raises AiBudgetExceeded if the budget can't cover estimated_tokens."""
+        if budget is not None and not budget.reserve(estimated_tokens):
+            self._count('budget_refusals')
+            raise AiBudgetExceeded(f"AI token budget exhausted for restaurant {budget.restaurant_id}")
+        for attempt in range(AI_MAX_RETRIES + 1):
+            self.requests.acquire(1)
+            self.tokens.acquire(estimated_tokens)
+            try:
+                self._count('calls')
+                response = request()
+            except Exception as e:
+                if not _is_retryable(e) or attempt == AI_MAX_RETRIES:
+                    self._count('failures')
+                    if budget is not None:
+                        budget.release(estimated_tokens)
+                    raise
+                # Full jitter: a random delay up to the exponential cap, unless the provider says when
+                delay = _retry_after(e) or random.uniform(0, min(AI_BACKOFF_MAX, AI_BACKOFF_BASE * (2 ** attempt)))
+                self._count('retries')
+                logger.warning(f"AI request failed ({str(e)}), retry {attempt + 1}/{AI_MAX_RETRIES} in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            usage = getattr(response, 'usage', None)
+            actual = getattr(usage, 'total_tokens', None) or estimated_tokens
+            self.tokens.adjust(actual - estimated_tokens)
+            if budget is not None:
+                budget.settle(estimated_tokens, actual)
+            return response
+
+# Shared by every AI call in this process
+AI_SCHEDULER = AiScheduler()
@@ -1,25 +1,35 @@
 from fastapi import APIRouter, HTTPException, Depends, status, UploadFile, File, Form
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-from app.models import User, Restaurant, WineListFile, WineEntry, Ruleset
-from app.supabase_auth import get_current_user, require_role  # updated import
-from app.database import get_db, SessionLocal  # You should have a get_db dependency for DB sessions
+from sqlalchemy import update as sa_update, insert as sa_insert, bindparam
+from app.models import User, Restaurant, WineListFile, WineEntry, WineEntryStatus, Ruleset, AuditLog
+from app.supabase_auth import get_current_user, require_role, invalidate_user_cache  # updated import
+from app.database import get_db  # You should have a get_db dependency for DB sessions
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 from uuid import UUID
 from app.config import supabase
-from app.pdf_extraction import extract_pdf_text_with_ocr, save_extraction_to_json, extract_date_from_pdf_metadata, extract_date_from_filename
+from app.pdf_extraction import extract_date_from_pdf_metadata, extract_date_from_filename
 import os
 import tempfile
-import re
-from app.preprocessing import preprocess_extraction, detect_sections
-from app.wine_segmentation import segment_wine_entries
-from app.parsing import extract_fields_for_entries, parse_wine_list, GLOBAL_RULES
-import pandas as pd
-import numpy as np
+from app.parsing import extract_fields_for_entries, GLOBAL_RULES
 from datetime import datetime, date
 import logging
 from app.ai_parsing import parse_wine_entries
-from app.lwin import match_lwin_batch, enrich_wine_entry as lwin_enrich_wine_entry
+from app.ai_scheduler import AiBudget
+from app.lwin import (
+    match_lwin_batch, get_lwin_snapshot, get_lwin_status, reload_lwin_db, update_lwin_alias_table, delete_lwin_alias,
+    get_lwin_suggestions, get_lwin_suggestion_latency, enrich_wine_entry as lwin_enrich_wine_entry
+)
+from app.lwin_cache import get_lwin_cache_stats, invalidate_lwin_match_cache
+from app.ai_cache import get_ai_cache_stats, evict_ai_cache
+from app.jobs import (
+    JobQueueFull, enqueue_parse_job, queued_job_count, lane_max_pending, has_active_job, get_job, list_jobs, get_job_stats
+)
+from app.progress import progress_snapshot, progress_events
+from app.refinement_store import load_refinement_data, refinement_sections
+from app.review_queue import next_review_entry, random_review_entry, review_queue_stats
+from app.entry_listing import parse_fields, entry_select, list_entries_page, iter_entries, encode_entries
 import uuid
 
 logger = logging.getLogger(__name__)
@@ -65,6 +75,23 @@ class WineEntryUpdate(BaseModel):
     classification: Optional[str] = None
     sub_type: Optional[str] = None
 
+class WineEntryBulkUpdate(WineEntryUpdate):
+    id: UUID
+    version: Optional[int] = None  # The version the client edited; a mismatch rejects the whole batch
+
+class LwinSuggestionRequest(BaseModel):
+    producer: Optional[str] = None
+    cuvee: Optional[str] = None
+    vintage: Optional[str] = None
+    region: Optional[str] = None
+    country: Optional[str] = None
+    grape_variety: Optional[str] = None
+    type: Optional[str] = None
+    section_header: Optional[str] = None
+    subheader: Optional[str] = None
+    restaurant_id: Optional[uuid.UUID] = None
+    limit: int = 5
+
 class UserCreate(BaseModel):
     email: str
     name: Optional[str] = None
@@ -120,8 +147,12 @@ def delete_restaurant(id: str, db: Session = Depends(get_db)):
     restaurant = db.query(Restaurant).get(id)
     if not restaurant:
         raise HTTPException(status_code=404, detail="Restaurant not found")
+    # Its users go with it (cascade); their cached logins must not outlive them
+    supabase_user_ids = [user_id for (user_id,) in db.query(User.supabase_user_id).filter(User.restaurant_id == restaurant.id)]
     db.delete(restaurant)
     db.commit()
+    for supabase_user_id in supabase_user_ids:
+        invalidate_user_cache(supabase_user_id)
     return {"detail": "Deleted"}
 
 @api_router.post("/wine-lists/upload", dependencies=[Depends(require_role("admin"))])
@@ -131,6 +162,10 @@ def upload_wine_list(
     parsed_date: str = Form(None),
     db: Session = Depends(get_db)
 ):
+    # Uploads always parse in the bulk lane; interactive is kept for server-initiated work such as re-parses
+    # Push back before reading or storing anything when the parse queue is already full
+    if queued_job_count(db, "bulk") >= lane_max_pending("bulk"):
+        raise HTTPException(status_code=429, detail="Too many wine lists are being parsed, try again shortly", headers={"Retry-After": "30"})
     file_bytes = file.file.read()  # Read file content once
 
     # --- Date extraction logic ---
@@ -169,146 +204,62 @@ def upload_wine_list(
     db.commit()
     db.refresh(wine_list)
 
-    # Start async processing
-    import threading
-    from app.database import SessionLocal  # Import SessionLocal for new session
-
-    def make_json_serializable(obj):
-        import math
-        if isinstance(obj, dict):
-            return {k: make_json_serializable(v) for k, v in obj.items()}
-        elif isinstance(obj, list):
-            return [make_json_serializable(v) for v in obj]
-        elif isinstance(obj, (pd.Timestamp, np.datetime64)):
-            return str(obj)
-        elif isinstance(obj, float):
-            if math.isnan(obj) or math.isinf(obj):
-                return None
-            return obj
-        elif hasattr(obj, 'isna') and obj.isna():  # pandas NA
-            return None
-        elif isinstance(obj, (np.floating, np.integer)):
-            if np.isnan(obj) or np.isinf(obj):
-                return None
-            return obj.item()
-        elif obj is None:
-            return None
-        else:
-            return obj
-
-    def process_file(wine_list_id: str):
-        # Create new database session for this thread
-        thread_db = SessionLocal()
-        try:
-            # Get fresh wine_list object in this session
-            wine_list = thread_db.query(WineListFile).get(wine_list_id)
-            if not wine_list:
-                logger.error(f"[ERROR] Wine list {wine_list_id} not found in thread")
-                return
-
-            # Save a local temp copy for extraction
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-                tmp.write(file_bytes)
-                tmp_path = tmp.name
-
-            # Update status to processing
-            wine_list.status = "processing"
-            logger.info(f"Setting wine_list {wine_list.id} status to 'processing'")
-            thread_db.commit()
-            thread_db.flush()
-            logger.info(f"wine_list {wine_list.id} status after commit: {wine_list.status}")
-
-            logger.info(f"Starting PDF extraction for wine_list {wine_list.id}")
-            pages = extract_pdf_text_with_ocr(tmp_path)
-            logger.info(f"Finished PDF extraction for wine_list {wine_list.id}")
-
-            logger.info(f"Starting preprocessing for wine_list {wine_list.id}")
-            cleaned_pages = preprocess_extraction(pages)
-            logger.info(f"Finished preprocessing for wine_list {wine_list.id}")
-
-            logger.info(f"Starting section detection for wine_list {wine_list.id}")
-            lines_with_sections = detect_sections(cleaned_pages)
-            logger.info(f"Finished section detection for wine_list {wine_list.id}")
-
-            logger.info(f"Starting segmentation for wine_list {wine_list.id}")
-            wine_entries = segment_wine_entries(lines_with_sections)
-            logger.info(f"Finished segmentation for wine_list {wine_list.id}")
-
-            logger.info(f"Starting multi-stage parsing pipeline for wine_list {wine_list.id}")
-            ruleset_obj = thread_db.query(Ruleset).filter_by(restaurant_id=restaurant_id).first()
-            ruleset = ruleset_obj.rules_json if ruleset_obj else None
-            final_entries, refinement_data = parse_wine_list(wine_entries, ruleset)
-            logger.info(f"Finished multi-stage parsing for wine_list {wine_list.id}")
-
-            logger.info(f"Starting DB entry creation for wine_list {wine_list.id}")
-            # Get valid WineEntry fields dynamically
-            valid_fields = set(c.name for c in WineEntry.__table__.columns)
-            for entry in final_entries:
-                db_entry = {k: v for k, v in entry.items() if k in valid_fields and k != 'extra_data'}
-                # Store all extra fields in extra_data
-                extra_data = {k: v for k, v in entry.items() if k not in valid_fields or k == 'provenance' or k == 'lwin_match_info' or k == 'lwin_suggestions'}
-                extra_data = make_json_serializable(extra_data)
-                wine_entry = WineEntry(
-                    wine_list_file_id=wine_list.id,
-                    restaurant_id=restaurant_id,
-                    **db_entry,
-                    extra_data=extra_data if extra_data else None
-                )
-                thread_db.add(wine_entry)
-            logger.info(f"Finished DB entry creation for wine_list {wine_list.id}")
-
-            # Save extraction and refinement data to JSON for debugging
-            project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            specs_dir = os.path.join(project_root, "specs")
-            os.makedirs(specs_dir, exist_ok=True)
-            safe_filename = re.sub(r'[^a-zA-Z0-9_.-]', '_', file.filename)
-            json_filename = f"extracted_{safe_filename}.json"
-            json_path = os.path.join(specs_dir, json_filename)
-            save_extraction_to_json(wine_entries, json_path)
-            # Save refinement data
-            refinement_filename = f"refinement_{safe_filename}.json"
-            refinement_path = os.path.join(specs_dir, refinement_filename)
-            import json as _json
-            # Make refinement_data JSON serializable before saving
-            serializable_refinement_data = make_json_serializable(refinement_data)
-            with open(refinement_path, "w", encoding="utf-8") as f:
-                _json.dump(serializable_refinement_data, f, ensure_ascii=False, indent=2)
-
-            # Update wine list status and notes
-            wine_list.status = "parsed"
-            wine_list.notes = f"extraction_json: specs/{json_filename}; refinement_json: specs/{refinement_filename}"
-            logger.info(f"Setting wine_list {wine_list.id} status to 'parsed'")
-            thread_db.commit()
-            thread_db.flush()
-            logger.info(f"wine_list {wine_list.id} status after commit: {wine_list.status}")
-
-            # Clean up temp file
-            os.remove(tmp_path)
-
-        except Exception as e:
-            # Log error and update status
-            logger.error(f"Error processing file: {str(e)}")
-            if 'wine_list' in locals():
-                wine_list.status = "error"
-                wine_list.notes = f"Error: {str(e)}"
-                logger.error(f"[DEBUG] Setting wine_list {wine_list.id} status to 'error'")
-                thread_db.commit()
-                thread_db.flush()
-                logger.error(f"wine_list {wine_list.id} status after commit: {wine_list.status}")
-        finally:
-            # Always close the thread's database session
-            thread_db.close()
-
-    # Start processing in background thread
-    thread = threading.Thread(target=process_file, args=(str(wine_list.id),))
-    thread.start()
+    # Queue parsing; any worker (in this API or a separate worker.py node) fetches the file from storage
+    try:
+        job = enqueue_parse_job(db, wine_list, file.filename, "bulk")
+    except JobQueueFull as e:
+        wine_list.status = "error"
+        wine_list.notes = f"Error: {str(e)}"
+        db.commit()
+        raise HTTPException(status_code=429, detail="Too many wine lists are being parsed, try again shortly", headers={"Retry-After": "30"})
 
     return {
         "file_id": str(wine_list.id),
+        "job_id": str(job.id),
         "status": wine_list.status.value if hasattr(wine_list.status, 'value') else wine_list.status,
         "upload_url": file_url
     }
 
+@api_router.get("/jobs", dependencies=[Depends(require_role("admin"))])
+def list_parse_jobs(limit: int = 50, db: Session = Depends(get_db)):
+    """
+    Queue counts and the most recent parse jobs across all workers, newest first.
+    """
+    return {**get_job_stats(db), "jobs": list_jobs(db, limit)}
+
+@api_router.get("/jobs/metrics", dependencies=[Depends(require_role("admin"))])
+def get_parse_job_metrics(db: Session = Depends(get_db)):
+    """
+    Queue depth per priority lane (queued/running counts, caps, oldest wait) and queued jobs per restaurant.
+    """
+    return get_job_stats(db)
+
+@api_router.post("/wine-lists/{file_id}/reparse", dependencies=[Depends(require_role("admin"))])
+def reparse_wine_list(file_id: str, db: Session = Depends(get_db)):
+    """
+    Re-parse a wine list (e.g. after a ruleset edit) in the interactive lane. Its entries are replaced.
+    """
+    wine_list = db.query(WineListFile).get(file_id)
+    if not wine_list:
+        raise HTTPException(status_code=404, detail="Wine list not found")
+    if has_active_job(db, wine_list.id):
+        raise HTTPException(status_code=409, detail="Wine list is already queued or being parsed")
+    try:
+        job = enqueue_parse_job(db, wine_list, wine_list.filename, 'interactive')
+    except JobQueueFull:
+        raise HTTPException(status_code=429, detail="Too many re-parses queued, try again shortly", headers={"Retry-After": "10"})
+    return {"file_id": str(wine_list.id), "job_id": str(job.id), "lane": job.lane}
+
+@api_router.get("/jobs/{job_id}", dependencies=[Depends(require_role("admin"))])
+def get_parse_job(job_id: str, db: Session = Depends(get_db)):
+    """
+    Status, current stage and attempts of a parse job.
+    """
+    job = get_job(db, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
 @api_router.get("/wine-lists/{file_id}", dependencies=[Depends(require_role("admin"))])
 def get_wine_list(file_id: str, db: Session = Depends(get_db)):
     wine_list = db.query(WineListFile).get(file_id)
@@ -316,6 +267,24 @@ def get_wine_list(file_id: str, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Wine list file not found")
     return wine_list
 
+@api_router.get("/wine-lists/{file_id}/progress", dependencies=[Depends(require_role("admin", allow_query_token=True))])
+def stream_wine_list_progress(file_id: str, db: Session = Depends(get_db)):
+    """
+    Server-sent events with the wine list's parse progress: stage, pages extracted and entries
+    parsed out of their totals. Sends the current state first and closes when the parse is done
+    or errored, so one connection replaces polling GET /wine-lists/{file_id}.
+    Browsers' EventSource can't set headers, so the token may be passed as ?access_token=.
+    """
+    snapshot = progress_snapshot(db, file_id)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="Wine list file not found")
+    # Auth and the snapshot are done; don't hold a DB connection for the life of the stream
+    db.close()
+    return StreamingResponse(
+        progress_events(snapshot), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @api_router.delete("/wine-lists/{file_id}", dependencies=[Depends(require_role("admin"))])
 def delete_wine_list(file_id: str, db: Session = Depends(get_db)):
     wine_list = db.query(WineListFile).get(file_id)
@@ -330,8 +299,91 @@ def list_wine_lists_for_restaurant(id: str, db: Session = Depends(get_db)):
     return db.query(WineListFile).filter_by(restaurant_id=id).all()
 
 @api_router.get("/wine-entries/{file_id}", dependencies=[Depends(require_role("admin"))])
-def list_wine_entries(file_id: str, db: Session = Depends(get_db)):
-    return db.query(WineEntry).filter_by(wine_list_file_id=file_id).all()
+def list_wine_entries(file_id: str, limit: Optional[int] = None, cursor: Optional[str] = None,
+                      fields: Optional[str] = None, status: Optional[str] = None,
+                      needs_review: Optional[bool] = None, format: str = "json", db: Session = Depends(get_db)):
+    """
+    Entry rows of a wine list as stored (extra_data nested), with the same paging, projection,
+    filters and streaming as /wine-lists/{file_id}/entries.
+    """
+    return _entry_listing(file_id, db, False, limit, cursor, fields, status, needs_review, format)
+
+def _audit_value(value):
+    return value.value if isinstance(value, WineEntryStatus) else value
+
+@api_router.put("/wine-entries/bulk")
+def bulk_update_wine_entries(entries: List[WineEntryBulkUpdate], db: Session = Depends(get_db),
+                             current_user=Depends(require_role("admin"))):
+    """
+    Apply a table edit in one transaction. The whole payload is checked first (unknown ids,
+    duplicate ids, invalid statuses and stale versions reject it all), then changed rows are
+    written with one executemany UPDATE and one audit log insert. Returns the id and new
+    version of each entry that actually changed.
+    """
+    ids = [item.id for item in entries]
+    if len(set(ids)) != len(ids):
+        raise HTTPException(status_code=400, detail="Duplicate wine entry ids in payload")
+    changes = {item.id: item.dict(exclude_unset=True, exclude={'id', 'version'}) for item in entries}
+    for item_id, fields in changes.items():
+        if fields.get('status') is not None:
+            try:
+                fields['status'] = WineEntryStatus(fields['status'])
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"Invalid status for wine entry {item_id}: {fields['status']}")
+
+    # Lock the rows so concurrent edits can't interleave between the version check and the update
+    current = {entry.id: entry for entry in db.query(WineEntry).filter(WineEntry.id.in_(ids)).with_for_update()}
+    missing = [str(item_id) for item_id in ids if item_id not in current]
+    if missing:
+        db.rollback()
+        raise HTTPException(status_code=404, detail={"message": "Wine entries not found", "ids": missing})
+    stale = [str(item.id) for item in entries if item.version is not None and item.version != current[item.id].version]
+    if stale:
+        db.rollback()
+        raise HTTPException(status_code=409, detail={"message": "Wine entries were modified by someone else", "ids": stale})
+
+    # Only fields whose value actually changes are written and audited
+    diffs = {}
+    for item_id, fields in changes.items():
+        entry = current[item_id]
+        diff = {k: v for k, v in fields.items() if getattr(entry, k) != v}
+        if diff:
+            diffs[item_id] = diff
+    if not diffs:
+        db.rollback()
+        return {"updated": []}
+
+    now = datetime.utcnow()
+    columns = sorted({k for diff in diffs.values() for k in diff})
+    rows = []
+    audit_rows = []
+    for item_id, diff in diffs.items():
+        entry = current[item_id]
+        # executemany needs the same columns in every row, so unchanged ones keep their current value
+        rows.append({
+            '_id': item_id, '_version': entry.version,
+            **{k: diff.get(k, getattr(entry, k)) for k in columns},
+            'version': entry.version + 1, 'last_modified': now
+        })
+        audit_rows.append({
+            'id': uuid.uuid4(), 'user_id': current_user.id, 'wine_entry_id': item_id,
+            'wine_list_file_id': entry.wine_list_file_id, 'action': 'bulk_update', 'timestamp': now,
+            'old_value': {k: _audit_value(getattr(entry, k)) for k in diff},
+            'new_value': {k: _audit_value(v) for k, v in diff.items()}
+        })
+    table = WineEntry.__table__
+    stmt = sa_update(table).where(table.c.id == bindparam('_id'), table.c.version == bindparam('_version')).values(
+        {**{k: bindparam(k) for k in columns}, 'version': bindparam('version'), 'last_modified': bindparam('last_modified')}
+    )
+    try:
+        db.execute(stmt, rows)
+        db.execute(sa_insert(AuditLog.__table__), audit_rows)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Bulk update of {len(rows)} wine entries failed: {str(e)}")
+        raise HTTPException(status_code=500, detail="Bulk update failed, no entries were changed")
+    return {"updated": [{"id": str(row['_id']), "version": row['version']} for row in rows]}
 
 @api_router.put("/wine-entries/{wine_entry_id}", dependencies=[Depends(require_role("admin"))])
 def update_wine_entry(wine_entry_id: str, data: WineEntryUpdate, db: Session = Depends(get_db)):
@@ -340,24 +392,11 @@ def update_wine_entry(wine_entry_id: str, data: WineEntryUpdate, db: Session = D
         raise HTTPException(status_code=404, detail="Wine entry not found")
     for k, v in data.dict(exclude_unset=True).items():
         setattr(entry, k, v)
+    entry.version = (entry.version or 1) + 1
     db.commit()
     db.refresh(entry)
     return entry
 
-@api_router.put("/wine-entries/bulk", dependencies=[Depends(require_role("admin"))])
-def bulk_update_wine_entries(entries: list[dict], db: Session = Depends(get_db)):
-    updated = []
-    for entry_data in entries:
-        entry = db.query(WineEntry).get(entry_data["id"])
-        if entry:
-            for k, v in entry_data.items():
-                if k != "id":
-                    setattr(entry, k, v)
-            db.commit()
-            db.refresh(entry)
-            updated.append(entry)
-    return {"updated": updated}
-
 @api_router.post("/wine-entries/{wine_entry_id}/reject", dependencies=[Depends(require_role("admin"))])
 def reject_wine_entry(wine_entry_id: str, db: Session = Depends(get_db)):
     entry = db.query(WineEntry).get(wine_entry_id)
@@ -399,6 +438,8 @@ def update_user(id: str, data: UserUpdate, db: Session = Depends(get_db)):
         setattr(user, k, v)
     db.commit()
     db.refresh(user)
+    # Cached logins must see the new role (or lose access) straight away
+    invalidate_user_cache(user.supabase_user_id)
     return user
 
 @api_router.delete("/users/{id}", dependencies=[Depends(require_role("admin"))])
@@ -406,8 +447,10 @@ def delete_user(id: str, db: Session = Depends(get_db)):
     user = db.query(User).get(id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
+    supabase_user_id = user.supabase_user_id
     db.delete(user)
     db.commit()
+    invalidate_user_cache(supabase_user_id)
     return {"detail": "Deleted"}
 
 @api_router.get("/restaurants/{id}/ruleset", dependencies=[Depends(require_role("admin"))])
@@ -442,68 +485,92 @@ def get_me(current_user=Depends(get_current_user)):
         "restaurant_id": current_user.restaurant_id
     }
 
-@api_router.get("/wine-lists/{file_id}/entries", dependencies=[Depends(require_role("admin"))])
-def list_wine_list_entries(file_id: str, db: Session = Depends(get_db)):
-    entries = db.query(WineEntry).filter_by(wine_list_file_id=file_id).all()
-    # Convert to dict and merge extra_data fields
-    result = []
-    for entry in entries:
-        entry_dict = {
-            "id": str(entry.id),
-            "producer": entry.producer,
-            "cuvee": entry.cuvee,
-            "type": entry.type,
-            "vintage": entry.vintage,
-            "price": entry.price,
-            "bottle_size": entry.bottle_size,
-            "grape_variety": entry.grape_variety,
-            "country": entry.country,
-            "region": entry.region,
-            "subregion": entry.subregion,
-            "row_confidence": entry.row_confidence,
-            "field_confidence": entry.field_confidence or {},
-            "section_header": entry.section_header,
-            "subheader": entry.subheader,
-            "raw_text": entry.raw_text,
-            "designation": entry.designation,
-            "classification": entry.classification,
-            "sub_type": entry.sub_type,
-            "status": entry.status.value if entry.status else None,
-            "last_modified": entry.last_modified.isoformat() if entry.last_modified else None
-        }
-        # Merge extra_data fields if they exist
-        if entry.extra_data:
-            entry_dict.update(entry.extra_data)
-        result.append(entry_dict)
-    return result
+def _entry_listing(file_id: str, db: Session, merge_extra: bool, limit: Optional[int], cursor: Optional[str],
+                   fields: Optional[str], status: Optional[str], needs_review: Optional[bool], format: str,
+                   headers: Optional[dict] = None) -> StreamingResponse:
+    if format not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be json or ndjson")
+    try:
+        projection = parse_fields(fields)
+        filters = dict(fields=projection, status=status, needs_review=needs_review, cursor=cursor)
+        entry_select(file_id, **filters)  # Validates status and cursor before the response starts
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    headers = dict(headers or {})
+    if limit is not None:
+        rows, next_cursor = list_entries_page(db, file_id, limit, **filters)
+        if next_cursor:
+            headers["X-Next-Cursor"] = next_cursor
+        rows = iter(rows)
+    else:
+        # The whole list is streamed from its own session; release this one
+        db.close()
+        rows = iter_entries(file_id, **filters)
+    media_type = "application/x-ndjson" if format == "ndjson" else "application/json"
+    return StreamingResponse(encode_entries(rows, format, projection, merge_extra), media_type=media_type, headers=headers)
 
-@api_router.post("/wine-lists/{file_id}/refinement/random", dependencies=[Depends(require_role("admin"))])
-def get_random_wine_for_refinement(file_id: str, db: Session = Depends(get_db)):
+@api_router.get("/wine-lists/{file_id}/entries", dependencies=[Depends(require_role("admin"))])
+def list_wine_list_entries(file_id: str, limit: Optional[int] = None, cursor: Optional[str] = None,
+                           fields: Optional[str] = None, status: Optional[str] = None,
+                           needs_review: Optional[bool] = None, format: str = "json", db: Session = Depends(get_db)):
+    """
+    Entries of a wine list in document order, with extra_data merged into each entry.
+    limit pages with a keyset cursor (next page's cursor in X-Next-Cursor); without it the
+    whole list is streamed. fields= projects columns (e.g. leave out extra_data and raw_text),
+    status and needs_review filter, and format=ndjson gives one entry per line.
+    While the list is still parsing, the entries saved so far are returned with X-Partial-Results: true.
+    """
     wine_list = db.query(WineListFile).get(file_id)
-    if not wine_list:
-        raise HTTPException(status_code=404, detail="Wine list file not found")
-    entries = db.query(WineEntry).filter_by(wine_list_file_id=file_id).all()
-    if not entries:
-        raise HTTPException(status_code=404, detail="No wine entries found for this file")
-    import random
-    entry = random.choice(entries)
+    partial = "true" if wine_list and wine_list.partial_results else "false"
+    return _entry_listing(file_id, db, True, limit, cursor, fields, status, needs_review, format,
+                          {"X-Partial-Results": partial})
+
+def _refinement_entry(entry: WineEntry) -> dict:
+    entry_dict = {c.name: getattr(entry, c.name) for c in WineEntry.__table__.columns}
+    entry_dict['id'] = str(entry.id)
     # Check if key fields are missing
     key_fields = ["producer", "cuvee", "vintage", "price", "type"]
-    needs_parse = any(getattr(entry, f, None) in (None, "") for f in key_fields)
-    if needs_parse:
+    if any(getattr(entry, f, None) in (None, "") for f in key_fields):
         # Parse with global rules (stateless, do not save)
-        entry_dict = {c.name: getattr(entry, c.name) for c in WineEntry.__table__.columns}
-        entry_dict['raw_text'] = entry.raw_text
-        parsed, _ = extract_fields_for_entries([entry_dict], ruleset=None, global_rules=GLOBAL_RULES)
+        parsed, _ = extract_fields_for_entries([entry_dict], ruleset=None, global_rules=GLOBAL_RULES,
+                                               restaurant_id=entry.restaurant_id)
         enriched = entry_dict.copy()
         enriched.update(parsed[0])
         enriched['id'] = str(entry.id)
         return enriched
-    else:
-        # Return as dict (with id as str)
-        entry_dict = {c.name: getattr(entry, c.name) for c in WineEntry.__table__.columns}
-        entry_dict['id'] = str(entry.id)
-        return entry_dict
+    return entry_dict
+
+@api_router.post("/wine-lists/{file_id}/refinement/random", dependencies=[Depends(require_role("admin"))])
+def get_random_wine_for_refinement(file_id: str, mode: str = "queue", after: Optional[str] = None, db: Session = Depends(get_db)):
+    """
+    Next entry to review. mode=queue (default) serves pending entries lowest confidence first;
+    pass after=<id of the entry shown> to skip it. mode=random picks a random pending entry.
+    Both are single indexed lookups; the list is never loaded.
+    """
+    if mode not in ("queue", "random"):
+        raise HTTPException(status_code=400, detail="mode must be queue or random")
+    if after is not None:
+        try:
+            after = UUID(after)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="after must be a wine entry id")
+    wine_list = db.query(WineListFile).get(file_id)
+    if not wine_list:
+        raise HTTPException(status_code=404, detail="Wine list file not found")
+    entry = random_review_entry(db, wine_list.id) if mode == "random" else next_review_entry(db, wine_list.id, after)
+    if not entry:
+        raise HTTPException(status_code=404, detail="No wine entries left to review for this file")
+    return _refinement_entry(entry)
+
+@api_router.get("/wine-lists/{file_id}/review-queue", dependencies=[Depends(require_role("admin"))])
+def get_review_queue(file_id: str, db: Session = Depends(get_db)):
+    """
+    Entries still waiting for review, and how many of those are below the confidence threshold.
+    """
+    wine_list = db.query(WineListFile).get(file_id)
+    if not wine_list:
+        raise HTTPException(status_code=404, detail="Wine list file not found")
+    return review_queue_stats(db, wine_list.id)
 
 class WineRefinementUpdate(BaseModel):
     entry_id: str
@@ -515,10 +582,22 @@ def update_wine_refinement_and_generate_rule(file_id: str, data: WineRefinementU
     entry = db.query(WineEntry).get(data.entry_id)
     if not entry:
         raise HTTPException(status_code=404, detail="Wine entry not found")
+    # Remember producer/cuvee corrections as restaurant aliases so LWIN matching skips fuzzy search next time
+    correction = {}
+    for field in ['producer', 'cuvee']:
+        if field in data.fields and getattr(entry, field) and data.fields[field] != getattr(entry, field):
+            correction[field] = getattr(entry, field)
+            correction[f'corrected_{field}'] = data.fields[field]
     for k, v in data.fields.items():
         setattr(entry, k, v)
+    # A reviewed entry leaves the review queue unless the reviewer set another status
+    if entry.status in (WineEntryStatus.auto, WineEntryStatus.auto.value):
+        entry.status = WineEntryStatus.user_edited
+    entry.version = (entry.version or 1) + 1
     db.commit()
     db.refresh(entry)
+    if correction:
+        update_lwin_alias_table(correction, restaurant_id=entry.restaurant_id)
     # Generate/update ruleset for the restaurant
     wine_list = db.query(WineListFile).get(file_id)
     if not wine_list:
@@ -526,21 +605,25 @@ def update_wine_refinement_and_generate_rule(file_id: str, data: WineRefinementU
     # For now, just log the correction; rule generation logic can be expanded
     # Re-parse the file with the new rule (pseudo-code, to be implemented)
     # parse_wine_list_again(wine_list, new_rule_from_correction)
-    # Select next random wine for refinement
-    entries = db.query(WineEntry).filter_by(wine_list_file_id=file_id).all()
-    import random
-    entry = random.choice(entries)
-    return entry
+    # Serve the next entry from the review queue
+    next_entry = next_review_entry(db, wine_list.id)
+    return _refinement_entry(next_entry) if next_entry else None
 
 @api_router.get("/wine-lists/{file_id}/refinement-data", dependencies=[Depends(require_role("admin"))])
-def get_wine_list_refinement_data(file_id: str, db: Session = Depends(get_db)):
+def get_wine_list_refinement_data(file_id: str, sections: Optional[str] = None, db: Session = Depends(get_db)):
     """
-    Return the refinement data (JSON) for a given wine list file.
-    Looks up the specs/refinement_{filename}.json referenced in wine_list.notes.
+    Return the refinement data for a given wine list file. sections= (comma-separated, e.g.
+    needs_review,restaurant_rules) returns only those parts; only they are read and decompressed.
+    Lists parsed before refinement data moved to the database fall back to the
+    specs/refinement_{filename}.json referenced in wine_list.notes.
     """
     wine_list = db.query(WineListFile).get(file_id)
     if not wine_list:
         raise HTTPException(status_code=404, detail="Wine list file not found")
+    requested = [section.strip() for section in sections.split(",") if section.strip()] if sections else None
+    data = load_refinement_data(db, wine_list.id, requested)
+    if data is not None:
+        return data
     # Parse the refinement_json path from notes
     import re, os, json
     notes = wine_list.notes or ""
@@ -556,10 +639,20 @@ def get_wine_list_refinement_data(file_id: str, db: Session = Depends(get_db)):
     try:
         with open(abs_path, "r", encoding="utf-8") as f:
             data = json.load(f)
-        return data
+        return {k: v for k, v in data.items() if k in requested} if requested else data
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error reading refinement data: {str(e)}")
 
+@api_router.get("/wine-lists/{file_id}/refinement-data/sections", dependencies=[Depends(require_role("admin"))])
+def list_wine_list_refinement_sections(file_id: str, db: Session = Depends(get_db)):
+    """
+    Sections of the stored refinement data with their uncompressed sizes in bytes.
+    """
+    wine_list = db.query(WineListFile).get(file_id)
+    if not wine_list:
+        raise HTTPException(status_code=404, detail="Wine list file not found")
+    return refinement_sections(db, wine_list.id)
+
 @api_router.post("/wine-entries/{wine_entry_id}/refine/ai", dependencies=[Depends(require_role("admin"))])
 def refine_wine_entry_ai(wine_entry_id: str, db: Session = Depends(get_db)):
     """
@@ -571,8 +664,11 @@ def refine_wine_entry_ai(wine_entry_id: str, db: Session = Depends(get_db)):
     # Prepare entry dict for AI
     entry_dict = {c.name: getattr(entry, c.name) for c in WineEntry.__table__.columns}
     entry_dict['raw_text'] = entry.raw_text
-    # Run AI parser
-    enriched = parse_wine_entries([entry_dict])[0]
+    # Run AI parser (interactive refinements only count against the restaurant's daily budget)
+    budget = AiBudget(restaurant_id=str(entry.restaurant_id), upload_tokens=None)
+    enriched = parse_wine_entries([entry_dict], budget=budget)[0]
+    if enriched.get('ai_budget_exceeded'):
+        raise HTTPException(status_code=429, detail="Daily AI token budget exhausted for this restaurant")
     # Merge with original fields
     for k, v in enriched.items():
         if v is not None:
@@ -600,6 +696,92 @@ def refine_wine_entry_lwin(wine_entry_id: str, db: Session = Depends(get_db)):
     else:
         return entry_dict
 
+@api_router.get("/wine-entries/{wine_entry_id}/lwin-suggestions", dependencies=[Depends(require_role("admin"))])
+def lwin_suggestions_for_entry(wine_entry_id: str, limit: int = 5, db: Session = Depends(get_db)):
+    """
+    Return the top-k ranked LWIN candidates for a wine entry (for the refinement candidate picker).
+    """
+    entry = db.query(WineEntry).get(wine_entry_id)
+    if not entry:
+        raise HTTPException(status_code=404, detail="Wine entry not found")
+    entry_dict = {c.name: getattr(entry, c.name) for c in WineEntry.__table__.columns}
+    suggestions = get_lwin_suggestions(entry_dict, limit=min(limit, 50), restaurant_id=str(entry.restaurant_id))
+    return {"suggestions": suggestions, "lwin_version": get_lwin_snapshot().version}
+
+@api_router.post("/lwin/suggestions", dependencies=[Depends(require_role("admin"))])
+def lwin_suggestions(data: LwinSuggestionRequest):
+    """
+    Return the top-k ranked LWIN candidates for free-form fields (e.g. as a reviewer types).
+    """
+    wine = data.dict(exclude={"limit", "restaurant_id"})
+    restaurant_id = str(data.restaurant_id) if data.restaurant_id else None
+    suggestions = get_lwin_suggestions(wine, limit=min(data.limit, 50), restaurant_id=restaurant_id)
+    return {"suggestions": suggestions, "lwin_version": get_lwin_snapshot().version}
+
+@api_router.get("/lwin/suggestions/latency", dependencies=[Depends(require_role("admin"))])
+def lwin_suggestions_latency():
+    """
+    Return p50/p95 latency of recent suggestion lookups against the SLO.
+    """
+    return get_lwin_suggestion_latency()
+
+@api_router.get("/lwin/status", dependencies=[Depends(require_role("admin"))])
+def lwin_status():
+    """
+    Return the active LWIN snapshot version and the state of any reload in progress.
+    """
+    return get_lwin_status()
+
+@api_router.post("/lwin/reload", dependencies=[Depends(require_role("admin"))])
+def lwin_reload():
+    """
+    Rebuild the LWIN snapshot from the current export in the background and swap it in when ready.
+    """
+    if not reload_lwin_db(background=True):
+        raise HTTPException(status_code=409, detail="LWIN reload already in progress")
+    return {"detail": "LWIN reload started", "current_version": get_lwin_snapshot().version}
+
+@api_router.get("/lwin/cache/stats", dependencies=[Depends(require_role("admin"))])
+def lwin_cache_stats():
+    """
+    Return LWIN match cache hit/miss counters and entry counts for the current LWIN snapshot.
+    """
+    return get_lwin_cache_stats(get_lwin_snapshot().version)
+
+@api_router.delete("/lwin/cache", dependencies=[Depends(require_role("admin"))])
+def clear_lwin_cache():
+    """
+    Drop every cached LWIN match (e.g. after changing the matching logic).
+    """
+    deleted = invalidate_lwin_match_cache()
+    return {"detail": "Cleared", "deleted": deleted}
+
+@api_router.delete("/lwin/aliases", dependencies=[Depends(require_role("admin"))])
+def remove_lwin_alias(field: str, alias: str, restaurant_id: Optional[UUID] = None):
+    """
+    Remove a producer/cuvee alias (a restaurant's, or a global one if no restaurant_id).
+    Every worker drops it on its next alias refresh.
+    """
+    if field not in ("producer", "cuvee"):
+        raise HTTPException(status_code=400, detail="field must be producer or cuvee")
+    if not delete_lwin_alias(field, alias, str(restaurant_id) if restaurant_id else None):
+        raise HTTPException(status_code=404, detail="Alias not found")
+    return {"detail": "Deleted"}
+
+@api_router.get("/ai/cache/stats", dependencies=[Depends(require_role("admin"))])
+def ai_cache_stats():
+    """
+    Return AI result cache hit-rate metrics and entry counts.
+    """
+    return get_ai_cache_stats()
+
+@api_router.post("/ai/cache/evict", dependencies=[Depends(require_role("admin"))])
+def ai_cache_evict():
+    """
+    Run an AI cache eviction sweep now (expired entries, then least recently hit beyond the size cap).
+    """
+    return {"detail": "Evicted", "deleted": evict_ai_cache()}
+
 @api_router.post("/sync-user")
 def sync_user(data: SyncUserRequest, db: Session = Depends(get_db)):
     user = db.query(User).filter_by(supabase_user_id=data.supabase_user_id).first()
@@ -0,0 +1,148 @@
+import json
+import time
+import zlib
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.database import SessionLocal
+from app.models import PipelineArtifact
+from app.config import PIPELINE_CHECKPOINTS_ENABLED, PIPELINE_ARTIFACT_TTL_DAYS
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Bump a stage's version whenever its output changes for the same input, so stale artifacts aren't reused
+STAGE_VERSIONS = {
+    'extracting': 1,
+    'preprocessing': 1,
+    'detecting_sections': 1,
+    'segmenting': 1,
+    'parsing': 2
+}
+
+PIPELINE_ARTIFACT_EVICT_INTERVAL = 3600  # Seconds between eviction sweeps
+_last_eviction = 0.0
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def hash_json(obj: Any) -> str:
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+def artifact_key(stage: str, input_hash: str) -> str:
+    return hashlib.sha256(f"{stage}\x1f{STAGE_VERSIONS[stage]}\x1f{input_hash}".encode('utf-8')).hexdigest()
+
+def existing_artifacts(keys: List[str]) -> set:
+    db = SessionLocal()
+    try:
+        return {key for (key,) in db.query(PipelineArtifact.artifact_key).filter(PipelineArtifact.artifact_key.in_(keys))}
+    except Exception as e:
+        logger.error(f"Error reading pipeline artifacts: {str(e)}")
+        return set()
+    finally:
+        db.close()
+
+def load_artifact(key: str) -> Optional[Any]:
+    db = SessionLocal()
+    try:
+        row = db.query(PipelineArtifact).get(key)
+        return json.loads(zlib.decompress(row.data).decode('utf-8')) if row else None
+    except Exception as e:
+        logger.error(f"Error loading pipeline artifact {key}: {str(e)}")
+        return None
+    finally:
+        db.close()
+
+def save_artifact(key: str, stage: str, input_hash: str, data: Any) -> None:
+    payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    db = SessionLocal()
+    try:
+        # Same key means same input and stage version, so a concurrent writer produced the same output
+        stmt = pg_insert(PipelineArtifact.__table__).values(
+            artifact_key=key, stage=stage, stage_version=STAGE_VERSIONS[stage], input_hash=input_hash,
+            data=zlib.compress(payload, 6), size_bytes=len(payload), date_created=datetime.utcnow()
+        ).on_conflict_do_nothing(index_elements=['artifact_key'])
+        db.execute(stmt)
+        db.commit()
+    except Exception as e:
+        # A checkpoint that fails to save only costs a recompute on retry
+        logger.error(f"Error saving pipeline artifact for {stage}: {str(e)}")
+        db.rollback()
+    finally:
+        db.close()
+    _maybe_evict()
+
+def run_checkpointed(source_hash: str, stages: List[Tuple[str, Callable[[Any], Any], str]],
+                     on_stage: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+    """Run a chain of stages, each fed the previous stage's output, persisting every output.
+
+    stages is a list of (name, function, extra input hash). A stage's key covers its
+    name, version, extra inputs and the previous stage's key, so keys for the whole
+    chain are known before anything runs: the pipeline resumes after the last stage
+    with a stored artifact and only recomputes from there. Outputs must be JSON
+    serializable. Returns {stage name: output} for the stages loaded or run (earlier
+    stages skipped by a resume are absent).
+    """
+    keys = []
+    input_hashes = []
+    previous = source_hash
+    for name, _, extra in stages:
+        input_hash = hashlib.sha256(f"{previous}\x1f{extra}".encode('utf-8')).hexdigest()
+        input_hashes.append(input_hash)
+        previous = artifact_key(name, input_hash)
+        keys.append(previous)
+
+    outputs: Dict[str, Any] = {}
+    start = 0
+    value = None
+    if PIPELINE_CHECKPOINTS_ENABLED:
+        stored = existing_artifacts(keys)
+        for i in reversed(range(len(stages))):
+            if keys[i] in stored:
+                value = load_artifact(keys[i])
+                if value is not None:
+                    outputs[stages[i][0]] = value
+                    start = i + 1
+                    logger.info(f"Resuming pipeline after stored '{stages[i][0]}' output")
+                    break
+
+    for i in range(start, len(stages)):
+        name, function, _ = stages[i]
+        if on_stage:
+            on_stage(name)
+        value = function(value)
+        outputs[name] = value
+        if PIPELINE_CHECKPOINTS_ENABLED:
+            save_artifact(keys[i], name, input_hashes[i], value)
+    return outputs
+
+def _maybe_evict() -> None:
+    global _last_eviction
+    now = time.monotonic()
+    if now - _last_eviction < PIPELINE_ARTIFACT_EVICT_INTERVAL:
+        return
+    _last_eviction = now
+    evict_pipeline_artifacts()
+
+def evict_pipeline_artifacts() -> int:
+    """Delete artifacts older than PIPELINE_ARTIFACT_TTL_DAYS."""
+    db = SessionLocal()
+    try:
+        cutoff = datetime.utcnow() - timedelta(days=PIPELINE_ARTIFACT_TTL_DAYS)
+        deleted = db.query(PipelineArtifact).filter(PipelineArtifact.date_created < cutoff).delete(synchronize_session=False)
+        db.commit()
+        if deleted:
+            logger.info(f"Evicted {deleted} pipeline artifacts")
+        return deleted
+    except Exception as e:
+        logger.error(f"Error evicting pipeline artifacts: {str(e)}")
+        db.rollback()
+        return 0
+    finally:
+        db.close()
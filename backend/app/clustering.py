@@ -0,0 +1,92 @@
+import re
+import copy
+from typing import List, Dict, Any, Tuple, Optional, Hashable
+from app.gazetteer import tokenize
+
+# Fields that differ between variants of the same wine; everything else is shared by a cluster
+VARIANT_FIELDS = ('vintage', 'price', 'bottle_size')
+
+_VINTAGE_PATTERN = re.compile(r'\b(?:19|20)\d{2}\b|(?<!\w)n\.?\s?v\.?(?!\w)', re.IGNORECASE)
+_SIZE_PATTERN = re.compile(
+    r'\b\d+(?:[.,]\d+)?\s*(?:ml|cl|ltr|lt|l|litres?|liters?)\b'
+    r'|\b(?:magnum|jeroboam|rehoboam|methuselah|salmanazar|balthazar|nebuchadnezzar|imperial|half[\s-]?bottle|half|demi)\b',
+    re.IGNORECASE
+)
+_PRICE_PATTERN = re.compile(
+    r'[€$£]\s*\d[\d.,]*|\d[\d.,]*\s*(?:[€$£]|eur|gbp|usd)\b|(?<![\w.,])\d{1,4}(?:[.,]\d{2})?\s*$',
+    re.IGNORECASE
+)
+# Serving formats aren't wine attributes either ("125ml glass", "carafe")
+_FORMAT_WORDS = {'bottle', 'btl', 'glass', 'carafe', 'bt'}
+
+def split_variants(text: str) -> Tuple[str, Dict[str, str]]:
+    """Strip vintage, size and price tokens from an entry's text.
+
+    Returns the canonical shape of the entry (folded words, numbers and serving
+    formats removed) and the variant values found, so "Krug Grande Cuvée 750ml"
+    and "Krug Grande Cuvee Magnum" share the key 'krug grande cuvee'.
+    """
+    variants = {}
+    stripped = text or ''
+    for field, pattern in (('vintage', _VINTAGE_PATTERN), ('bottle_size', _SIZE_PATTERN), ('price', _PRICE_PATTERN)):
+        match = pattern.search(stripped)
+        if match:
+            variants[field] = match.group(0).strip()
+            stripped = pattern.sub(' ', stripped)
+    words = [word for word, _, _ in tokenize(stripped) if not word.isdigit() and word not in _FORMAT_WORDS]
+    return ' '.join(words), variants
+
+def canonical_key(text: str) -> str:
+    return split_variants(text)[0]
+
+def cluster_entries(keys: List[Optional[Hashable]]) -> List[List[int]]:
+    """Group entry indices by key, in first-seen order. The first index of each group is its
+    representative. Entries whose key is empty (None) are never grouped."""
+    clusters: Dict[Hashable, List[int]] = {}
+    singletons = []
+    for index, key in enumerate(keys):
+        if not key:
+            singletons.append([index])
+        else:
+            clusters.setdefault(key, []).append(index)
+    return sorted(list(clusters.values()) + singletons, key=lambda cluster: cluster[0])
+
+def _variant_values(entry: Dict[str, Any], text: str) -> Dict[str, Any]:
+    _, found = split_variants(text)
+    extracted = entry.get('extracted') or {}
+    values = {}
+    for field in VARIANT_FIELDS:
+        value = entry.get(field) or extracted.get(field) or found.get(field)
+        if value:
+            values[field] = value
+    return values
+
+def fan_out(clusters: List[List[int]], inputs: List[Dict[str, Any]], rep_results: List[Dict[str, Any]],
+            texts: List[str]) -> List[Dict[str, Any]]:
+    """Spread each representative's enrichment to the other members of its cluster.
+
+    Whatever enrichment added or changed relative to the representative's input is
+    copied onto each member's own input (nested dicts such as field_confidence are
+    merged); vintage, price and size always come from the member itself.
+    Returns one result per input, in input order.
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(inputs)
+    for cluster, rep_result in zip(clusters, rep_results):
+        rep_input = inputs[cluster[0]]
+        delta = {key: value for key, value in (rep_result or {}).items() if rep_input.get(key) != value}
+        for index in cluster:
+            if index == cluster[0]:
+                results[index] = rep_result
+                continue
+            member = copy.deepcopy(inputs[index])
+            for key, value in delta.items():
+                if key in VARIANT_FIELDS:
+                    continue
+                if isinstance(value, dict) and isinstance(member.get(key), dict):
+                    member[key].update({k: v for k, v in value.items()
+                                   if k not in VARIANT_FIELDS and (rep_input.get(key) or {}).get(k) != v})
+                else:
+                    member[key] = copy.deepcopy(value)
+            member.update(_variant_values(inputs[index], texts[index]))
+            results[index] = member
+    return results
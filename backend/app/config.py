@@ -1,4 +1,5 @@
 import os
+import json
 from dotenv import load_dotenv
 from supabase import create_client, Client
 
@@ -11,11 +12,56 @@ OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo')  # Default to gpt-3.5-
 
 # LWIN configuration
 LWIN_XLSX_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'specs', 'LWINdatabase.xlsx')
+LWIN_RELOAD_CHECK_INTERVAL = 60  # Seconds between checks for a new LWIN export on disk
+LWIN_ALIAS_REFRESH_INTERVAL = 30  # Seconds between incremental alias reloads (picks up other workers' corrections)
+LWIN_ALIAS_REFRESH_OVERLAP = 120  # Seconds re-read behind the watermark, so rows committed late by slow transactions aren't missed
+LWIN_SUGGESTIONS_SLO_MS = 50  # p95 latency target for the LWIN suggestions endpoint
+LWIN_MATCH_CACHE_ENABLED = os.getenv('LWIN_MATCH_CACHE_ENABLED', 'true').lower() == 'true'  # Shared DB cache of LWIN match results
 
 # Parsing configuration
+PRODUCER_GAZETTEER_ENABLED = os.getenv('PRODUCER_GAZETTEER_ENABLED', 'true').lower() == 'true'  # Aho-Corasick producer stage
+ENTRY_CLUSTERING_ENABLED = os.getenv('ENTRY_CLUSTERING_ENABLED', 'true').lower() == 'true'  # Enrich one entry per near-duplicate cluster
 MIN_CONFIDENCE_THRESHOLD = 0.75
 BATCH_SIZE = 5  # Number of entries to process in parallel
-CACHE_SIZE = 1000  # Number of entries to cache for AI parsing 
+AI_MAX_CONCURRENCY = int(os.getenv('AI_MAX_CONCURRENCY', BATCH_SIZE))  # Concurrent AI requests per process
+AI_REQUEST_TIMEOUT = float(os.getenv('AI_REQUEST_TIMEOUT', 30))  # Seconds before a single AI request is abandoned
+AI_REQUESTS_PER_MINUTE = int(os.getenv('AI_REQUESTS_PER_MINUTE', 500))  # Account-wide request rate limit
+AI_TOKENS_PER_MINUTE = int(os.getenv('AI_TOKENS_PER_MINUTE', 200000))  # Account-wide token rate limit
+AI_RATE_LIMIT_PROCESSES = int(os.getenv('AI_RATE_LIMIT_PROCESSES', 3))  # Processes calling AI (API + workers, on every node); each gets an equal share of the limits
+AI_MAX_RETRIES = 4  # Retries on 429/5xx/timeouts before an AI request fails
+AI_BACKOFF_BASE = 1.0  # Seconds; backoff cap doubles per attempt, with full jitter
+AI_BACKOFF_MAX = 30.0  # Seconds
+AI_UPLOAD_TOKEN_BUDGET = int(os.getenv('AI_UPLOAD_TOKEN_BUDGET', 50000))  # AI tokens one upload may spend
+AI_RESTAURANT_DAILY_TOKEN_BUDGET = int(os.getenv('AI_RESTAURANT_DAILY_TOKEN_BUDGET', 500000))  # AI tokens per restaurant per day
+AI_ROUTED_MODE = os.getenv('AI_ROUTED_MODE', 'true').lower() == 'true'  # Only ask AI for missing/low-confidence fields
+AI_PACKED_MODE = os.getenv('AI_PACKED_MODE', 'true').lower() == 'true'  # Send several entries per AI request
+AI_PACK_MAX_ITEMS = 10  # Most entries packed into one request
+AI_PACK_TOKEN_BUDGET = 3000  # Estimated prompt + completion tokens per packed request
+AI_PACK_COMPLETION_TOKENS_PER_ITEM = 120  # Expected completion tokens per packed entry
+CACHE_SIZE = 1000  # Number of entries to cache for AI parsing (in-process, in front of the shared cache)
+AI_CACHE_TTL_SECONDS = int(os.getenv('AI_CACHE_TTL_SECONDS', 30 * 24 * 3600))  # Age after which cached AI results expire
+AI_CACHE_MAX_ENTRIES = int(os.getenv('AI_CACHE_MAX_ENTRIES', 100000))  # Shared cache size before least recently hit entries are evicted
+AI_CACHE_EVICT_INTERVAL = 3600  # Seconds between eviction sweeps
+
+# Background job configuration
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))  # Worker processes the API starts itself (0 when running worker.py separately)
+JOB_QUEUE_MAX_PENDING = int(os.getenv('JOB_QUEUE_MAX_PENDING', 10))  # Queued bulk uploads before new ones get 429
+JOB_INTERACTIVE_MAX_PENDING = int(os.getenv('JOB_INTERACTIVE_MAX_PENDING', 50))  # Queued interactive jobs (re-parses) before 429
+JOB_LANES = ['interactive', 'bulk']  # Priority order: a free worker always takes interactive work first
+JOB_LANE_MAX_RUNNING = {  # Cluster-wide running jobs per lane (0 = no cap); capping bulk keeps workers free for interactive jobs
+    'interactive': int(os.getenv('JOB_INTERACTIVE_MAX_RUNNING', 0)),
+    'bulk': int(os.getenv('JOB_BULK_MAX_RUNNING', max(1, JOB_WORKERS - 1)))
+}
+JOB_FAIRNESS_WINDOW = 3600  # Seconds of recent job starts counted when choosing which restaurant goes next
+JOB_RESTAURANT_WEIGHTS = json.loads(os.getenv('JOB_RESTAURANT_WEIGHTS', '{}'))  # {restaurant_id: weight}, default weight 1
+PIPELINE_CHECKPOINTS_ENABLED = os.getenv('PIPELINE_CHECKPOINTS_ENABLED', 'true').lower() == 'true'  # Persist each stage's output for resumable retries
+PIPELINE_ARTIFACT_TTL_DAYS = 90  # Artifacts older than this are removed by the cleanup sweep
+ENTRY_COMMIT_BATCH_SIZE = int(os.getenv('ENTRY_COMMIT_BATCH_SIZE', 200))  # Parsed entries saved per commit while a list is still parsing
+ENTRY_COPY_MIN_ROWS = int(os.getenv('ENTRY_COPY_MIN_ROWS', 500))  # Saves of this many entries or more use COPY on Postgres
+JOB_LEASE_SECONDS = 120  # A running job not heartbeated for this long is considered abandoned
+JOB_HEARTBEAT_INTERVAL = 30  # Seconds between lease renewals while a job runs
+JOB_MAX_ATTEMPTS = 3  # Claims (first run plus retries of abandoned runs) before a job is failed
+JOB_POLL_INTERVAL = 2  # Seconds an idle worker waits before looking for work again
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")  # Use service role for backend
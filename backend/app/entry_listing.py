@@ -0,0 +1,118 @@
+import json
+import uuid
+import base64
+import logging
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from sqlalchemy import select, or_, and_
+from sqlalchemy.orm import Session
+from app.database import SessionLocal
+from app.models import WineEntry, WineEntryStatus
+from app.config import MIN_CONFIDENCE_THRESHOLD
+
+logger = logging.getLogger(__name__)
+
+ENTRY_FIELDS = [c.name for c in WineEntry.__table__.columns]
+ENTRY_STREAM_BATCH_SIZE = 500  # Rows fetched per round trip when streaming a whole list
+ENTRY_PAGE_MAX = 1000  # Largest page a client can ask for
+
+# Entries without a position (saved before it existed) sort first, in id order; the bare column
+# (not an expression over it) keeps the (wine_list_file_id, position NULLS FIRST, id) index usable
+_ORDER = (WineEntry.position.asc().nulls_first(), WineEntry.id)
+
+def parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """Validate a comma-separated fields= projection. None means every column."""
+    if not fields:
+        return None
+    requested = [f.strip() for f in fields.split(',') if f.strip()]
+    unknown = [f for f in requested if f not in ENTRY_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return requested
+
+def encode_cursor(position: Optional[int], entry_id: Any) -> str:
+    payload = json.dumps([position, str(entry_id)])
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str) -> Tuple[Optional[int], uuid.UUID]:
+    try:
+        position, entry_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        position = None if position is None or int(position) < 0 else int(position)  # -1: NULL in older cursors
+        return position, uuid.UUID(entry_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def _after_cursor(position: Optional[int], entry_id: uuid.UUID):
+    """Rows after (position, entry_id) in _ORDER, with every comparison on the bare columns."""
+    if position is None:
+        # Still in the NULL-position prefix: the rest of it, then every positioned entry
+        return or_(and_(WineEntry.position.is_(None), WineEntry.id > entry_id), WineEntry.position.isnot(None))
+    return or_(WineEntry.position > position, and_(WineEntry.position == position, WineEntry.id > entry_id))
+
+def entry_select(file_id: str, fields: Optional[List[str]] = None, status: Optional[str] = None,
+                 needs_review: Optional[bool] = None, cursor: Optional[str] = None):
+    """Select a wine list's entries in document order (position, then id), projected to fields.
+    id and position are always selected since the keyset cursor is built from them."""
+    columns = [WineEntry.__table__.c[name] for name in (fields or ENTRY_FIELDS)]
+    for required in (WineEntry.id, WineEntry.position):
+        if required.name not in (fields or ENTRY_FIELDS):
+            columns.append(required)
+    stmt = select(*columns).where(WineEntry.wine_list_file_id == file_id)
+    if status:
+        stmt = stmt.where(WineEntry.status == WineEntryStatus(status))
+    if needs_review is not None:
+        review = or_(WineEntry.row_confidence < MIN_CONFIDENCE_THRESHOLD, WineEntry.row_confidence.is_(None))
+        stmt = stmt.where(review if needs_review else ~review)
+    if cursor:
+        stmt = stmt.where(_after_cursor(*decode_cursor(cursor)))
+    return stmt.order_by(*_ORDER)
+
+def entry_to_dict(row: Any, fields: Optional[List[str]] = None, merge_extra: bool = True) -> Dict[str, Any]:
+    """JSON-ready dict for a selected row. With merge_extra, extra_data's keys are merged into the
+    entry (as the refinement UI expects) instead of being nested."""
+    data = {}
+    for name in fields or ENTRY_FIELDS:
+        value = getattr(row, name)
+        if name == 'extra_data' and merge_extra:
+            continue
+        if isinstance(value, WineEntryStatus):
+            value = value.value
+        elif name == 'field_confidence' and merge_extra:
+            value = value or {}
+        elif hasattr(value, 'isoformat'):
+            value = value.isoformat()
+        data[name] = value
+    if merge_extra and 'extra_data' in (fields or ENTRY_FIELDS) and row.extra_data:
+        data.update(row.extra_data)
+    return data
+
+def list_entries_page(db: Session, file_id: str, limit: int, **filters) -> Tuple[List[Any], Optional[str]]:
+    """One page of rows and the cursor for the next page (None on the last page)."""
+    limit = max(1, min(limit, ENTRY_PAGE_MAX))
+    rows = db.execute(entry_select(file_id, **filters).limit(limit + 1)).all()
+    if len(rows) <= limit:
+        return rows, None
+    last = rows[limit - 1]
+    return rows[:limit], encode_cursor(last.position, last.id)
+
+def iter_entries(file_id: str, **filters) -> Iterator[Any]:
+    """Stream every matching row with a server-side cursor, so memory stays flat however long the list.
+    Uses its own session, since it runs while the response is being sent."""
+    db = SessionLocal()
+    try:
+        result = db.execute(entry_select(file_id, **filters).execution_options(yield_per=ENTRY_STREAM_BATCH_SIZE))
+        for row in result:
+            yield row
+    finally:
+        db.close()
+
+def encode_entries(rows: Iterator[Any], fmt: str = 'json', fields: Optional[List[str]] = None,
+                   merge_extra: bool = True) -> Iterator[str]:
+    """Serialize rows as a JSON array or as NDJSON (one entry per line), one row at a time."""
+    if fmt == 'ndjson':
+        for row in rows:
+            yield json.dumps(entry_to_dict(row, fields, merge_extra), default=str) + '\n'
+        return
+    yield '['
+    for i, row in enumerate(rows):
+        yield (',' if i else '') + json.dumps(entry_to_dict(row, fields, merge_extra), default=str)
+    yield ']'
@@ -0,0 +1,172 @@
+import re
+import threading
+import unicodedata
+from collections import deque, OrderedDict
+from typing import List, Dict, Any, Tuple, Iterable, Optional, Callable
+
+# Words that name a style or title rather than a producer when they appear alone
+GAZETTEER_STOPWORDS = {
+    'chateau', 'domaine', 'estate', 'wine', 'wines', 'winery', 'vineyard', 'vineyards', 'cellar', 'cellars',
+    'grand', 'cru', 'premier', 'reserve', 'reserva', 'riserva', 'brut', 'sec', 'rose', 'blanc', 'rouge',
+    'red', 'white', 'sparkling', 'champagne', 'magnum', 'vintage', 'cuvee', 'classico', 'superiore'
+}
+
+# Single-word names shorter than this are too ambiguous to match on their own
+GAZETTEER_MIN_SINGLE_WORD_LENGTH = 4
+
+# Restaurants whose own alias automata are kept (least recently parsed evicted)
+GAZETTEER_RESTAURANT_CACHE_SIZE = 256
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+def fold_token(token: str) -> str:
+    """Lowercase and strip accents from a single word (so 'Romanée' and 'romanee' compare equal)."""
+    decomposed = unicodedata.normalize('NFKD', token.lower())
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+def tokenize(text: str) -> List[Tuple[str, int, int]]:
+    """Split text into (folded word, start, end) tuples with offsets into the original text."""
+    return [(fold_token(m.group(0)), m.start(), m.end()) for m in _TOKEN_PATTERN.finditer(text)]
+
+class AhoCorasick:
+    """Word-level Aho-Corasick automaton.
+
+    Every name is compiled into a single trie over folded words with failure links,
+    so one left-to-right pass over a text finds all known names in time linear in
+    the number of words, regardless of how many names are loaded. Working on words
+    rather than characters keeps the trie small and gives word-boundary matches.
+    """
+    def __init__(self, names: Iterable[Tuple[str, Any]]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[List[Tuple[int, Any]]] = [[]]  # (name length in words, value) ending at each state
+        self.size = 0
+        for name, value in names:
+            self._add([token for token, _, _ in tokenize(name)], value)
+        self._build_failure_links()
+
+    def _add(self, words: List[str], value: Any) -> None:
+        if not words:
+            return
+        state = 0
+        for word in words:
+            next_state = self.goto[state].get(word)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][word] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+            state = next_state
+        if not self.output[state]:
+            self.size += 1
+        self.output[state].append((len(words), value))
+
+    def _build_failure_links(self) -> None:
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for word, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and word not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(word, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def find_all(self, text: str) -> List[Dict[str, Any]]:
+        """Return every known name in text as {'start', 'end', 'text', 'value', 'words'}."""
+        tokens = tokenize(text)
+        matches = []
+        state = 0
+        for i, (word, _, end) in enumerate(tokens):
+            while state and word not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(word, 0)
+            for length, value in self.output[state]:
+                start = tokens[i - length + 1][1]
+                matches.append({'start': start, 'end': end, 'text': text[start:end], 'value': value, 'words': length})
+        return matches
+
+    def find_longest(self, text: str) -> Optional[Dict[str, Any]]:
+        """Return the longest (then leftmost) known name in text, if any."""
+        matches = self.find_all(text)
+        if not matches:
+            return None
+        return max(matches, key=lambda m: (m['words'], -m['start']))
+
+def is_gazetteer_name(name: str, excluded: Iterable[str] = ()) -> bool:
+    """Filter out names that would fire on generic wine-list words."""
+    words = [token for token, _, _ in tokenize(name)]
+    if not words:
+        return False
+    if len(words) == 1:
+        word = words[0]
+        if len(word) < GAZETTEER_MIN_SINGLE_WORD_LENGTH or word in GAZETTEER_STOPWORDS or word in excluded:
+            return False
+    return ' '.join(words) not in excluded
+
+class ProducerGazetteer:
+    """Producer automata built from an LWIN snapshot plus persisted aliases, rebuilt when either changes.
+
+    The shared automata hold LWIN names and global aliases only. Each restaurant's own
+    aliases get a small automaton of their own, consulted only when parsing that
+    restaurant's lists.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lwin_key = None
+        self._alias_key = None
+        self.lwin_automaton: Optional[AhoCorasick] = None
+        self.alias_automaton: Optional[AhoCorasick] = None
+        # restaurant id -> (alias generation it was built at, automaton)
+        self._restaurant_automata: "OrderedDict[str, Tuple[int, AhoCorasick]]" = OrderedDict()
+
+    def ensure(self, lwin_version: str, load_lwin_names: Callable[[], Tuple[Iterable[str], Iterable[str]]],
+               alias_generation: int, load_aliases: Callable[[], Iterable[str]]) -> None:
+        """Rebuild stale automata. load_lwin_names returns (producer names, excluded names such as
+        countries and regions); loaders are only called when a rebuild is needed."""
+        # LWIN names are rebuilt only per snapshot; the (much smaller) alias automaton per alias change
+        if self._lwin_key != lwin_version:
+            with self._lock:
+                if self._lwin_key != lwin_version:
+                    producer_names, excluded = load_lwin_names()
+                    excluded = {' '.join(token for token, _, _ in tokenize(name)) for name in excluded}
+                    self.lwin_automaton = AhoCorasick(
+                        (name, 'lwin') for name in producer_names if is_gazetteer_name(name, excluded)
+                    )
+                    self._lwin_key = lwin_version
+        if self._alias_key != alias_generation:
+            with self._lock:
+                if self._alias_key != alias_generation:
+                    self.alias_automaton = AhoCorasick((name, 'alias') for name in load_aliases() if is_gazetteer_name(name))
+                    self._alias_key = alias_generation
+
+    def ensure_restaurant(self, restaurant_id: str, alias_generation: int, load_aliases: Callable[[], Iterable[str]]) -> None:
+        """Rebuild a restaurant's alias automaton if aliases changed since it was built."""
+        with self._lock:
+            cached = self._restaurant_automata.get(restaurant_id)
+            if cached is not None and cached[0] == alias_generation:
+                self._restaurant_automata.move_to_end(restaurant_id)
+                return
+        automaton = AhoCorasick((name, 'restaurant_alias') for name in load_aliases() if is_gazetteer_name(name))
+        with self._lock:
+            self._restaurant_automata[restaurant_id] = (alias_generation, automaton)
+            self._restaurant_automata.move_to_end(restaurant_id)
+            while len(self._restaurant_automata) > GAZETTEER_RESTAURANT_CACHE_SIZE:
+                self._restaurant_automata.popitem(last=False)
+
+    def find_producer(self, text: str, restaurant_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Return the longest known producer mentioned in text, with its span. Aliases of
+        restaurant_id (see ensure_restaurant) are matched too; no other restaurant's are."""
+        with self._lock:
+            cached = self._restaurant_automata.get(restaurant_id) if restaurant_id else None
+        matches = []
+        for automaton in (self.lwin_automaton, self.alias_automaton, cached[1] if cached else None):
+            if automaton is not None:
+                match = automaton.find_longest(text)
+                if match:
+                    matches.append(match)
+        if not matches:
+            return None
+        return max(matches, key=lambda m: (m['words'], -m['start']))
@@ -0,0 +1,324 @@
+import os
+import uuid
+import time
+import socket
+import logging
+import tempfile
+import threading
+import multiprocessing
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+from sqlalchemy import func, text
+from sqlalchemy.orm import Session
+from app.database import SessionLocal, engine
+from app.models import ParseJob, ParseJobStatus, WineListFile, WineEntry
+from app.processing import process_wine_list_file, ParseCancelled
+from app.progress import ProgressReporter
+from app.config import (
+    supabase, JOB_QUEUE_MAX_PENDING, JOB_INTERACTIVE_MAX_PENDING, JOB_LANES, JOB_LANE_MAX_RUNNING, JOB_FAIRNESS_WINDOW,
+    JOB_RESTAURANT_WEIGHTS, JOB_LEASE_SECONDS, JOB_HEARTBEAT_INTERVAL, JOB_MAX_ATTEMPTS, JOB_POLL_INTERVAL
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+WINE_LIST_BUCKET = "wine-lists"
+JOB_CLAIM_LOCK_KEY = 4106  # Advisory lock id shared by all workers' claim transactions
+
+class JobQueueFull(Exception):
+    """Raised when a lane already has its maximum of parse jobs waiting for a worker."""
+
+def job_to_dict(job: ParseJob) -> Dict[str, Any]:
+    return {
+        'job_id': str(job.id),
+        'wine_list_id': str(job.wine_list_file_id),
+        'restaurant_id': str(job.restaurant_id),
+        'lane': job.lane,
+        'status': job.status.value if hasattr(job.status, 'value') else job.status,
+        'stage': job.stage,
+        'progress': job.progress,
+        'attempts': job.attempts,
+        'worker_id': job.worker_id,
+        'lease_expires_at': job.lease_expires_at.isoformat() if job.lease_expires_at else None,
+        'error': job.error,
+        'submitted_at': job.date_created.isoformat() if job.date_created else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None
+    }
+
+def queued_job_count(db: Session, lane: Optional[str] = None) -> int:
+    query = db.query(func.count(ParseJob.id)).filter(ParseJob.status == ParseJobStatus.queued)
+    if lane:
+        query = query.filter(ParseJob.lane == lane)
+    return query.scalar()
+
+def lane_max_pending(lane: str) -> int:
+    return JOB_INTERACTIVE_MAX_PENDING if lane == 'interactive' else JOB_QUEUE_MAX_PENDING
+
+def has_active_job(db: Session, wine_list_id: Any) -> bool:
+    return db.query(ParseJob.id).filter(
+        ParseJob.wine_list_file_id == wine_list_id,
+        ParseJob.status.in_([ParseJobStatus.queued, ParseJobStatus.running])
+    ).first() is not None
+
+def enqueue_parse_job(db: Session, wine_list: WineListFile, storage_path: str, lane: str = 'bulk') -> ParseJob:
+    """Add a parse job for an uploaded wine list. Raises JobQueueFull when its lane's queue is at capacity."""
+    if lane not in JOB_LANES:
+        raise ValueError(f"Unknown job lane: {lane}")
+    if queued_job_count(db, lane) >= lane_max_pending(lane):
+        raise JobQueueFull(f"{lane_max_pending(lane)} {lane} parse jobs already queued")
+    job = ParseJob(
+        wine_list_file_id=wine_list.id,
+        restaurant_id=wine_list.restaurant_id,
+        storage_path=storage_path,
+        lane=lane,
+        status=ParseJobStatus.queued
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+def _open_lanes(db: Session) -> List[str]:
+    """Lanes below their running cap, in priority order."""
+    running = dict(db.query(ParseJob.lane, func.count(ParseJob.id)).filter(
+        ParseJob.status == ParseJobStatus.running
+    ).group_by(ParseJob.lane).all())
+    return [lane for lane in JOB_LANES if not JOB_LANE_MAX_RUNNING.get(lane) or running.get(lane, 0) < JOB_LANE_MAX_RUNNING[lane]]
+
+def _next_restaurant(db: Session, lane: str, now: datetime) -> Optional[Any]:
+    """Weighted fair choice among restaurants with queued work in a lane: the one with the fewest
+    recent job starts per unit of weight goes next, ties broken by who has waited longest."""
+    waiting = db.query(ParseJob.restaurant_id, func.min(ParseJob.date_created)).filter(
+        ParseJob.status == ParseJobStatus.queued, ParseJob.lane == lane
+    ).group_by(ParseJob.restaurant_id).all()
+    if not waiting:
+        return None
+    recent = dict(db.query(ParseJob.restaurant_id, func.count(ParseJob.id)).filter(
+        ParseJob.restaurant_id.in_([restaurant_id for restaurant_id, _ in waiting]),
+        ParseJob.started_at >= now - timedelta(seconds=JOB_FAIRNESS_WINDOW)
+    ).group_by(ParseJob.restaurant_id).all())
+    def share(item):
+        restaurant_id, oldest = item
+        weight = float(JOB_RESTAURANT_WEIGHTS.get(str(restaurant_id), 1)) or 1.0
+        return (recent.get(restaurant_id, 0) / weight, oldest)
+    return min(waiting, key=share)[0]
+
+def claim_parse_job(db: Session, worker_id: str) -> Optional[ParseJob]:
+    """Claim the next job for this worker.
+
+    Lanes are tried in priority order, skipping any at its running cap. Within a
+    lane, a running job whose lease lapsed (its worker died) is reclaimed first;
+    otherwise the restaurant chosen by _next_restaurant gets its oldest queued job.
+    SKIP LOCKED lets any number of workers on any number of nodes poll the same
+    table without handing the same job to two of them.
+    """
+    now = datetime.utcnow()
+    if db.bind.dialect.name == 'postgresql':
+        # Serialise claims so lane caps hold across nodes; released at commit
+        db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': JOB_CLAIM_LOCK_KEY})
+    job = None
+    for lane in _open_lanes(db):
+        job = db.query(ParseJob).filter(
+            ParseJob.lane == lane, ParseJob.status == ParseJobStatus.running,
+            ParseJob.lease_expires_at < now, ParseJob.attempts < JOB_MAX_ATTEMPTS
+        ).order_by(ParseJob.date_created).with_for_update(skip_locked=True).first()
+        if job is None:
+            restaurant_id = _next_restaurant(db, lane, now)
+            if restaurant_id is not None:
+                job = db.query(ParseJob).filter(
+                    ParseJob.lane == lane, ParseJob.status == ParseJobStatus.queued, ParseJob.restaurant_id == restaurant_id
+                ).order_by(ParseJob.date_created).with_for_update(skip_locked=True).first()
+        if job is not None:
+            break
+    if job is None:
+        db.rollback()
+        return None
+    if job.status == ParseJobStatus.running:
+        logger.warning(f"Reclaiming abandoned parse job {job.id} from worker {job.worker_id}")
+    job.status = ParseJobStatus.running
+    job.worker_id = worker_id
+    job.attempts = (job.attempts or 0) + 1
+    job.stage = None
+    job.progress = None
+    job.started_at = now
+    job.lease_expires_at = now + timedelta(seconds=JOB_LEASE_SECONDS)
+    db.commit()
+    db.refresh(job)
+    return job
+
+def renew_lease(job_id: Any, worker_id: str) -> bool:
+    """Extend a running job's lease. Returns False if the job no longer belongs to this worker."""
+    db = SessionLocal()
+    try:
+        updated = db.query(ParseJob).filter(
+            ParseJob.id == job_id, ParseJob.worker_id == worker_id, ParseJob.status == ParseJobStatus.running
+        ).update({ParseJob.lease_expires_at: datetime.utcnow() + timedelta(seconds=JOB_LEASE_SECONDS)}, synchronize_session=False)
+        db.commit()
+        return bool(updated)
+    finally:
+        db.close()
+
+def holds_lease(db: Session, job_id: Any, worker_id: str) -> bool:
+    """Lock the job row if this worker still owns it, in db's transaction. A reclaim has to update
+    the same row, so it waits until that transaction ends and can't interleave with its commit."""
+    return db.query(ParseJob.id).filter(
+        ParseJob.id == job_id, ParseJob.worker_id == worker_id, ParseJob.status == ParseJobStatus.running
+    ).with_for_update().first() is not None
+
+def finish_job(job_id: Any, worker_id: str, error: Optional[str] = None) -> None:
+    db = SessionLocal()
+    try:
+        db.query(ParseJob).filter(ParseJob.id == job_id, ParseJob.worker_id == worker_id).update({
+            ParseJob.status: ParseJobStatus.error if error else ParseJobStatus.done,
+            ParseJob.error: error,
+            ParseJob.finished_at: datetime.utcnow(),
+            ParseJob.lease_expires_at: None
+        }, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+def fail_exhausted_jobs(db: Session) -> int:
+    """Fail abandoned jobs that have used up their attempts, so their wine lists don't sit in 'processing'."""
+    now = datetime.utcnow()
+    jobs = db.query(ParseJob).filter(
+        ParseJob.status == ParseJobStatus.running, ParseJob.lease_expires_at < now, ParseJob.attempts >= JOB_MAX_ATTEMPTS
+    ).with_for_update(skip_locked=True).all()
+    for job in jobs:
+        job.status = ParseJobStatus.error
+        job.error = f"Abandoned after {job.attempts} attempts"
+        job.finished_at = now
+        wine_list = db.query(WineListFile).get(job.wine_list_file_id)
+        if wine_list:
+            wine_list.status = "error"
+            wine_list.notes = f"Error: parse abandoned after {job.attempts} attempts"
+    db.commit()
+    return len(jobs)
+
+def _download_wine_list(storage_path: str) -> str:
+    file_bytes = supabase.storage.from_(WINE_LIST_BUCKET).download(storage_path)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
+        tmp.write(file_bytes)
+        return tmp.name
+
+def run_parse_job(job: ParseJob, worker_id: str) -> None:
+    """Run one claimed job, renewing its lease in the background until it finishes.
+    Stage and page/entry counts are published as progress events for live viewers.
+    If the lease is lost, the pipeline stops at its next stage, page, entry or batch and
+    commits nothing more; every entries/status commit also re-checks ownership of the job."""
+    job_id = job.id
+    stop = threading.Event()
+    lease_lost = threading.Event()
+    progress = ProgressReporter(job_id, job.wine_list_file_id, worker_id)
+
+    def heartbeat() -> None:
+        while not stop.wait(JOB_HEARTBEAT_INTERVAL):
+            try:
+                if not renew_lease(job_id, worker_id):
+                    logger.warning(f"Lost the lease on parse job {job_id}; abandoning it to the worker that reclaims it")
+                    lease_lost.set()
+                    return
+            except Exception as e:
+                logger.error(f"Error renewing lease on parse job {job_id}: {str(e)}")
+
+    threading.Thread(target=heartbeat, daemon=True, name=f"lease-{job_id}").start()
+    try:
+        # A re-parse replaces the list's entries, and an earlier attempt may have saved some before dying
+        db = SessionLocal()
+        try:
+            db.query(WineEntry).filter(WineEntry.wine_list_file_id == job.wine_list_file_id).delete(synchronize_session=False)
+            if not holds_lease(db, job_id, worker_id):
+                raise ParseCancelled(f"Parse job {job_id} was reclaimed before it started")
+            db.commit()
+        finally:
+            db.close()
+        pdf_path = _download_wine_list(job.storage_path)
+        process_wine_list_file(
+            str(job.wine_list_file_id), str(job.restaurant_id), job.storage_path, pdf_path,
+            on_stage=progress.stage, on_progress=progress.progress,
+            cancelled=lease_lost.is_set, holds_lease=lambda session: holds_lease(session, job_id, worker_id)
+        )
+        finish_job(job_id, worker_id)
+        progress.finish()
+        logger.info(f"Parse job {job_id} done")
+    except ParseCancelled as e:
+        # The job (and its progress) now belongs to another worker, or to fail_exhausted_jobs
+        logger.warning(f"Parse job {job_id} abandoned: {str(e)}")
+    except Exception as e:
+        logger.error(f"Parse job {job_id} failed: {str(e)}")
+        finish_job(job_id, worker_id, str(e))
+        progress.finish(str(e))
+    finally:
+        stop.set()
+
+def run_worker(worker_id: Optional[str] = None, once: bool = False) -> None:
+    """Poll for parse jobs and run them one at a time. With once=True, return when the queue is empty."""
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+    logger.info(f"Parse worker {worker_id} started")
+    while True:
+        db = SessionLocal()
+        try:
+            fail_exhausted_jobs(db)
+            job = claim_parse_job(db, worker_id)
+            if job is not None:
+                db.expunge(job)
+        except Exception as e:
+            logger.error(f"Error claiming parse job: {str(e)}")
+            db.rollback()
+            job = None
+        finally:
+            db.close()
+        if job is not None:
+            run_parse_job(job, worker_id)
+        elif once:
+            return
+        else:
+            time.sleep(JOB_POLL_INTERVAL)
+
+def _worker_process_main() -> None:
+    # Forked workers must not reuse the parent's pooled DB connections
+    engine.dispose(close=False)
+    run_worker()
+
+def start_worker_processes(count: int) -> List[multiprocessing.Process]:
+    """Start parse workers as child processes (used by the API when JOB_WORKERS > 0).
+    They aren't daemonic, since a parse may itself start a process (LWIN reloads); stop them with terminate()."""
+    processes = []
+    for _ in range(count):
+        process = multiprocessing.Process(target=_worker_process_main, name="parse-worker")
+        process.start()
+        processes.append(process)
+    return processes
+
+def get_job(db: Session, job_id: str) -> Optional[Dict[str, Any]]:
+    job = db.query(ParseJob).get(job_id)
+    return job_to_dict(job) if job else None
+
+def list_jobs(db: Session, limit: int = 50) -> List[Dict[str, Any]]:
+    return [job_to_dict(job) for job in db.query(ParseJob).order_by(ParseJob.date_created.desc()).limit(limit)]
+
+def get_job_stats(db: Session) -> Dict[str, Any]:
+    """Queue depth per lane (queued, running, caps, oldest wait) and queued jobs per restaurant."""
+    now = datetime.utcnow()
+    counts = db.query(ParseJob.lane, ParseJob.status, func.count(ParseJob.id)).group_by(ParseJob.lane, ParseJob.status).all()
+    oldest = dict(db.query(ParseJob.lane, func.min(ParseJob.date_created)).filter(
+        ParseJob.status == ParseJobStatus.queued
+    ).group_by(ParseJob.lane).all())
+    lanes = {lane: {
+        'max_running': JOB_LANE_MAX_RUNNING.get(lane) or None,
+        'max_pending': lane_max_pending(lane),
+        'counts': {},
+        'oldest_queued_seconds': (now - oldest[lane]).total_seconds() if oldest.get(lane) else 0
+    } for lane in JOB_LANES}
+    for lane, status, count in counts:
+        lanes.setdefault(lane, {'counts': {}})['counts'][status.value if hasattr(status, 'value') else status] = count
+    per_restaurant = db.query(ParseJob.restaurant_id, ParseJob.lane, func.count(ParseJob.id)).filter(
+        ParseJob.status == ParseJobStatus.queued
+    ).group_by(ParseJob.restaurant_id, ParseJob.lane).all()
+    return {
+        'lanes': lanes,
+        'queued_by_restaurant': [
+            {'restaurant_id': str(restaurant_id), 'lane': lane, 'queued': count} for restaurant_id, lane, count in per_restaurant
+        ]
+    }
@@ -1,11 +1,22 @@
 import os
 import pandas as pd
 from typing import Dict, Any, Optional, List, Tuple
-from functools import lru_cache
 from rapidfuzz import fuzz, process
 import numpy as np
-from concurrent.futures import ThreadPoolExecutor
-from app.config import LWIN_XLSX_PATH, BATCH_SIZE
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timedelta
+from app.config import (
+    LWIN_XLSX_PATH, LWIN_RELOAD_CHECK_INTERVAL, LWIN_ALIAS_REFRESH_INTERVAL, LWIN_ALIAS_REFRESH_OVERLAP, LWIN_SUGGESTIONS_SLO_MS,
+    BATCH_SIZE
+)
+from app.database import SessionLocal
+from app.models import LwinAlias
+from app.lwin_cache import make_match_key, get_cached_matches, store_matches, invalidate_lwin_match_cache
+from collections import deque
+import hashlib
+import heapq
+import threading
+import time
 import re
 
 # Fields to normalize for matching
@@ -25,17 +36,57 @@ LWIN_FIELD_MAPPING = {
     'TYPE': 'type'
 }
 
-# Example alias table (expand as needed)
+# Raw LWIN columns read by the matcher, enrichment and rule generation; everything else is dropped on load
+LWIN_RETAINED_COLUMNS = ['LWIN', 'DISPLAY_NAME', 'SUB_REGION'] + list(LWIN_FIELD_MAPPING.keys())
+
+# Shard dimensions and the normalized LWIN column each one partitions on
+LWIN_SHARD_COLUMNS = {
+    'country': 'country_norm',
+    'region': 'region_norm',
+    'colour': 'colour_norm'
+}
+
+# Entry fields that may carry routing context (section headers often name a country or region)
+LWIN_SHARD_CONTEXT_FIELDS = ['country', 'region', 'subregion', 'type', 'section_header', 'subheader', 'section', 'sub_section']
+
+# Longest multi-word region/country name looked up in context strings
+LWIN_SHARD_MAX_WORDS = 4
+
+# Object columns with at most this ratio of distinct values to rows are stored as categoricals
+LWIN_CATEGORICAL_MAX_RATIO = 0.5
+
+# Global alias table, loaded from lwin_alias rows with no restaurant
 LWIN_ALIAS_TABLE = {
     'producer': {},
     'cuvee': {}
 }
 
+# Per-restaurant alias tables: {restaurant_id: {field: {alias: canonical}}}, consulted before the global table
+RESTAURANT_ALIAS_TABLES: Dict[str, Dict[str, Dict[str, str]]] = {}
+
+_alias_lock = threading.Lock()
+_alias_high_water: Optional[datetime] = None  # Newest last_updated seen, for incremental refreshes
+_alias_last_refresh = 0.0
+_alias_generation = 0  # Bumped on every alias change so derived structures (e.g. the producer gazetteer) can rebuild
+
 # Confidence thresholds
 DIRECT_MATCH_THRESHOLD = 100
 FUZZY_MATCH_THRESHOLD = 85
 PARTIAL_MATCH_THRESHOLD = 70
 
+# Suggestion candidate selection: pool = limit * overfetch composite-key hits, re-ranked per field
+LWIN_SUGGESTION_OVERFETCH = 4
+LWIN_SUGGESTION_CANDIDATE_CUTOFF = 50
+
+# Token blocking index: only rows sharing a token (or a token prefix, for typos) with the query are scored
+LWIN_TOKEN_PREFIX_LENGTH = 4  # Tokens longer than this are also indexed under their first 4 characters
+LWIN_TOKEN_MAX_SHARE = 0.05  # Tokens on more than this share of rows ("chateau", "2015") don't narrow anything
+LWIN_SUGGESTION_SHORTLIST = 2000  # Most rows scored per lookup, picked by how many query tokens they share
+_LWIN_TOKEN_PATTERN = re.compile(r'[^\W_]{2,}')
+
+# Recent suggestion latencies in milliseconds, for the p95 SLO report
+LWIN_SUGGESTION_LATENCIES = deque(maxlen=1000)
+
 # Field weights for LWIN matching
 LWIN_FIELD_WEIGHTS = {
     'producer': 1.0,  # Most important
@@ -46,46 +97,309 @@ LWIN_FIELD_WEIGHTS = {
     'grape_variety': 0.6  # Optional
 }
 
-@lru_cache(maxsize=1)
+def compute_lwin_version(path: str = LWIN_XLSX_PATH) -> str:
+    """Return a content hash identifying the LWIN export snapshot."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+def _index_tokens(text: str) -> set:
+    """Tokens a composite key or query is indexed and looked up under: each word, plus a
+    prefix key for long words so a misspelt ending still shares a posting."""
+    tokens = set(_LWIN_TOKEN_PATTERN.findall(text))
+    tokens.update('~' + token[:LWIN_TOKEN_PREFIX_LENGTH] for token in list(tokens) if len(token) > LWIN_TOKEN_PREFIX_LENGTH)
+    return tokens
+
+class LwinTokenIndex:
+    """Inverted index from composite-key tokens to the row positions containing them."""
+    def __init__(self, keys: List[str]):
+        postings: Dict[str, List[int]] = {}
+        for position, key in enumerate(keys):
+            for token in _index_tokens(key):
+                postings.setdefault(token, []).append(position)
+        self.rows = len(keys)
+        self.postings = {token: np.asarray(rows, dtype=np.int32) for token, rows in postings.items()}
+
+    def shortlist(self, query: str, limit: int, within: Optional[np.ndarray] = None) -> np.ndarray:
+        """Row positions sharing the most tokens with the query (at most limit), optionally
+        restricted to within. Over-common tokens are only used if nothing rarer matches."""
+        lists = sorted((self.postings[t] for t in _index_tokens(query) if t in self.postings), key=len)
+        if not lists:
+            return np.empty(0, dtype=np.int32)
+        max_rows = max(int(self.rows * LWIN_TOKEN_MAX_SHARE), limit)
+        lists = [rows for rows in lists if len(rows) <= max_rows] or lists[:1]
+        rows, hits = np.unique(np.concatenate(lists), return_counts=True)
+        if within is not None:
+            keep = np.isin(rows, within, assume_unique=True)
+            rows, hits = rows[keep], hits[keep]
+        if len(rows) > limit:
+            rows = rows[np.argpartition(hits, -limit)[-limit:]]
+        return rows
+
+class LwinSnapshot:
+    """A loaded, fully indexed version of the LWIN database.
+
+    Snapshots are never mutated once built; a reload builds a new one and swaps
+    the module-level reference, so matches already holding the old snapshot
+    finish against the version they started with.
+    """
+    def __init__(self, db: pd.DataFrame, version: str, signature: Optional[Tuple[float, int]] = None):
+        self.db = db
+        self.version = version
+        self.signature = signature  # (mtime, size) of the export this snapshot was built from
+        self.choices = db['composite_key'].tolist() if 'composite_key' in db.columns else []
+        self.choice_array = np.asarray(self.choices, dtype=object)  # Fancy-indexed per lookup, no list copies
+        self.token_index = LwinTokenIndex(self.choices)
+        self.loaded_at = datetime.utcnow()
+        self.memory_bytes = int(db.memory_usage(deep=True).sum()) if not db.empty else 0
+        self.raw_memory_bytes = self.memory_bytes  # Footprint before compaction, set by build_lwin_snapshot
+        # Row positions per country, region and colour, used to route queries to a subset of LWIN
+        self.shards = {}
+        for dim, col in LWIN_SHARD_COLUMNS.items():
+            if col in db.columns:
+                self.shards[dim] = {key: rows for key, rows in db.groupby(col, observed=True).indices.items() if key}
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            'version': self.version,
+            'rows': len(self.db),
+            'loaded_at': self.loaded_at.isoformat(),
+            'memory_bytes': self.memory_bytes,
+            'raw_memory_bytes': self.raw_memory_bytes,
+            'shards': {dim: len(index) for dim, index in self.shards.items()}
+        }
+
+_lwin_snapshot: Optional[LwinSnapshot] = None
+_lwin_snapshot_lock = threading.Lock()  # Guards the first (blocking) load
+_lwin_reload_lock = threading.Lock()  # Only one background rebuild at a time
+_lwin_last_check = 0.0
+LWIN_RELOAD_STATE = {
+    'status': 'idle',
+    'started_at': None,
+    'finished_at': None,
+    'error': None
+}
+
+def _lwin_file_signature(path: str = LWIN_XLSX_PATH) -> Optional[Tuple[float, int]]:
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime, stat.st_size
+    except OSError:
+        return None
+
+def build_composite_key(lwin_db: pd.DataFrame) -> pd.Series:
+    """The composite key for faster lookups (same field order as the fuzzy query string), from the *_norm columns."""
+    missing = [field + '_norm' for field in LWIN_KEY_FIELDS if field + '_norm' not in lwin_db.columns]
+    if missing:
+        raise ValueError(f"LWIN frame has no composite_key and is missing {', '.join(missing)}")
+    composite_key = lwin_db[LWIN_KEY_FIELDS[0] + '_norm'].astype(str)
+    for field in LWIN_KEY_FIELDS[1:]:
+        composite_key = composite_key + ' ' + lwin_db[field + '_norm'].astype(str)
+    return composite_key
+
+def compact_lwin_frame(lwin_db: pd.DataFrame) -> pd.DataFrame:
+    """Drop columns the matcher never reads and dictionary-encode low-cardinality string columns."""
+    keep = [col for col in lwin_db.columns
+            if col in LWIN_RETAINED_COLUMNS or col.endswith('_norm') or col == 'composite_key']
+    compact = lwin_db[keep].copy()
+    row_count = max(len(compact), 1)
+    for col in compact.columns:
+        if compact[col].dtype == 'object' and compact[col].nunique() / row_count <= LWIN_CATEGORICAL_MAX_RATIO:
+            # Categoricals keep one string per distinct value plus small integer codes per row;
+            # equality filters in the matcher compare codes instead of strings
+            compact[col] = compact[col].astype('category')
+    compact.attrs = dict(lwin_db.attrs)
+    return compact
+
+def build_lwin_snapshot(path: str = LWIN_XLSX_PATH) -> LwinSnapshot:
+    """Load and normalize the LWIN database and build its match indexes."""
+    signature = _lwin_file_signature(path)
+    # Load the LWIN database
+    lwin_db = pd.read_excel(path)
+    lwin_db = lwin_db.copy()
+    lwin_db.columns = [col.strip().upper() for col in lwin_db.columns]
+    # Precompute normalized columns for fast matching
+    for field in LWIN_KEY_FIELDS:
+        col = None
+        for k, v in LWIN_FIELD_MAPPING.items():
+            if v == field:
+                col = k
+                break
+        if col and col in lwin_db.columns:
+            lwin_db[field + '_norm'] = lwin_db[col].fillna('').astype(str).str.lower().str.strip()
+        else:
+            lwin_db[field + '_norm'] = ''
+    lwin_db['colour_norm'] = (lwin_db['COLOUR'].fillna('').astype(str).str.lower().str.strip()
+                              if 'COLOUR' in lwin_db.columns else '')
+    lwin_db['composite_key'] = build_composite_key(lwin_db)
+    for col in lwin_db.columns:
+        if lwin_db[col].dtype == 'object':
+            lwin_db[col] = lwin_db[col].fillna('').astype(str).str.strip()
+    raw_memory_bytes = int(lwin_db.memory_usage(deep=True).sum())
+    lwin_db = compact_lwin_frame(lwin_db)
+    # Tag the frame with its snapshot version so cached matches can be keyed by it
+    lwin_version = compute_lwin_version(path)
+    lwin_db.attrs['lwin_version'] = lwin_version
+    snapshot = LwinSnapshot(lwin_db, lwin_version, signature)
+    snapshot.raw_memory_bytes = raw_memory_bytes
+    print(f"LWIN snapshot {lwin_version}: {snapshot.memory_bytes / 1e6:.1f} MB resident "
+          f"(was {raw_memory_bytes / 1e6:.1f} MB before compaction)")
+    return snapshot
+
+def _swap_lwin_snapshot(snapshot: LwinSnapshot) -> None:
+    global _lwin_snapshot
+    previous = _lwin_snapshot
+    # A single reference assignment: readers see either the old or the new snapshot, never a mix
+    _lwin_snapshot = snapshot
+    if previous is None or previous.version != snapshot.version:
+        invalidate_lwin_match_cache(snapshot.version)
+    print(f"LWIN snapshot {snapshot.version} active ({len(snapshot.db)} rows)")
+
+def _rebuild_lwin_snapshot() -> None:
+    try:
+        LWIN_RELOAD_STATE.update({'status': 'running', 'started_at': datetime.utcnow().isoformat(), 'finished_at': None, 'error': None})
+        # Build in a separate process so request and parse threads keep the GIL during the refresh
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            snapshot = pool.submit(build_lwin_snapshot, LWIN_XLSX_PATH).result()
+        _swap_lwin_snapshot(snapshot)
+        LWIN_RELOAD_STATE.update({'status': 'idle', 'finished_at': datetime.utcnow().isoformat()})
+    except Exception as e:
+        print(f"Error reloading LWIN database: {str(e)}")
+        LWIN_RELOAD_STATE.update({'status': 'error', 'finished_at': datetime.utcnow().isoformat(), 'error': str(e)})
+    finally:
+        _lwin_reload_lock.release()
+
+def reload_lwin_db(background: bool = True) -> bool:
+    """Rebuild the LWIN snapshot from the export and swap it in atomically.
+    Returns False if a reload is already in progress."""
+    if not _lwin_reload_lock.acquire(blocking=False):
+        return False
+    if background:
+        threading.Thread(target=_rebuild_lwin_snapshot, daemon=True).start()
+    else:
+        _rebuild_lwin_snapshot()
+    return True
+
+def _check_for_new_lwin_export(snapshot: LwinSnapshot) -> None:
+    """Start a background reload if the export on disk changed (lets every worker pick up a refresh)."""
+    global _lwin_last_check
+    now = time.monotonic()
+    if now - _lwin_last_check < LWIN_RELOAD_CHECK_INTERVAL:
+        return
+    _lwin_last_check = now
+    signature = _lwin_file_signature()
+    if signature and snapshot.signature and signature != snapshot.signature:
+        reload_lwin_db(background=True)
+
+def get_lwin_snapshot() -> LwinSnapshot:
+    """Return the active LWIN snapshot, loading it on first use."""
+    global _lwin_snapshot
+    snapshot = _lwin_snapshot
+    if snapshot is None:
+        with _lwin_snapshot_lock:
+            if _lwin_snapshot is None:
+                try:
+                    _swap_lwin_snapshot(build_lwin_snapshot())
+                except Exception as e:
+                    print(f"Error loading LWIN database: {str(e)}")
+                    # Empty snapshot on error; the signature check retries once the export is fixed
+                    _lwin_snapshot = LwinSnapshot(pd.DataFrame(), '', (0.0, 0))
+            snapshot = _lwin_snapshot
+    else:
+        _check_for_new_lwin_export(snapshot)
+    return snapshot
+
 def get_lwin_db() -> pd.DataFrame:
-    """Load and normalize the LWIN database."""
+    """Return the normalized LWIN database of the active snapshot."""
+    return get_lwin_snapshot().db
+
+def get_lwin_status() -> Dict[str, Any]:
+    """Describe the active LWIN snapshot and any reload in progress."""
+    status = get_lwin_snapshot().describe()
+    status['reload'] = dict(LWIN_RELOAD_STATE)
+    return status
+
+def _apply_alias_row(row: LwinAlias) -> bool:
+    """Apply one alias row (or its tombstone) to the in-memory tables. Returns whether anything changed."""
+    global _alias_generation
+    if row.restaurant_id:
+        table = RESTAURANT_ALIAS_TABLES.setdefault(str(row.restaurant_id), {'producer': {}, 'cuvee': {}})
+    else:
+        table = LWIN_ALIAS_TABLE
+    aliases = table.setdefault(row.field, {})
+    if row.deleted:
+        if row.alias not in aliases:
+            return False
+        del aliases[row.alias]
+    else:
+        if aliases.get(row.alias) == row.canonical:
+            return False
+        aliases[row.alias] = row.canonical
+    _alias_generation += 1
+    return True
+
+def refresh_lwin_aliases(force: bool = False) -> int:
+    """Load alias rows changed since the last refresh into the in-memory tables.
+
+    The watermark is the newest database-assigned last_updated seen, and each refresh
+    re-reads LWIN_ALIAS_REFRESH_OVERLAP seconds behind it: a row whose transaction
+    commits after a refresh read past its timestamp is still picked up. Re-applying a
+    row is a no-op. Throttled to LWIN_ALIAS_REFRESH_INTERVAL unless force is set;
+    returns the number of rows that changed the tables.
+    """
+    global _alias_high_water, _alias_last_refresh
+    now = time.monotonic()
+    if not force and now - _alias_last_refresh < LWIN_ALIAS_REFRESH_INTERVAL:
+        return 0
+    _alias_last_refresh = now
+    db = SessionLocal()
     try:
-        # Load the LWIN database
-        lwin_db = pd.read_excel(LWIN_XLSX_PATH)
-        lwin_db = lwin_db.copy()
-        lwin_db.columns = [col.strip().upper() for col in lwin_db.columns]
-        # Precompute normalized columns for fast matching
-        for field in LWIN_KEY_FIELDS:
-            col = None
-            for k, v in LWIN_FIELD_MAPPING.items():
-                if v == field:
-                    col = k
-                    break
-            if col and col in lwin_db.columns:
-                lwin_db[field + '_norm'] = lwin_db[col].fillna('').astype(str).str.lower().str.strip()
-            else:
-                lwin_db[field + '_norm'] = ''
-        # Create a composite key for faster lookups
-        lwin_db['composite_key'] = lwin_db.apply(
-            lambda row: ' '.join(str(row.get(col, '')).strip().lower() 
-                               for col in LWIN_KEY_FIELDS),
-            axis=1
-        )
-        for col in lwin_db.columns:
-            if lwin_db[col].dtype == 'object':
-                lwin_db[col] = lwin_db[col].fillna('').astype(str).str.strip()
-        return lwin_db
+        query = db.query(LwinAlias)
+        if _alias_high_water is not None:
+            query = query.filter(LwinAlias.last_updated > _alias_high_water - timedelta(seconds=LWIN_ALIAS_REFRESH_OVERLAP))
+        rows = query.order_by(LwinAlias.last_updated).all()
+        changed = 0
+        with _alias_lock:
+            for row in rows:
+                changed += _apply_alias_row(row)
+                if row.last_updated and (_alias_high_water is None or row.last_updated > _alias_high_water):
+                    _alias_high_water = row.last_updated
+        return changed
     except Exception as e:
-        print(f"Error loading LWIN database: {str(e)}")
-        return pd.DataFrame()  # Return empty DataFrame on error
+        print(f"Error refreshing LWIN aliases: {str(e)}")
+        return 0
+    finally:
+        db.close()
+
+def get_producer_aliases(restaurant_id: Optional[str] = None) -> Tuple[int, List[str]]:
+    """Return the alias generation and the global producer aliases, or with restaurant_id only
+    that restaurant's own (one restaurant's corrections never apply to another's lists)."""
+    with _alias_lock:
+        if restaurant_id:
+            table = RESTAURANT_ALIAS_TABLES.get(str(restaurant_id), {})
+        else:
+            table = LWIN_ALIAS_TABLE
+        return _alias_generation, sorted(table.get('producer', {}))
 
-def normalize_wine_dict(wine: Dict[str, Any]) -> Dict[str, str]:
+def load_lwin_aliases() -> int:
+    """Load every persisted alias at startup."""
+    count = refresh_lwin_aliases(force=True)
+    print(f"Loaded {count} LWIN aliases")
+    return count
+
+def normalize_wine_dict(wine: Dict[str, Any], restaurant_id: Optional[str] = None) -> Dict[str, str]:
     """Return a normalized dict of key fields for matching."""
     norm = {f: (str(wine.get(f, '')).lower().strip() if wine.get(f) else '') for f in LWIN_KEY_FIELDS}
     
-    # Apply alias table
+    # Apply alias tables (restaurant-specific first, then global) before any scoring
+    restaurant_id = restaurant_id or wine.get('restaurant_id')
+    restaurant_aliases = RESTAURANT_ALIAS_TABLES.get(str(restaurant_id), {}) if restaurant_id else {}
     for field in ['producer', 'cuvee']:
-        if norm[field] in LWIN_ALIAS_TABLE.get(field, {}):
+        if norm[field] in restaurant_aliases.get(field, {}):
+            norm[field] = restaurant_aliases[field][norm[field]]
+        elif norm[field] in LWIN_ALIAS_TABLE.get(field, {}):
             norm[field] = LWIN_ALIAS_TABLE[field][norm[field]]
     
     # Normalize producer names
@@ -228,59 +542,111 @@ def process_batch(batch: List[Dict[str, Any]], lwin_df: pd.DataFrame) -> List[Di
     
     return results
 
-def match_lwin_batch(wines: List[Dict[str, Any]], batch_size: int = 100) -> List[Dict[str, Any]]:
-    """Match a batch of wine entries against the LWIN database (fast vectorized direct, then fuzzy)."""
+def _lookup_shard_key(text: str, index: Dict[str, np.ndarray]) -> Optional[str]:
+    """Find the longest run of words in text that names a shard (e.g. 'red burgundy' -> 'burgundy')."""
+    if text in index:
+        return text
+    words = re.findall(r"[\w'-]+", text)
+    for n in range(min(LWIN_SHARD_MAX_WORDS, len(words)), 0, -1):
+        for i in range(len(words) - n + 1):
+            candidate = ' '.join(words[i:i + n])
+            if candidate in index:
+                return candidate
+    return None
+
+def route_lwin_shards(wine: Dict[str, Any], snapshot: LwinSnapshot) -> Tuple[Optional[np.ndarray], str]:
+    """Pick the LWIN rows relevant to a wine from its country/region/colour and section context.
+    Returns (row positions or None for a global search, route description)."""
+    context = [str(wine[f]).lower().strip() for f in LWIN_SHARD_CONTEXT_FIELDS if wine.get(f)]
+    if not context or not snapshot.shards:
+        return None, ''
+    rows = None
+    route = []
+    for dim, index in snapshot.shards.items():
+        key = next((k for k in (_lookup_shard_key(text, index) for text in context) if k), None)
+        if not key:
+            continue
+        # Narrow by each dimension found, skipping any that would leave no candidates
+        narrowed = index[key] if rows is None else np.intersect1d(rows, index[key], assume_unique=True)
+        if len(narrowed):
+            rows = narrowed
+            route.append(f"{dim}={key}")
+    return rows, ';'.join(route)
+
+def _find_lwin_match(wine_norm: Dict[str, str], lwin_db: pd.DataFrame, choices: List[str], shard_rows: Optional[np.ndarray] = None) -> Tuple[Optional[int], float, str]:
+    """Find the best LWIN row for a normalized wine (vectorized direct, then fuzzy within shard, then global fuzzy).
+    Returns (row position or None, score, provenance)."""
+    # 1. Try vectorized direct match on all normalized fields
+    if any(wine_norm[field] for field in LWIN_KEY_FIELDS):
+        mask = np.ones(len(lwin_db), dtype=bool)
+        for field in LWIN_KEY_FIELDS:
+            val = wine_norm[field]
+            if val:
+                mask &= (lwin_db[field + '_norm'] == val).to_numpy()
+        direct_rows = np.flatnonzero(mask)
+        if len(direct_rows):
+            return int(direct_rows[0]), 100, 'direct'
+    # 2. Fuzzy match only if no direct match
+    # Use composite key for RapidFuzz process extraction
+    query = ' '.join([wine_norm[f] for f in LWIN_KEY_FIELDS])
+    if shard_rows is not None and len(shard_rows):
+        best = process.extractOne(query, [choices[i] for i in shard_rows], scorer=fuzz.token_sort_ratio,
+                                  score_cutoff=PARTIAL_MATCH_THRESHOLD)
+        if best:
+            return int(shard_rows[best[2]]), best[1], 'fuzzy'
+    # 3. Global search only when the shard had nothing above threshold
+    best = process.extractOne(query, choices, scorer=fuzz.token_sort_ratio, score_cutoff=PARTIAL_MATCH_THRESHOLD)
+    if best:
+        return int(best[2]), best[1], 'fuzzy'
+    return None, 0.0, 'no_match'
+
+def _apply_lwin_match(wine: Dict[str, Any], wine_norm: Dict[str, str], match: Dict[str, Any], score: float, provenance: str, lwin_version: str) -> None:
+    """Merge an LWIN row into the wine entry and update field confidence for matched fields."""
+    match['lwin_match_score'] = score
+    match['lwin_match_provenance'] = provenance
+    match['lwin_version'] = lwin_version
+    wine.update(match)
+    if 'field_confidence' not in wine:
+        wine['field_confidence'] = {}
+    confidence = 0.95 if provenance == 'direct' else min(0.95, score / 100)
+    for field in LWIN_KEY_FIELDS:
+        if field in wine_norm and wine_norm[field]:
+            wine['field_confidence'][field] = confidence
+
+def match_lwin_batch(wines: List[Dict[str, Any]], batch_size: int = 100, restaurant_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Match a batch of wine entries against the LWIN database (shared match cache, then vectorized direct, then sharded fuzzy)."""
     try:
-        lwin_db = get_lwin_db()
+        # Hold one snapshot for the whole batch so a concurrent reload can't mix versions
+        snapshot = get_lwin_snapshot()
+        lwin_db = snapshot.db
         if lwin_db.empty:
             return wines
+        lwin_version = snapshot.version
+        refresh_lwin_aliases()
         results = []
         for i in range(0, len(wines), batch_size):
             batch = wines[i:i + batch_size]
-            # 1. Try vectorized direct match on all normalized fields
-            for wine in batch:
-                wine_norm = normalize_wine_dict(wine)
-                mask = np.ones(len(lwin_db), dtype=bool)
-                for field in LWIN_KEY_FIELDS:
-                    val = wine_norm[field]
-                    if val:
-                        mask &= (lwin_db[field + '_norm'] == val)
-                direct_matches = lwin_db[mask]
-                if not direct_matches.empty:
-                    match = direct_matches.iloc[0].to_dict()
-                    match['lwin_match_score'] = 100
-                    match['lwin_match_provenance'] = 'direct'
-                    wine.update(match)
-                    wine['lwin_match_score'] = 100
-                    # Update field confidence for matched fields
-                    if 'field_confidence' not in wine:
-                        wine['field_confidence'] = {}
-                    for field in LWIN_KEY_FIELDS:
-                        if field in wine_norm and wine_norm[field]:
-                            wine['field_confidence'][field] = 0.95
-                    results.append(wine)
-                    continue
-                # 2. Fuzzy match only if no direct match
-                # Use composite key for RapidFuzz process extraction
-                choices = lwin_db['composite_key'].tolist()
-                query = ' '.join([wine_norm[f] for f in LWIN_KEY_FIELDS])
-                best = process.extractOne(query, choices, scorer=fuzz.token_sort_ratio)
-                if best and best[1] >= PARTIAL_MATCH_THRESHOLD:
-                    idx = best[2]
-                    match = lwin_db.iloc[idx].to_dict()
-                    match['lwin_match_score'] = best[1]
-                    match['lwin_match_provenance'] = 'fuzzy'
-                    wine.update(match)
-                    wine['lwin_match_score'] = best[1]
-                    # Update field confidence for matched fields based on match score
-                    if 'field_confidence' not in wine:
-                        wine['field_confidence'] = {}
-                    for field in LWIN_KEY_FIELDS:
-                        if field in wine_norm and wine_norm[field]:
-                            wine['field_confidence'][field] = min(0.95, best[1] / 100)
-                    results.append(wine)
-                else:
-                    results.append(wine)
+            norms = [normalize_wine_dict(wine, restaurant_id) for wine in batch]
+            routes = [route_lwin_shards(wine, snapshot) for wine in batch]
+            # The shard route is part of the key: the same wine under a different section may resolve differently
+            keys = [make_match_key({**wine_norm, 'shard': route}) for wine_norm, (_, route) in zip(norms, routes)]
+            cached = get_cached_matches(keys, lwin_version)
+            computed = {}
+            for wine, wine_norm, (shard_rows, _), key in zip(batch, norms, routes, keys):
+                match = cached.get(key) or computed.get(key)
+                if match is None:
+                    row, score, provenance = _find_lwin_match(wine_norm, lwin_db, snapshot.choices, shard_rows)
+                    match = {
+                        'lwin_row': row,
+                        'lwin': str(lwin_db.iloc[row].get('LWIN', '')) if row is not None else None,
+                        'score': score,
+                        'provenance': provenance
+                    }
+                    computed[key] = match
+                if match['lwin_row'] is not None and match['lwin_row'] < len(lwin_db):
+                    _apply_lwin_match(wine, wine_norm, lwin_db.iloc[match['lwin_row']].to_dict(), match['score'], match['provenance'], lwin_version)
+                results.append(wine)
+            store_matches(computed, lwin_version)
         return results
     except Exception as e:
         print(f"Error in batch LWIN matching: {str(e)}")
@@ -326,31 +692,134 @@ def match_lwin(wine: Dict[str, Any]) -> Tuple[Dict[str, Any], float]:
         print(f"Error in LWIN matching: {str(e)}")
         return wine, 0.0
 
-def get_lwin_suggestions(wine: Dict[str, Any], lwin_df: Optional[pd.DataFrame] = None, limit: int = 5) -> List[Dict[str, Any]]:
-    """Get a list of potential LWIN matches for a wine entry."""
+def _suggestion_payload(row: pd.Series, score: float, provenance: str) -> Dict[str, Any]:
+    """Trim an LWIN row to the raw columns a candidate picker shows (no *_norm helpers, no NaN)."""
+    match = {col: row[col] for col in LWIN_RETAINED_COLUMNS if col in row.index}
+    for col, value in match.items():
+        if isinstance(value, float) and np.isnan(value):
+            match[col] = None
+        elif isinstance(value, np.generic):
+            match[col] = value.item()
+    match['lwin_match_score'] = score
+    match['lwin_match_provenance'] = provenance
+    return match
+
+def _record_suggestion_latency(elapsed_ms: float) -> None:
+    LWIN_SUGGESTION_LATENCIES.append(elapsed_ms)
+    if elapsed_ms > LWIN_SUGGESTIONS_SLO_MS:
+        print(f"LWIN suggestions took {elapsed_ms:.1f} ms (SLO {LWIN_SUGGESTIONS_SLO_MS} ms)")
+
+def get_lwin_suggestion_latency() -> Dict[str, Any]:
+    """Return latency percentiles for recent suggestion lookups against the SLO."""
+    latencies = sorted(LWIN_SUGGESTION_LATENCIES)
+    if not latencies:
+        return {'count': 0, 'slo_ms': LWIN_SUGGESTIONS_SLO_MS}
+    p50 = latencies[int(0.50 * (len(latencies) - 1))]
+    p95 = latencies[int(0.95 * (len(latencies) - 1))]
+    return {
+        'count': len(latencies),
+        'p50_ms': round(p50, 2),
+        'p95_ms': round(p95, 2),
+        'max_ms': round(latencies[-1], 2),
+        'slo_ms': LWIN_SUGGESTIONS_SLO_MS,
+        'slo_met': p95 <= LWIN_SUGGESTIONS_SLO_MS
+    }
+
+def _top_k_candidates(query: str, snapshot: LwinSnapshot, rows: Optional[np.ndarray], k: int) -> List[int]:
+    """Shortlist rows sharing tokens with the query from the token index (optionally within a shard),
+    then score only those with a multi-threaded cdist and take the k best with an O(n) argpartition."""
+    shortlist = snapshot.token_index.shortlist(query, LWIN_SUGGESTION_SHORTLIST, rows)
+    if not len(shortlist):
+        return []
+    scores = process.cdist([query], snapshot.choice_array[shortlist], scorer=fuzz.token_sort_ratio, dtype=np.uint8,
+                           score_cutoff=LWIN_SUGGESTION_CANDIDATE_CUTOFF, workers=-1)[0]
+    hits = np.flatnonzero(scores)
+    if len(hits) > k:
+        hits = hits[np.argpartition(scores[hits], -k)[-k:]]
+    return [int(p) for p in shortlist[hits]]
+
+def get_lwin_suggestions(wine: Dict[str, Any], lwin_df: Optional[pd.DataFrame] = None, limit: int = 5, restaurant_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Get a ranked list of potential LWIN matches for a wine entry.
+
+    Candidates come from the token index over composite keys (the routed shard first,
+    topped up from the whole snapshot), and only those are re-scored field by field.
+    An explicit lwin_df is indexed on the fly; its composite_key is built from the
+    *_norm columns if it has none.
+    """
+    started = time.perf_counter()
     if lwin_df is None:
-        lwin_df = get_lwin_db()
+        snapshot = get_lwin_snapshot()
+    else:
+        if 'composite_key' not in lwin_df.columns:
+            lwin_df = lwin_df.assign(composite_key=build_composite_key(lwin_df))
+        snapshot = LwinSnapshot(lwin_df, lwin_df.attrs.get('lwin_version', 'adhoc'))
+    lwin_df = snapshot.db
+    shard_rows, _ = route_lwin_shards(wine, snapshot)
+    if lwin_df.empty:
+        return []
     
-    wine_norm = normalize_wine_dict(wine)
-    suggestions = []
+    wine_norm = normalize_wine_dict(wine, restaurant_id)
+    query = ' '.join([wine_norm[f] for f in LWIN_KEY_FIELDS])
+    pool_size = limit * LWIN_SUGGESTION_OVERFETCH
     
-    for _, row in lwin_df.iterrows():
+    candidates = _top_k_candidates(query, snapshot, shard_rows, pool_size) if shard_rows is not None else []
+    if len(candidates) < pool_size:
+        # Not enough in the shard: top up from the whole snapshot
+        seen = set(candidates)
+        candidates += [p for p in _top_k_candidates(query, snapshot, None, pool_size) if p not in seen]
+    
+    # Re-rank the bounded candidate pool with the weighted per-field score
+    scored = []
+    for position in candidates:
+        row = lwin_df.iloc[position]
         score, provenance = calculate_match_score(wine_norm, row)
         if score >= PARTIAL_MATCH_THRESHOLD:
-            match = row.to_dict()
-            match['lwin_match_score'] = score
-            match['lwin_match_provenance'] = provenance
-            suggestions.append(match)
-    
-    # Sort by score and limit results
-    suggestions.sort(key=lambda x: x['lwin_match_score'], reverse=True)
-    return suggestions[:limit]
+            scored.append((score, position, provenance))
+    suggestions = [_suggestion_payload(lwin_df.iloc[position], score, provenance)
+                   for score, position, provenance in heapq.nlargest(limit, scored)]
+    _record_suggestion_latency((time.perf_counter() - started) * 1000)
+    return suggestions
 
-def update_lwin_alias_table(correction: Dict[str, str]) -> None:
-    """Update the LWIN alias table with a user correction."""
-    for field in ['producer', 'cuvee']:
-        if field in correction and field in LWIN_ALIAS_TABLE:
-            original = correction[field].lower().strip()
-            corrected = correction.get(f'corrected_{field}', '').lower().strip()
-            if original and corrected:
-                LWIN_ALIAS_TABLE[field][original] = corrected 
\ No newline at end of file
+def update_lwin_alias_table(correction: Dict[str, str], restaurant_id: Optional[str] = None) -> None:
+    """Update the LWIN alias table with a user correction and persist it (per restaurant, or global if no restaurant)."""
+    db = SessionLocal()
+    try:
+        for field in ['producer', 'cuvee']:
+            if field in correction and field in LWIN_ALIAS_TABLE:
+                original = (correction[field] or '').lower().strip()
+                corrected = (correction.get(f'corrected_{field}') or '').lower().strip()
+                if not original or not corrected or original == corrected:
+                    continue
+                row = db.query(LwinAlias).filter_by(restaurant_id=restaurant_id, field=field, alias=original).first()
+                if row:
+                    row.canonical = corrected
+                    row.deleted = False
+                else:
+                    row = LwinAlias(restaurant_id=restaurant_id, field=field, alias=original, canonical=corrected)
+                    db.add(row)
+                db.commit()
+                with _alias_lock:
+                    _apply_alias_row(row)
+    except Exception as e:
+        print(f"Error persisting LWIN alias: {str(e)}")
+        db.rollback()
+    finally:
+        db.close()
+
+def delete_lwin_alias(field: str, alias: str, restaurant_id: Optional[str] = None) -> bool:
+    """Remove an alias (per restaurant, or global if no restaurant). The row is kept as a tombstone
+    so other workers drop it on their next refresh. Returns False if there was no such alias."""
+    db = SessionLocal()
+    try:
+        row = db.query(LwinAlias).filter_by(
+            restaurant_id=restaurant_id, field=field, alias=alias.lower().strip(), deleted=False
+        ).first()
+        if not row:
+            return False
+        row.deleted = True
+        db.commit()
+        with _alias_lock:
+            _apply_alias_row(row)
+        return True
+    finally:
+        db.close() 
\ No newline at end of file
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Any, List
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.database import SessionLocal
+from app.models import LwinMatchCache
+from app.config import LWIN_MATCH_CACHE_ENABLED
+
+logger = logging.getLogger(__name__)
+
+# Process-local hit/miss counters (the hit_count column holds the shared totals)
+_stats_lock = threading.Lock()
+LWIN_CACHE_STATS = {
+    'hits': 0,
+    'misses': 0,
+    'stored': 0,
+    'invalidated': 0
+}
+
+def make_match_key(wine_norm: Dict[str, str]) -> str:
+    """Build a stable cache key from the output of normalize_wine_dict."""
+    payload = json.dumps(wine_norm, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _record(stat: str, amount: int) -> None:
+    with _stats_lock:
+        LWIN_CACHE_STATS[stat] += amount
+
+def get_cached_matches(keys: List[str], lwin_version: str) -> Dict[str, Dict[str, Any]]:
+    """Look up cached LWIN matches (including negative results) for a list of match keys."""
+    if not LWIN_MATCH_CACHE_ENABLED or not keys or not lwin_version:
+        return {}
+    db = SessionLocal()
+    try:
+        rows = db.query(LwinMatchCache).filter(
+            LwinMatchCache.lwin_version == lwin_version,
+            LwinMatchCache.match_key.in_(set(keys))
+        ).all()
+        found = {
+            row.match_key: {
+                'lwin_row': row.lwin_row,
+                'lwin': row.lwin,
+                'score': row.score,
+                'provenance': row.provenance
+            } for row in rows
+        }
+        if rows:
+            db.query(LwinMatchCache).filter(LwinMatchCache.id.in_([row.id for row in rows])).update(
+                {LwinMatchCache.hit_count: LwinMatchCache.hit_count + 1, LwinMatchCache.last_hit: datetime.utcnow()},
+                synchronize_session=False
+            )
+            db.commit()
+    except Exception as e:
+        logger.error(f"Error reading LWIN match cache: {str(e)}")
+        db.rollback()
+        found = {}
+    finally:
+        db.close()
+    hits = sum(1 for key in keys if key in found)
+    _record('hits', hits)
+    _record('misses', len(keys) - hits)
+    return found
+
+def store_matches(matches: Dict[str, Dict[str, Any]], lwin_version: str) -> None:
+    """Persist freshly computed LWIN matches, keyed by match key and LWIN version."""
+    if not LWIN_MATCH_CACHE_ENABLED or not matches or not lwin_version:
+        return
+    rows = [{
+        'match_key': key,
+        'lwin_version': lwin_version,
+        'lwin_row': match.get('lwin_row'),
+        'lwin': match.get('lwin'),
+        'score': match.get('score'),
+        'provenance': match.get('provenance', 'no_match'),
+        'hit_count': 0,
+        'date_created': datetime.utcnow()
+    } for key, match in matches.items()]
+    db = SessionLocal()
+    try:
+        # Another worker may have cached the same wine concurrently; keep whichever landed first
+        stmt = pg_insert(LwinMatchCache.__table__).values(rows).on_conflict_do_nothing(
+            index_elements=['match_key', 'lwin_version']
+        )
+        db.execute(stmt)
+        db.commit()
+        _record('stored', len(rows))
+    except Exception as e:
+        logger.error(f"Error writing LWIN match cache: {str(e)}")
+        db.rollback()
+    finally:
+        db.close()
+
+def invalidate_lwin_match_cache(current_version: str = None) -> int:
+    """Delete cached matches computed against any LWIN version other than current_version (all if None)."""
+    db = SessionLocal()
+    try:
+        query = db.query(LwinMatchCache)
+        if current_version:
+            query = query.filter(LwinMatchCache.lwin_version != current_version)
+        deleted = query.delete(synchronize_session=False)
+        db.commit()
+        _record('invalidated', deleted)
+        if deleted:
+            logger.info(f"Invalidated {deleted} LWIN match cache entries")
+        return deleted
+    except Exception as e:
+        logger.error(f"Error invalidating LWIN match cache: {str(e)}")
+        db.rollback()
+        return 0
+    finally:
+        db.close()
+
+def get_lwin_cache_stats(lwin_version: str = None) -> Dict[str, Any]:
+    """Return hit/miss counters for this process plus shared cache totals."""
+    with _stats_lock:
+        stats = dict(LWIN_CACHE_STATS)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    stats['lwin_version'] = lwin_version
+    db = SessionLocal()
+    try:
+        query = db.query(func.count(LwinMatchCache.id), func.coalesce(func.sum(LwinMatchCache.hit_count), 0))
+        if lwin_version:
+            query = query.filter(LwinMatchCache.lwin_version == lwin_version)
+        entries, total_hits = query.one()
+        stats['entries'] = entries
+        stats['total_hits'] = int(total_hits)
+    except Exception as e:
+        logger.error(f"Error reading LWIN match cache stats: {str(e)}")
+    finally:
+        db.close()
+    return stats
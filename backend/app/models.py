@@ -1,8 +1,9 @@
 import uuid
 from datetime import datetime
 from sqlalchemy import (
-    Column, String, DateTime, ForeignKey, Boolean, Enum, Float, Text, JSON, UniqueConstraint, DECIMAL
+    Column, String, DateTime, Date, ForeignKey, Boolean, Enum, Float, Text, JSON, UniqueConstraint, DECIMAL, Integer, Index, LargeBinary
 )
+from sqlalchemy import func, text
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import declarative_base, relationship
 import enum
@@ -26,6 +27,12 @@ class WineEntryStatus(enum.Enum):
     confirmed = "confirmed"
     rejected = "rejected"
 
+class ParseJobStatus(enum.Enum):
+    queued = "queued"
+    running = "running"
+    done = "done"
+    error = "error"
+
 class UserRole(enum.Enum):
     admin = "admin"
     restaurant_admin = "restaurant_admin"
@@ -54,6 +61,7 @@ class WineListFile(Base):
     parsed_date = Column(DateTime)
     status = Column(Enum(WineListFileStatus), default=WineListFileStatus.uploaded)
     notes = Column(Text)
+    partial_results = Column(Boolean, default=False)  # Entries are being saved as they're parsed; more will follow
 
     restaurant = relationship("Restaurant", back_populates="wine_list_files")
     wine_entries = relationship("WineEntry", back_populates="wine_list_file", cascade="all, delete-orphan")
@@ -85,9 +93,18 @@ class WineEntry(Base):
     classification = Column(String, nullable=True)  # e.g. AOC, DOCG
     sub_type = Column(String, nullable=True)  # e.g. Brut, Sec, Demi-Sec
     extra_data = Column(JSON, nullable=True)
+    version = Column(Integer, default=1, nullable=False)  # Bumped on every edit, for optimistic concurrency checks
+    page = Column(Integer, nullable=True)  # PDF page the entry starts on
+    position = Column(Integer, nullable=True)  # Order of the entry within its wine list
 
     wine_list_file = relationship("WineListFile", back_populates="wine_entries")
 
+    __table_args__ = (
+        # NULLS FIRST to match the listing order (app.entry_listing); SQLite sorts NULLs first already
+        Index("ix_wine_entry_list_position", "wine_list_file_id", "position", "id", postgresql_ops={"position": "NULLS FIRST"}),
+        Index("ix_wine_entry_review_queue", "wine_list_file_id", "status", "row_confidence", "id"),  # See app.review_queue
+    )
+
 # Ruleset table
 class Ruleset(Base):
     __tablename__ = "ruleset"
@@ -130,6 +147,105 @@ class AuditLog(Base):
     # wine_entry = relationship("WineEntry")
     # wine_list_file = relationship("WineListFile")
 
+# LwinMatchCache table (LWIN match results shared across restaurants and uploads)
+class LwinMatchCache(Base):
+    __tablename__ = "lwin_match_cache"
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    match_key = Column(String, nullable=False)  # Hash of the normalize_wine_dict output
+    lwin_version = Column(String, nullable=False)  # LWIN snapshot the match was computed against
+    lwin = Column(String, nullable=True)  # Null for negative (no_match) results
+    lwin_row = Column(Integer, nullable=True)  # Row position within the LWIN snapshot
+    score = Column(Float, nullable=True)
+    provenance = Column(String, nullable=False)  # direct, fuzzy or no_match
+    hit_count = Column(Integer, default=0)
+    date_created = Column(DateTime, default=datetime.utcnow)
+    last_hit = Column(DateTime, nullable=True)
+
+    __table_args__ = (UniqueConstraint("match_key", "lwin_version", name="uq_lwin_match_cache_key_version"),)
+
+# LwinAlias table (user-confirmed producer/cuvee aliases, per restaurant or global)
+class LwinAlias(Base):
+    __tablename__ = "lwin_alias"
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    restaurant_id = Column(UUID(as_uuid=True), ForeignKey("restaurant.id"), nullable=True)  # Null for global aliases
+    field = Column(String, nullable=False)  # producer or cuvee
+    alias = Column(String, nullable=False)  # Normalized (lowercase) text as it appears on lists
+    canonical = Column(String, nullable=False)  # Normalized value to match LWIN with
+    deleted = Column(Boolean, default=False, nullable=False)  # Tombstone, so other workers drop the alias on refresh
+    date_created = Column(DateTime, default=datetime.utcnow)
+    # Assigned by the database (one clock for every node); incremental refreshes use it as their watermark
+    last_updated = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        UniqueConstraint("restaurant_id", "field", "alias", name="uq_lwin_alias_restaurant_field_alias"),
+        # NULLs never conflict in the constraint above, so global aliases need their own unique index
+        Index("uq_lwin_alias_global_field_alias", "field", "alias", unique=True,
+              postgresql_where=text("restaurant_id IS NULL"), sqlite_where=text("restaurant_id IS NULL")),
+    )
+
+# AiParseCache table (AI parse results shared across workers, keyed by normalized text, model and prompt version)
+class AiParseCache(Base):
+    __tablename__ = "ai_parse_cache"
+    cache_key = Column(String, primary_key=True)
+    model = Column(String, nullable=False)
+    prompt_version = Column(String, nullable=False)
+    result = Column(JSON, nullable=False)
+    hit_count = Column(Integer, default=0)
+    date_created = Column(DateTime, default=datetime.utcnow)
+    last_hit = Column(DateTime, default=datetime.utcnow)
+
+# AiTokenUsage table (daily AI token spend per restaurant, for budgets)
+class AiTokenUsage(Base):
+    __tablename__ = "ai_token_usage"
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    restaurant_id = Column(UUID(as_uuid=True), ForeignKey("restaurant.id"), nullable=False)
+    usage_date = Column(Date, nullable=False)
+    tokens = Column(Integer, default=0)
+    requests = Column(Integer, default=0)
+
+    __table_args__ = (UniqueConstraint("restaurant_id", "usage_date", name="uq_ai_token_usage_restaurant_date"),)
+
+# ParseJob table (durable queue of wine list parses, claimed by workers with leases)
+class ParseJob(Base):
+    __tablename__ = "parse_job"
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    wine_list_file_id = Column(UUID(as_uuid=True), ForeignKey("wine_list_file.id", ondelete="CASCADE"), nullable=False)
+    restaurant_id = Column(UUID(as_uuid=True), ForeignKey("restaurant.id"), nullable=False)
+    storage_path = Column(String, nullable=False)  # Object name in the wine-lists bucket
+    lane = Column(String, default="bulk", nullable=False)  # interactive or bulk (see JOB_LANES)
+    status = Column(Enum(ParseJobStatus), default=ParseJobStatus.queued, nullable=False)
+    stage = Column(String, nullable=True)  # Current pipeline stage while running
+    progress = Column(JSON, nullable=True)  # Latest progress event (pages and entries done), see app.progress
+    attempts = Column(Integer, default=0)
+    worker_id = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)  # A running job whose lease lapses is reclaimed
+    error = Column(Text, nullable=True)
+    date_created = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (Index("ix_parse_job_status_lane_created", "status", "lane", "date_created"),)
+
+# PipelineArtifact table (content-addressed, compressed output of each parse pipeline stage)
+class PipelineArtifact(Base):
+    __tablename__ = "pipeline_artifact"
+    artifact_key = Column(String, primary_key=True)  # Hash of stage, stage version and input hash
+    stage = Column(String, nullable=False)
+    stage_version = Column(Integer, nullable=False)
+    input_hash = Column(String, nullable=False)
+    data = Column(LargeBinary, nullable=False)  # zlib-compressed JSON
+    size_bytes = Column(Integer, nullable=False)  # Uncompressed size
+    date_created = Column(DateTime, default=datetime.utcnow)
+
+# RefinementArtifact table (a wine list's refinement data, one compressed row per top-level section)
+class RefinementArtifact(Base):
+    __tablename__ = "refinement_artifact"
+    wine_list_file_id = Column(UUID(as_uuid=True), ForeignKey("wine_list_file.id", ondelete="CASCADE"), primary_key=True)
+    section = Column(String, primary_key=True)  # e.g. initial_parse, enriched_sample, restaurant_rules, needs_review
+    data = Column(LargeBinary, nullable=False)  # zlib-compressed JSON
+    size_bytes = Column(Integer, nullable=False)  # Uncompressed size
+    date_created = Column(DateTime, default=datetime.utcnow)
+
 class UserCreate(BaseModel):
     email: str
     supabase_user_id: str
@@ -1,15 +1,23 @@
-from typing import List, Dict, Any, Tuple, Optional
+from typing import List, Dict, Any, Tuple, Optional, Callable
+from concurrent.futures import ThreadPoolExecutor
 from app.rules import apply_rules
-from app.preprocessing import normalize_text
+from app.preprocessing import normalize_text, map_normalized_span
 from app.lwin import (
     match_lwin_batch,
     get_lwin_db,
+    get_lwin_snapshot,
+    get_producer_aliases,
     enrich_wine_entry as lwin_enrich_wine_entry,
     get_lwin_suggestions,
     LWIN_KEY_FIELDS,
     LWIN_FIELD_MAPPING
 )
-from app.ai_parsing import parse_wine_entries
+from app.ai_parsing import AI_FIELDS, parse_wine_entries
+from app.ai_scheduler import AiBudget
+from app.gazetteer import ProducerGazetteer
+from app.clustering import cluster_entries, canonical_key, fan_out
+from app.config import PRODUCER_GAZETTEER_ENABLED, ENTRY_CLUSTERING_ENABLED, AI_ROUTED_MODE, ENTRY_COMMIT_BATCH_SIZE, MIN_CONFIDENCE_THRESHOLD
+import copy
 import re
 import logging
 
@@ -52,6 +60,13 @@ GLOBAL_RULES = [
     {'field': 'cuvee', 'pattern': r'(?:\'(?P<cuvee>[^\']+)\'|"(?P<cuvee2>[^"]+)"|(?P<cuvee3>[A-Z][a-zA-Z\s\'-]+))(?=\s*,\s*[A-Z][a-zA-Z\s\'-]+)', 'confidence': 0.8},
 ]
 
+# Known-producer automaton (LWIN PRODUCER_NAME + persisted aliases), shared by all parses in the process
+PRODUCER_GAZETTEER = ProducerGazetteer()
+GAZETTEER_CONFIDENCE = 0.95
+
+# Provenance whose values skip validate_field's shape checks
+VALIDATION_EXEMPT_PROVENANCE = {'gazetteer'}
+
 # Required fields for WineEntry with weights
 REQUIRED_FIELDS = {
     'producer': 1.0,  # Most important
@@ -69,6 +84,10 @@ REQUIRED_FIELDS = {
     'sub_type': 0.5   # Optional
 }
 
+# Per-field AI routing thresholds. Extracted field confidences are scaled by the field's weight,
+# so a flat bar would send most optional fields to the model however sure the rules were
+AI_ROUTING_THRESHOLDS = {field: MIN_CONFIDENCE_THRESHOLD * REQUIRED_FIELDS.get(field, 0.5) for field in AI_FIELDS}
+
 def validate_field(field: str, value: Any) -> Tuple[bool, float]:
     """Validate a field value and return (is_valid, confidence)."""
     if not value:
@@ -100,6 +119,7 @@ def calculate_field_confidence(field: str, value: Any, provenance: str, base_con
         'restaurant_rule': 1.0,
         'global_rule': 0.9,
         'lwin_match': 0.95,
+        'gazetteer': 1.0,
         'lwin_enrichment': 0.85,
         'context': 0.7,
         'context_propagation': 0.6,
@@ -107,10 +127,11 @@ def calculate_field_confidence(field: str, value: Any, provenance: str, base_con
     }
     confidence *= provenance_multipliers.get(provenance, 0.5)
     
-    # Validate field
-    is_valid, validation_confidence = validate_field(field, value)
-    if not is_valid:
-        confidence *= 0.5
+    # Validate field (known names are valid as they stand, even with words like "grand" or "cru")
+    if provenance not in VALIDATION_EXEMPT_PROVENANCE:
+        is_valid, validation_confidence = validate_field(field, value)
+        if not is_valid:
+            confidence *= 0.5
     
     # Additional field-specific adjustments
     if field == 'vintage' and str(value).upper() in ['NV', 'N.V.']:
@@ -142,11 +163,77 @@ def calculate_row_confidence(extracted: Dict[str, Any], field_confidence: Dict[s
     # Calculate weighted average
     return weighted_sum / total_weight
 
-def extract_fields_for_entries(entries: List[Dict[str, Any]], ruleset: Dict[str, Any], global_rules: List[Dict[str, Any]] = GLOBAL_RULES) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
-    """Extract fields with focus on accurate full-string parsing."""
+def _lwin_gazetteer_names() -> Tuple[List[str], List[str]]:
+    """Producer names from the active LWIN snapshot, plus country/region/colour names to exclude."""
+    snapshot = get_lwin_snapshot()
+    producers = snapshot.db['PRODUCER_NAME'] if 'PRODUCER_NAME' in snapshot.db.columns else None
+    if producers is None:
+        return [], []
+    names = producers.cat.categories.tolist() if hasattr(producers, 'cat') else producers.unique().tolist()
+    excluded = [key for index in snapshot.shards.values() for key in index]
+    return [name for name in names if name], excluded
+
+def get_producer_gazetteer(restaurant_id: Optional[str] = None) -> Optional[ProducerGazetteer]:
+    """Return the producer gazetteer, rebuilding it if the LWIN snapshot or aliases changed.
+    With restaurant_id, that restaurant's own aliases are made ready for find_producer too."""
+    if not PRODUCER_GAZETTEER_ENABLED:
+        return None
+    try:
+        lwin_version = get_lwin_snapshot().version
+        alias_generation, aliases = get_producer_aliases()
+        PRODUCER_GAZETTEER.ensure(lwin_version, _lwin_gazetteer_names, alias_generation, lambda: aliases)
+        if restaurant_id:
+            PRODUCER_GAZETTEER.ensure_restaurant(
+                str(restaurant_id), alias_generation, lambda: get_producer_aliases(restaurant_id)[1]
+            )
+        return PRODUCER_GAZETTEER
+    except Exception as e:
+        logger.error(f"Error building producer gazetteer: {str(e)}")
+        return None
+
+def extract_known_producer(raw_text: str, gazetteer: Optional[ProducerGazetteer] = None,
+                           restaurant_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Find the longest known producer in raw_text in a single linear scan (LWIN names, global
+    aliases and restaurant_id's own aliases). Returns the match with its span."""
+    gazetteer = gazetteer or get_producer_gazetteer(restaurant_id)
+    if gazetteer is None:
+        return None
+    return gazetteer.find_producer(raw_text, str(restaurant_id) if restaurant_id else None)
+
+def lwin_match_input(e: Dict[str, Any]) -> Dict[str, Any]:
+    """The extracted fields of a parsed entry plus its section headers, which route LWIN matching to a shard."""
+    return {
+        **e['extracted'],
+        'section': e['entry'].get('section'),
+        'sub_section': e['entry'].get('sub_section')
+    }
+
+def _entry_result(e: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        **e['extracted'],
+        'section_header': e['entry'].get('section'),
+        'subheader': e['entry'].get('sub_section'),
+        'sub_subheader': e['entry'].get('sub_sub_section'),
+        'raw_text': e['entry']['raw_text'],
+        'page': (e['entry'].get('lines') or [{}])[0].get('page'),
+        'field_confidence': e['field_confidence'],
+        'provenance': e['provenance'],
+        'row_confidence': e['row_confidence'],
+        'needs_review': e['needs_review']
+    }
+
+def extract_fields_for_entries(entries: List[Dict[str, Any]], ruleset: Dict[str, Any], global_rules: List[Dict[str, Any]] = GLOBAL_RULES,
+                               on_progress: Optional[Callable[[int, int], None]] = None,
+                               on_batch: Optional[Callable[[List[Dict[str, Any]]], None]] = None,
+                               batch_size: int = ENTRY_COMMIT_BATCH_SIZE,
+                               restaurant_id: Optional[str] = None) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Extract fields with focus on accurate full-string parsing. on_progress(done, total) is called after each entry;
+    on_batch receives the results in order, batch_size at a time, as soon as each batch is parsed.
+    restaurant_id is the restaurant whose list this is; its own producer aliases are matched too."""
     logger.info(f"Starting extract_fields_for_entries with {len(entries)} entries")
-    results = []
+    flushed = 0
     per_restaurant_rules = ruleset.get('extraction_rules', []) if ruleset else []
+    gazetteer = get_producer_gazetteer(restaurant_id)
     
     # First pass: extract fields using full-string patterns
     extracted_entries = []
@@ -176,6 +263,20 @@ def extract_fields_for_entries(entries: List[Dict[str, Any]], ruleset: Dict[str,
                                 provenance[field] = rule.get('provenance', 'restaurant_rule')
                                 logger.info(f"    Extracted {field}: {match.group(field)} (confidence: {field_confidence[field]})")
             
+            # 1b. Find known producers with the gazetteer before the regex cascade; a hit
+            # outranks the capitalised-word producer patterns, so those are skipped below
+            if 'producer' not in extracted and gazetteer is not None:
+                known = extract_known_producer(raw_text, gazetteer, restaurant_id)
+                if known:
+                    extracted['producer'] = known['text']
+                    # Offsets are into the stored (unnormalised) raw text
+                    extracted['producer_span'] = list(map_normalized_span(entry['raw_text'], raw_text, known['start'], known['end']))
+                    field_confidence['producer'] = calculate_field_confidence(
+                        'producer', known['text'], 'gazetteer', GAZETTEER_CONFIDENCE
+                    )
+                    provenance['producer'] = 'gazetteer'
+                    logger.info(f"  Gazetteer found producer: {known['text']} ({known['value']})")
+            
             # 2. Try global rules for remaining fields
             for rule in global_rules:
                 if 'pattern' in rule and 'field' not in rule:  # Full-string pattern
@@ -253,19 +354,16 @@ def extract_fields_for_entries(entries: List[Dict[str, Any]], ruleset: Dict[str,
                 logger.info(f"Processed {idx+1}/{len(entries)} entries")
         except Exception as e:
             logger.error(f"Exception processing entry {idx}: {str(e)}")
+        if on_progress:
+            on_progress(idx + 1, len(entries))
+        if on_batch and len(extracted_entries) - flushed >= batch_size:
+            on_batch([_entry_result(e) for e in extracted_entries[flushed:]])
+            flushed = len(extracted_entries)
     
     # Convert to final results format
-    results = [{
-        **e['extracted'],
-        'section_header': e['entry'].get('section'),
-        'subheader': e['entry'].get('sub_section'),
-        'sub_subheader': e['entry'].get('sub_sub_section'),
-        'raw_text': e['entry']['raw_text'],
-        'field_confidence': e['field_confidence'],
-        'provenance': e['provenance'],
-        'row_confidence': e['row_confidence'],
-        'needs_review': e['needs_review']
-    } for e in extracted_entries]
+    results = [_entry_result(e) for e in extracted_entries]
+    if on_batch and flushed < len(results):
+        on_batch(results[flushed:])
     
     logger.info(f"Finished extract_fields_for_entries, processed {len(results)} entries")
     return results, extracted_entries
@@ -276,7 +374,7 @@ def get_low_confidence_samples(entries: List[Dict[str, Any]], count: int = 10) -
     low_confidence = sorted(entries, key=lambda x: x['row_confidence'])[:count]
     return low_confidence
 
-def generate_initial_rules(samples: List[Dict[str, Any]]) -> Dict[str, Any]:
+def generate_initial_rules(samples: List[Dict[str, Any]], restaurant_id: Optional[str] = None) -> Dict[str, Any]:
     """Generate initial restaurant rules from low confidence samples using LWIN and AI."""
     logger.info("Starting initial rule generation from samples")
     ruleset = {
@@ -289,7 +387,7 @@ def generate_initial_rules(samples: List[Dict[str, Any]]) -> Dict[str, Any]:
     
     try:
         # Get LWIN matches for samples
-        lwin_matches = match_lwin_batch([s['extracted'] for s in samples])
+        lwin_matches = match_lwin_batch([lwin_match_input(s) for s in samples], restaurant_id=restaurant_id)
         
         # Analyze patterns from samples and LWIN matches
         for sample, lwin_match in zip(samples, lwin_matches):
@@ -394,7 +492,19 @@ def generate_initial_rules(samples: List[Dict[str, Any]]) -> Dict[str, Any]:
         logger.error(f"Exception during rule generation: {str(e)}")
         return ruleset
 
-def parse_wine_list(entries: List[Dict[str, Any]], restaurant_rules: Optional[Dict[str, Any]] = None) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+def cluster_key(entry: Dict[str, Any]) -> Optional[Tuple[Any, ...]]:
+    """Near-duplicate key for an extracted entry: its text without vintage, price and size,
+    within its section (section context feeds both the inherited fields and LWIN routing)."""
+    canonical = canonical_key(entry['raw_text'])
+    if not canonical:
+        return None
+    source = entry.get('entry', {})
+    return (source.get('section'), source.get('sub_section'), canonical)
+
+def parse_wine_list(entries: List[Dict[str, Any]], restaurant_rules: Optional[Dict[str, Any]] = None, restaurant_id: Optional[str] = None,
+                    ai_budget: Optional[AiBudget] = None,
+                    on_progress: Optional[Callable[[int, int], None]] = None,
+                    on_entries: Optional[Callable[[List[Dict[str, Any]]], None]] = None) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
     """Parse wine list with the new multi-stage pipeline:
     1. If restaurant rules exist, parse with them and show refinement.
     2. If no rules:
@@ -404,6 +514,9 @@ def parse_wine_list(entries: List[Dict[str, Any]], restaurant_rules: Optional[Di
        - Generate initial restaurant rules from enriched sample
        - Re-parse all entries with new rules
        - Return all relevant data for refinement
+    AI calls are charged to ai_budget (by default a fresh per-upload budget for the restaurant).
+    on_progress(done, total) reports the pass that produces the returned entries, and on_entries
+    receives those entries in batches as they are produced, so they can be saved before parsing ends.
     """
     logger.info("\n===== Starting Wine List Parsing (Multi-Stage) =====")
     logger.info(f"Input entries count: {len(entries)}")
@@ -411,7 +524,8 @@ def parse_wine_list(entries: List[Dict[str, Any]], restaurant_rules: Optional[Di
     # 1. If restaurant rules exist, use them directly
     if restaurant_rules and restaurant_rules.get('extraction_rules'):
         logger.info("\nUsing existing restaurant rules")
-        results, _ = extract_fields_for_entries(entries, restaurant_rules, GLOBAL_RULES)
+        results, _ = extract_fields_for_entries(entries, restaurant_rules, GLOBAL_RULES, on_progress, on_entries,
+                                                restaurant_id=restaurant_id)
         needs_review = [r for r in results if r['needs_review']]
         return results, {
             'final_parse': results,
@@ -424,7 +538,7 @@ def parse_wine_list(entries: List[Dict[str, Any]], restaurant_rules: Optional[Di
 
     # 2. Initial parse with global rules only (no LWIN/AI)
     logger.info("\n==== Step 1: Initial Parse with Global Rules (no LWIN/AI) ===")
-    initial_results, initial_intermediate = extract_fields_for_entries(entries, None, GLOBAL_RULES)
+    initial_results, initial_intermediate = extract_fields_for_entries(entries, None, GLOBAL_RULES, restaurant_id=restaurant_id)
     logger.info(f"Initial parse completed with {len(initial_results)} entries")
 
     # 3. Select a sample for enrichment (low-confidence + a few high-confidence)
@@ -438,8 +552,21 @@ def parse_wine_list(entries: List[Dict[str, Any]], restaurant_rules: Optional[Di
 
     # 4. Enrich only the sample with LWIN/AI
     logger.info("\n==== Step 3: LWIN/AI Enrichment of Sample ===")
-    lwin_matches = match_lwin_batch([s['extracted'] for s in sample])
-    ai_processed_samples = parse_wine_entries(sample)
+    if ai_budget is None:
+        ai_budget = AiBudget(restaurant_id)
+    # Variants of one wine (vintages, formats, prices) are enriched once and fanned back out
+    clusters = cluster_entries([cluster_key(s) for s in sample]) if ENTRY_CLUSTERING_ENABLED else [[i] for i in range(len(sample))]
+    representatives = [sample[cluster[0]] for cluster in clusters]
+    logger.info(f"Enriching {len(representatives)} representatives for {len(sample)} sampled entries")
+    # LWIN matching runs alongside the (network-bound) AI requests; both get copies since they update entries in place
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        lwin_future = pool.submit(match_lwin_batch, [copy.deepcopy(lwin_match_input(s)) for s in representatives], restaurant_id=restaurant_id)
+        ai_processed_samples = parse_wine_entries(copy.deepcopy(representatives), budget=ai_budget, routed=AI_ROUTED_MODE,
+                                                    field_thresholds=AI_ROUTING_THRESHOLDS)
+        lwin_matches = lwin_future.result()
+    texts = [s['raw_text'] for s in sample]
+    lwin_matches = fan_out(clusters, [s['extracted'] for s in sample], lwin_matches, texts)
+    ai_processed_samples = fan_out(clusters, sample, ai_processed_samples, texts)
     enriched_sample = []
     for orig, lwin, ai in zip(sample, lwin_matches, ai_processed_samples):
         enriched = orig.copy()
@@ -449,6 +576,12 @@ def parse_wine_list(entries: List[Dict[str, Any]], restaurant_rules: Optional[Di
             enriched['lwin_match_info'] = lwin
             enriched['lwin_confidence'] = lwin.get('lwin_match_score', 0) / 100.0
             enriched['lwin_number'] = lwin.get('LWIN', None)
+        # Confident enough that AI wasn't asked
+        elif ai and ai.get('ai_skipped'):
+            enriched['ai_skipped'] = True
+        # Out of AI budget: keep the rule-based fields and flag the entry
+        elif ai and ai.get('ai_budget_exceeded'):
+            enriched['ai_budget_exceeded'] = True
         # Otherwise, use AI fields if present
         elif ai:
             for field, value in ai.items():
@@ -461,15 +594,17 @@ def parse_wine_list(entries: List[Dict[str, Any]], restaurant_rules: Optional[Di
             enriched['ai_used'] = True
         enriched_sample.append(enriched)
     logger.info(f"Enriched sample size: {len(enriched_sample)}")
+    logger.info(f"AI token usage: {ai_budget.summary()}")
 
     # 5. Generate initial restaurant rules from enriched sample
     logger.info("\n==== Step 4: Generating Initial Restaurant Rules from Enriched Sample ===")
-    restaurant_rules = generate_initial_rules(sample)
+    restaurant_rules = generate_initial_rules(sample, restaurant_id)
     logger.info(f"Generated {len(restaurant_rules.get('extraction_rules', []))} initial rules")
 
     # 6. Re-parse all entries with new rules
     logger.info("\n==== Step 5: Parsing All Entries with New Restaurant Rules ===")
-    final_results, _ = extract_fields_for_entries(entries, restaurant_rules, GLOBAL_RULES)
+    final_results, _ = extract_fields_for_entries(entries, restaurant_rules, GLOBAL_RULES, on_progress, on_entries,
+                                                  restaurant_id=restaurant_id)
     needs_review = [r for r in final_results if r['needs_review']]
     logger.info(f"Final parse completed. Entries needing review: {len(needs_review)}")
     
@@ -480,6 +615,7 @@ def parse_wine_list(entries: List[Dict[str, Any]], restaurant_rules: Optional[Di
         'restaurant_rules': restaurant_rules,
         'final_parse': final_results,
         'needs_review': needs_review,
+        'ai_usage': ai_budget.summary(),
         'stage': 'multi_stage',
     }
     logger.info("\n===== Multi-Stage Wine List Parsing Complete =====")
@@ -1,13 +1,15 @@
 import fitz  # PyMuPDF
 import json
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Callable, Optional
 import pytesseract
 from PIL import Image
 import io
 import re
 from datetime import datetime
 
-def extract_pdf_text_with_ocr(pdf_path: str) -> List[List[Dict[str, Any]]]:
+def extract_pdf_text_with_ocr(pdf_path: str, on_page: Optional[Callable[[int, int], None]] = None) -> List[List[Dict[str, Any]]]:
+    """Extract text lines per page, falling back to OCR for pages without a text layer.
+    on_page(done, total) is called after each page."""
     doc = fitz.open(pdf_path)
     pages = []
     for page_num in range(len(doc)):
@@ -41,6 +43,8 @@ def extract_pdf_text_with_ocr(pdf_path: str) -> List[List[Dict[str, Any]]]:
                         "source": "ocr"
                     })
         pages.append(page_lines)
+        if on_page:
+            on_page(page_num + 1, len(doc))
     return pages
 
 def save_extraction_to_json(pages: List[List[Dict[str, Any]]], output_path: str):
@@ -1,4 +1,5 @@
 import re
+import difflib
 import unicodedata
 from typing import List, Dict, Any, Tuple
 
@@ -27,6 +28,23 @@ def normalize_text(text: str) -> str:
     text = re.sub(r"\s+", " ", text)
     return text.strip()
 
+def map_normalized_span(original: str, normalized: str, start: int, end: int) -> Tuple[int, int]:
+    """Map a [start, end) span found in normalize_text(original) back onto original.
+    Characters normalization rewrote map to the whole rewritten stretch."""
+    opcodes = difflib.SequenceMatcher(None, normalized, original, autojunk=False).get_opcodes()
+
+    def locate(position: int, is_end: bool) -> int:
+        for tag, i1, i2, j1, j2 in opcodes:
+            if i1 == i2:
+                continue  # Inserted in original only
+            if i1 <= position < i2 or (is_end and i1 < position <= i2):
+                if tag == 'equal':
+                    return j1 + position - i1
+                return j2 if is_end else j1
+        return len(original) if is_end else 0
+
+    return locate(start, False), locate(end, True)
+
 def is_contents_page(page: List[Dict[str, Any]]) -> Tuple[bool, Dict[str, int]]:
     """Detect if a page is a contents/index page and extract page numbers."""
     contents_keywords = ["contents", "index", "table of contents", "wine list", "sommelier's selection"]
@@ -0,0 +1,253 @@
+import io
+import os
+import re
+import csv
+import enum
+import json
+import math
+import uuid
+import logging
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+import numpy as np
+import pandas as pd
+from app.database import SessionLocal
+from sqlalchemy import func, insert
+from sqlalchemy.orm import Session
+from app.models import WineListFile, WineEntry, WineEntryStatus, Ruleset, LwinAlias
+from app.pdf_extraction import extract_pdf_text_with_ocr, save_extraction_to_json
+from app.preprocessing import preprocess_extraction, detect_sections
+from app.wine_segmentation import segment_wine_entries
+from app.parsing import parse_wine_list
+from app.lwin import get_lwin_snapshot
+from app.ai_parsing import AI_PROMPT_VERSION
+from app.artifacts import run_checkpointed, hash_file, hash_json
+from app.refinement_store import save_refinement_data
+from app.config import ENTRY_COPY_MIN_ROWS
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Stages reported through on_stage, in order
+PROCESSING_STAGES = ['extracting', 'preprocessing', 'detecting_sections', 'segmenting', 'parsing', 'saving']
+
+class ParseCancelled(Exception):
+    """Raised when the caller gave up on a parse (e.g. its job lease was lost); nothing more is committed."""
+
+def make_json_serializable(obj):
+    if isinstance(obj, dict):
+        return {k: make_json_serializable(v) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [make_json_serializable(v) for v in obj]
+    elif isinstance(obj, (pd.Timestamp, np.datetime64)):
+        return str(obj)
+    elif isinstance(obj, float):
+        if math.isnan(obj) or math.isinf(obj):
+            return None
+        return obj
+    elif hasattr(obj, 'isna') and obj.isna():  # pandas NA
+        return None
+    elif isinstance(obj, (np.floating, np.integer)):
+        if np.isnan(obj) or np.isinf(obj):
+            return None
+        return obj.item()
+    elif obj is None:
+        return None
+    else:
+        return obj
+
+# Columns written for every saved entry, in COPY column order
+_ENTRY_COLUMNS = [c.name for c in WineEntry.__table__.columns]
+_EXTRA_DATA_KEYS = {'provenance', 'lwin_match_info', 'lwin_suggestions'}
+
+def wine_entry_rows(wine_list: WineListFile, restaurant_id: str, entries: List[Dict[str, Any]], start: int = 0) -> List[Dict[str, Any]]:
+    """Plain column dicts for parsed entries; fields without a WineEntry column go to extra_data.
+    Every row has every column, since an executemany statement is compiled from the first row.
+    start is the position of the first entry within the wine list."""
+    now = datetime.utcnow()
+    valid_fields = set(_ENTRY_COLUMNS)
+    rows = []
+    for position, entry in enumerate(entries, start):
+        entry = make_json_serializable(entry)
+        row = dict.fromkeys(_ENTRY_COLUMNS)
+        row.update({k: v for k, v in entry.items() if k in valid_fields and k != 'extra_data'})
+        extra_data = {k: v for k, v in entry.items() if k not in valid_fields or k in _EXTRA_DATA_KEYS}
+        row.update({
+            'id': uuid.uuid4(),
+            'wine_list_file_id': wine_list.id,
+            'restaurant_id': restaurant_id,
+            'status': row['status'] or WineEntryStatus.auto,
+            'last_modified': now,
+            'version': 1,
+            'position': position,
+            'extra_data': extra_data or None
+        })
+        rows.append(row)
+    return rows
+
+def _copy_value(value: Any) -> Any:
+    if value is None:
+        return r'\N'
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    if isinstance(value, enum.Enum):
+        return value.name  # SQLAlchemy Enum columns store member names
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+def _copy_rows(db, rows: List[Dict[str, Any]]) -> bool:
+    """COPY rows into wine_entry on the session's connection. Returns False if the driver can't COPY."""
+    cursor = db.connection().connection.cursor()
+    try:
+        if not hasattr(cursor, 'copy_expert'):
+            return False
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([_copy_value(row[column]) for column in _ENTRY_COLUMNS])
+        buffer.seek(0)
+        columns = ', '.join(f'"{column}"' for column in _ENTRY_COLUMNS)
+        cursor.copy_expert(f"COPY {WineEntry.__tablename__} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+        return True
+    finally:
+        cursor.close()
+
+def save_wine_entries(db, wine_list: WineListFile, restaurant_id: str, entries: List[Dict[str, Any]], start: int = 0) -> None:
+    """Insert parsed entries in the session's transaction (the caller commits).
+
+    Rows bypass the ORM unit of work: one executemany INSERT (batched into multi-row
+    statements by the driver) or, on Postgres for ENTRY_COPY_MIN_ROWS rows or more, COPY.
+    """
+    rows = wine_entry_rows(wine_list, restaurant_id, entries, start)
+    if not rows:
+        return
+    if len(rows) >= ENTRY_COPY_MIN_ROWS and db.bind.dialect.name == 'postgresql' and _copy_rows(db, rows):
+        return
+    db.execute(insert(WineEntry.__table__), rows)
+
+def process_wine_list_file(wine_list_id: str, restaurant_id: str, filename: str, pdf_path: str,
+                           on_stage: Optional[Callable[[str], None]] = None,
+                           on_progress: Optional[Callable[[str, int, int], None]] = None,
+                           cancelled: Optional[Callable[[], bool]] = None,
+                           holds_lease: Optional[Callable[[Session], bool]] = None) -> None:
+    """Run the full pipeline for an uploaded wine list: PDF extraction, preprocessing, section
+    detection, segmentation, parsing and saving entries. The PDF at pdf_path is removed afterwards.
+    on_progress(kind, done, total) reports pages extracted ('pages') and entries parsed ('entries').
+    Entries are committed in batches as the final parse pass produces them, with the list's
+    partial_results flag set until the last batch is saved.
+    cancelled() is polled between stages, pages, entries and batches, and holds_lease(db) is
+    checked inside every entries/status transaction before it commits; either failing raises
+    ParseCancelled after rolling back, leaving the wine list to whoever took the parse over.
+    Otherwise raises after marking the wine list as errored (if the lease is still held), so
+    callers can record the failure too."""
+    def check_cancelled() -> None:
+        if cancelled and cancelled():
+            raise ParseCancelled(f"Parse of wine list {wine_list_id} cancelled")
+
+    def commit_if_owned() -> None:
+        check_cancelled()
+        if holds_lease and not holds_lease(db):
+            raise ParseCancelled(f"Parse of wine list {wine_list_id} no longer owned by this worker")
+        db.commit()
+
+    def stage(name: str) -> None:
+        check_cancelled()
+        logger.info(f"Wine list {wine_list_id}: {name}")
+        if on_stage:
+            on_stage(name)
+
+    def report(kind: str) -> Callable[[int, int], None]:
+        def callback(done: int, total: int) -> None:
+            check_cancelled()
+            if on_progress:
+                on_progress(kind, done, total)
+        return callback
+
+    db = SessionLocal()
+    try:
+        wine_list = db.query(WineListFile).get(wine_list_id)
+        if not wine_list:
+            logger.error(f"[ERROR] Wine list {wine_list_id} not found")
+            return
+
+        # Update status to processing
+        wine_list.status = "processing"
+        commit_if_owned()
+
+        # Each stage's output is checkpointed: a retry resumes after the last stored stage, and a
+        # re-parse after a rule change reuses everything up to segmentation (OCR included)
+        ruleset_obj = db.query(Ruleset).filter_by(restaurant_id=restaurant_id).first()
+        ruleset = ruleset_obj.rules_json if ruleset_obj else None
+        parse_inputs = hash_json({
+            'ruleset': ruleset,
+            'restaurant_id': restaurant_id,
+            'lwin_version': get_lwin_snapshot().version,
+            'aliases_updated': str(db.query(func.max(LwinAlias.last_updated)).scalar()),
+            'ai_prompt_version': AI_PROMPT_VERSION
+        })
+        on_page = report('pages')
+        on_entry = report('entries')
+        saved = 0
+
+        def save_batch(entries: List[Dict[str, Any]]) -> None:
+            nonlocal saved
+            save_wine_entries(db, wine_list, restaurant_id, entries, saved)
+            wine_list.partial_results = True
+            commit_if_owned()
+            saved += len(entries)
+            logger.info(f"Wine list {wine_list_id}: saved {saved} entries so far")
+
+        outputs = run_checkpointed(hash_file(pdf_path), [
+            ('extracting', lambda _: extract_pdf_text_with_ocr(pdf_path, on_page=on_page), ''),
+            ('preprocessing', preprocess_extraction, ''),
+            ('detecting_sections', detect_sections, ''),
+            ('segmenting', segment_wine_entries, ''),
+            ('parsing', lambda entries: make_json_serializable(list(parse_wine_list(entries, ruleset, restaurant_id, on_progress=on_entry, on_entries=save_batch))), parse_inputs)
+        ], on_stage=stage)
+        final_entries, refinement_data = outputs['parsing']
+        wine_entries = outputs.get('segmenting')
+
+        stage('saving')
+        # Entries not already saved in batches (all of them when the parse output came from a checkpoint)
+        save_wine_entries(db, wine_list, restaurant_id, final_entries[saved:], saved)
+
+        # Refinement data is stored per section in the database, shared by every node
+        save_refinement_data(db, wine_list.id, refinement_data)
+
+        # Save extraction to JSON for debugging (local to this node)
+        project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        specs_dir = os.path.join(project_root, "specs")
+        os.makedirs(specs_dir, exist_ok=True)
+        safe_filename = re.sub(r'[^a-zA-Z0-9_.-]', '_', filename)
+        json_filename = f"extracted_{safe_filename}.json"
+        if wine_entries is not None:  # Not loaded when the run resumed from a stored parse
+            save_extraction_to_json(wine_entries, os.path.join(specs_dir, json_filename))
+
+        # Update wine list status and notes
+        wine_list.status = "parsed"
+        wine_list.partial_results = False
+        wine_list.notes = f"extraction_json: specs/{json_filename}"
+        commit_if_owned()
+        logger.info(f"wine_list {wine_list.id} status after commit: {wine_list.status}")
+
+    except ParseCancelled:
+        db.rollback()
+        raise
+    except Exception as e:
+        logger.error(f"Error processing file: {str(e)}")
+        db.rollback()
+        wine_list = db.query(WineListFile).get(wine_list_id)
+        if wine_list:
+            wine_list.status = "error"
+            wine_list.notes = f"Error: {str(e)}"
+            # A parse that was taken over leaves the list's status to its new owner
+            if holds_lease and not holds_lease(db):
+                db.rollback()
+                raise ParseCancelled(f"Parse of wine list {wine_list_id} no longer owned by this worker") from e
+            db.commit()
+        raise
+    finally:
+        db.close()
+        if os.path.exists(pdf_path):
+            os.remove(pdf_path)
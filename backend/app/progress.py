@@ -0,0 +1,212 @@
+import json
+import time
+import select
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, Optional, Set, Tuple
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from app.database import SessionLocal, engine
+from app.models import ParseJob, WineListFile
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_CHANNEL = "wine_list_progress"
+PROGRESS_MIN_INTERVAL = 0.5  # Seconds between counter updates (stage changes are always sent)
+
+class ProgressReporter:
+    """Tracks one parse job's progress and publishes it to the job row and the progress channel.
+
+    Every update carries the full state (stage, pages done/total, entries done/total),
+    so a viewer that misses an event is corrected by the next one. Counter updates are
+    throttled; stage changes and the final status are not.
+    """
+    def __init__(self, job_id: Any, wine_list_id: Any, worker_id: Optional[str] = None):
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.state: Dict[str, Any] = {
+            'wine_list_id': str(wine_list_id),
+            'job_id': str(job_id),
+            'status': 'running',
+            'stage': None,
+            'pages_done': 0,
+            'pages_total': None,
+            'entries_done': 0,
+            'entries_total': None
+        }
+        self._last_sent = 0.0
+
+    def stage(self, name: str) -> None:
+        self.state['stage'] = name
+        self._publish(force=True)
+
+    def progress(self, kind: str, done: int, total: int) -> None:
+        """kind is 'pages' or 'entries'."""
+        self.state[f'{kind}_done'] = done
+        self.state[f'{kind}_total'] = total
+        self._publish(force=done >= total)
+
+    def finish(self, error: Optional[str] = None) -> None:
+        self.state['status'] = 'error' if error else 'done'
+        self.state['error'] = error[:1000] if error else None  # NOTIFY payloads are capped at 8000 bytes
+        self._publish(force=True)
+
+    def _publish(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._last_sent < PROGRESS_MIN_INTERVAL:
+            return
+        self._last_sent = now
+        self.state['updated_at'] = datetime.utcnow().isoformat()
+        try:
+            publish_progress(self.state, self.job_id, self.worker_id)
+        except Exception as e:
+            # Progress is best effort; never fail a parse over it
+            logger.error(f"Error publishing progress for job {self.job_id}: {str(e)}")
+
+def publish_progress(state: Dict[str, Any], job_id: Any = None, worker_id: Optional[str] = None) -> None:
+    """Store the latest state on the job (if this worker still holds it) and notify listeners in every API process."""
+    db = SessionLocal()
+    try:
+        if job_id is not None:
+            query = db.query(ParseJob).filter(ParseJob.id == job_id)
+            if worker_id is not None:
+                query = query.filter(ParseJob.worker_id == worker_id)
+            query.update(
+                {ParseJob.progress: state, ParseJob.stage: state.get('stage')}, synchronize_session=False
+            )
+        if db.bind.dialect.name == 'postgresql':
+            db.execute(text("SELECT pg_notify(:channel, :payload)"), {'channel': PROGRESS_CHANNEL, 'payload': json.dumps(state)})
+        db.commit()
+    finally:
+        db.close()
+    if db.bind.dialect.name != 'postgresql':
+        PROGRESS_BUS.dispatch(state)
+
+class ProgressBus:
+    """Fans progress notifications out to the SSE streams open in this API process.
+
+    One background thread LISTENs on the progress channel (started with the first
+    subscriber); each subscriber is an asyncio queue fed thread-safely on its loop.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers: Dict[str, Set[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = defaultdict(set)
+        self._listener: Optional[threading.Thread] = None
+
+    def subscribe(self, wine_list_id: str) -> Tuple[asyncio.AbstractEventLoop, asyncio.Queue]:
+        subscription = (asyncio.get_running_loop(), asyncio.Queue(maxsize=100))
+        with self._lock:
+            self._subscribers[wine_list_id].add(subscription)
+            if engine.dialect.name == 'postgresql' and (self._listener is None or not self._listener.is_alive()):
+                self._listener = threading.Thread(target=self._listen, daemon=True, name="progress-listener")
+                self._listener.start()
+        return subscription
+
+    def unsubscribe(self, wine_list_id: str, subscription: Tuple[asyncio.AbstractEventLoop, asyncio.Queue]) -> None:
+        with self._lock:
+            self._subscribers[wine_list_id].discard(subscription)
+            if not self._subscribers[wine_list_id]:
+                del self._subscribers[wine_list_id]
+
+    def dispatch(self, state: Dict[str, Any]) -> None:
+        with self._lock:
+            subscriptions = list(self._subscribers.get(state.get('wine_list_id'), ()))
+        for loop, queue in subscriptions:
+            loop.call_soon_threadsafe(self._offer, queue, state)
+
+    @staticmethod
+    def _offer(queue: asyncio.Queue, state: Dict[str, Any]) -> None:
+        # A slow viewer drops intermediate updates; each update carries the full state anyway
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(state)
+
+    def _listen(self) -> None:
+        while True:
+            connection = None
+            try:
+                connection = engine.raw_connection()
+                connection.set_isolation_level(0)  # Autocommit, required for LISTEN
+                cursor = connection.cursor()
+                cursor.execute(f"LISTEN {PROGRESS_CHANNEL}")
+                logger.info("Listening for parse progress notifications")
+                while True:
+                    if select.select([connection], [], [], 30) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        notify = connection.notifies.pop(0)
+                        try:
+                            self.dispatch(json.loads(notify.payload))
+                        except ValueError:
+                            continue
+            except Exception as e:
+                logger.error(f"Progress listener error, reconnecting: {str(e)}")
+                time.sleep(5)
+            finally:
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+
+# Shared by every progress stream in this API process
+PROGRESS_BUS = ProgressBus()
+
+PROGRESS_HEARTBEAT_INTERVAL = 15  # Seconds between keep-alive comments on idle streams
+_TERMINAL_STATUSES = {'done', 'error', 'parsed'}
+
+def progress_snapshot(db: Session, wine_list_id: str) -> Optional[Dict[str, Any]]:
+    """Current progress of a wine list from its latest parse job (or its own status if it has none)."""
+    wine_list = db.query(WineListFile).get(wine_list_id)
+    if not wine_list:
+        return None
+    job = db.query(ParseJob).filter(ParseJob.wine_list_file_id == wine_list.id).order_by(ParseJob.date_created.desc()).first()
+    if job is None:
+        status = wine_list.status.value if hasattr(wine_list.status, 'value') else wine_list.status
+        return {'wine_list_id': str(wine_list.id), 'status': status, 'stage': None}
+    # The job row is authoritative for status, in case the final event was lost
+    return {
+        **(job.progress or {}),
+        'wine_list_id': str(wine_list.id),
+        'job_id': str(job.id),
+        'status': job.status.value if hasattr(job.status, 'value') else job.status,
+        'stage': (job.progress or {}).get('stage') or job.stage
+    }
+
+def _load_snapshot(wine_list_id: str) -> Optional[Dict[str, Any]]:
+    db = SessionLocal()
+    try:
+        return progress_snapshot(db, wine_list_id)
+    finally:
+        db.close()
+
+def _sse(state: Dict[str, Any]) -> str:
+    return f"event: progress\ndata: {json.dumps(state, default=str)}\n\n"
+
+async def progress_events(snapshot: Dict[str, Any]) -> AsyncIterator[str]:
+    """Server-sent events for one viewer: the snapshot, then every update until the parse finishes."""
+    yield _sse(snapshot)
+    if snapshot.get('status') in _TERMINAL_STATUSES:
+        return
+    wine_list_id = snapshot['wine_list_id']
+    subscription = PROGRESS_BUS.subscribe(wine_list_id)
+    try:
+        while True:
+            try:
+                state = await asyncio.wait_for(subscription[1].get(), PROGRESS_HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                # An idle stream rechecks the job row, in case the final event was missed
+                state = await run_in_threadpool(_load_snapshot, wine_list_id)
+                if state is None or state.get('status') not in _TERMINAL_STATUSES:
+                    yield ": keep-alive\n\n"
+                    continue
+            yield _sse(state)
+            if state.get('status') in _TERMINAL_STATUSES:
+                return
+    finally:
+        PROGRESS_BUS.unsubscribe(wine_list_id, subscription)
@@ -0,0 +1,35 @@
+import json
+import zlib
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from sqlalchemy.orm import Session
+from app.models import RefinementArtifact
+
+def save_refinement_data(db: Session, wine_list_id: Any, data: Dict[str, Any]) -> None:
+    """Replace a wine list's refinement data, one compressed row per top-level section.
+    Runs in the caller's transaction, so it lands together with the parsed entries."""
+    db.query(RefinementArtifact).filter(RefinementArtifact.wine_list_file_id == wine_list_id).delete(synchronize_session=False)
+    now = datetime.utcnow()
+    for section, value in data.items():
+        payload = json.dumps(value, ensure_ascii=False).encode('utf-8')
+        db.add(RefinementArtifact(
+            wine_list_file_id=wine_list_id, section=section,
+            data=zlib.compress(payload, 6), size_bytes=len(payload), date_created=now
+        ))
+
+def refinement_sections(db: Session, wine_list_id: Any) -> Dict[str, int]:
+    """Stored sections and their uncompressed sizes, without reading the data."""
+    return dict(db.query(RefinementArtifact.section, RefinementArtifact.size_bytes).filter(
+        RefinementArtifact.wine_list_file_id == wine_list_id
+    ).all())
+
+def load_refinement_data(db: Session, wine_list_id: Any, sections: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+    """Refinement data for a wine list, limited to sections if given (only those rows are read
+    and decompressed). None if nothing is stored for the list."""
+    query = db.query(RefinementArtifact.section, RefinementArtifact.data).filter(RefinementArtifact.wine_list_file_id == wine_list_id)
+    if sections:
+        query = query.filter(RefinementArtifact.section.in_(sections))
+    rows = query.all()
+    if not rows and not (sections and refinement_sections(db, wine_list_id)):
+        return None
+    return {section: json.loads(zlib.decompress(data).decode('utf-8')) for section, data in rows}
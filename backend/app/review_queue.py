@@ -0,0 +1,63 @@
+import random
+from typing import Any, Dict, Optional
+from sqlalchemy import func, or_, and_
+from sqlalchemy.orm import Session
+from app.models import WineEntry, WineEntryStatus
+from app.config import MIN_CONFIDENCE_THRESHOLD
+
+# Entries still waiting for a reviewer; edited, confirmed and rejected ones leave the queue
+REVIEW_PENDING_STATUS = WineEntryStatus.auto
+
+def _pending(db: Session, file_id: Any):
+    return db.query(WineEntry).filter(WineEntry.wine_list_file_id == file_id, WineEntry.status == REVIEW_PENDING_STATUS)
+
+def next_review_entry(db: Session, file_id: Any, after: Optional[Any] = None) -> Optional[WineEntry]:
+    """The pending entry most in need of review: lowest row_confidence first, then id.
+
+    Served straight from the (wine_list_file_id, status, row_confidence, id) index, one
+    row at a time. after is the id of the entry just shown; the queue continues past it,
+    so a reviewer can skip an entry without editing it, and wraps round to the head once the
+    end is passed. Entries with no confidence at all come last.
+    """
+    order = (WineEntry.row_confidence.asc().nulls_last(), WineEntry.id)
+    query = _pending(db, file_id)
+    if after:
+        previous = db.query(WineEntry.row_confidence, WineEntry.id).filter(WineEntry.id == after).first()
+        if previous is not None:
+            confidence, previous_id = previous
+            if confidence is None:
+                query = query.filter(WineEntry.row_confidence.is_(None), WineEntry.id > previous_id)
+            else:
+                query = query.filter(or_(
+                    WineEntry.row_confidence > confidence,
+                    and_(WineEntry.row_confidence == confidence, WineEntry.id > previous_id),
+                    WineEntry.row_confidence.is_(None)
+                ))
+    entry = query.order_by(*order).first()
+    if entry is None and after:
+        # Past the end: start again with the entries that were skipped
+        entry = _pending(db, file_id).order_by(*order).first()
+    return entry
+
+def random_review_entry(db: Session, file_id: Any) -> Optional[WineEntry]:
+    """A uniformly placed pending entry: jump to a random position within the list (via the
+    (wine_list_file_id, position) index) and take the next pending entry from there."""
+    max_position = db.query(func.max(WineEntry.position)).filter(WineEntry.wine_list_file_id == file_id).scalar()
+    query = _pending(db, file_id)
+    if max_position is not None:
+        start = random.randint(0, max_position)
+        entry = query.filter(WineEntry.position >= start).order_by(WineEntry.position).first()
+        if entry is not None:
+            return entry
+    # Wrapped past the end, or entries saved before positions existed
+    return query.order_by(WineEntry.position, WineEntry.id).first()
+
+def review_queue_stats(db: Session, file_id: Any) -> Dict[str, int]:
+    """Pending entries, and how many of those are below the review threshold."""
+    pending = _pending(db, file_id)
+    return {
+        'pending': pending.with_entities(func.count(WineEntry.id)).scalar(),
+        'needs_review': pending.filter(or_(
+            WineEntry.row_confidence < MIN_CONFIDENCE_THRESHOLD, WineEntry.row_confidence.is_(None)
+        )).with_entities(func.count(WineEntry.id)).scalar()
+    }
@@ -1,29 +1,81 @@
 import os
 import jwt
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
 from fastapi import Depends, HTTPException, Request, status
 from app.database import get_db
 from app.models import User
 import logging
-from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
 SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")  # Set this in your .env
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", 60))  # Seconds a verified token's user is reused before re-reading it
+AUTH_CACHE_MAX_ENTRIES = 1024  # Verified tokens kept (least recently used evicted)
+
+# sha256(token) -> (supabase user id, cache deadline, detached User)
+_auth_cache: "OrderedDict[str, Tuple[str, float, User]]" = OrderedDict()
+_auth_lock = threading.Lock()
+
+def _cached_user(token_key: str) -> Optional[User]:
+    with _auth_lock:
+        cached = _auth_cache.get(token_key)
+        if cached is None:
+            return None
+        if cached[1] <= time.time():
+            del _auth_cache[token_key]
+            return None
+        _auth_cache.move_to_end(token_key)
+        return cached[2]
+
+def _cache_user(token_key: str, sub: str, exp: Optional[float], user: User) -> None:
+    # Never outlive the token itself
+    deadline = min(time.time() + AUTH_CACHE_TTL, exp or float("inf"))
+    with _auth_lock:
+        _auth_cache[token_key] = (sub, deadline, user)
+        _auth_cache.move_to_end(token_key)
+        while len(_auth_cache) > AUTH_CACHE_MAX_ENTRIES:
+            _auth_cache.popitem(last=False)
+
+def invalidate_user_cache(supabase_user_id: Optional[str] = None) -> None:
+    """Drop cached users for one Supabase user id (all of them if None), e.g. after a role change.
+    Only this process's cache is cleared; other processes pick the change up within AUTH_CACHE_TTL."""
+    with _auth_lock:
+        if supabase_user_id is None:
+            _auth_cache.clear()
+            return
+        for key in [key for key, (sub, _, _) in _auth_cache.items() if sub == str(supabase_user_id)]:
+            del _auth_cache[key]
 
 def get_current_user(request: Request, db=Depends(get_db)):
     auth_header = request.headers.get("Authorization")
     if not auth_header or not auth_header.startswith("Bearer "):
         logger.error("Missing or invalid auth header")
         raise HTTPException(status_code=401, detail="Missing or invalid auth header")
-    
-    token = auth_header.split(" ")[1]
+    return _user_for_token(auth_header.split(" ")[1], db)
+
+def get_current_user_for_stream(request: Request, db=Depends(get_db)):
+    """Like get_current_user, but also accepts the token as ?access_token=, since browser
+    EventSource connections can't send an Authorization header. Only for event streams:
+    query strings end up in access logs, so the header is still preferred when present."""
+    if request.headers.get("Authorization"):
+        return get_current_user(request, db)
+    token = request.query_params.get("access_token")
+    if not token:
+        logger.error("Missing auth header or access_token")
+        raise HTTPException(status_code=401, detail="Missing or invalid auth header")
+    return _user_for_token(token, db)
+
+def _user_for_token(token: str, db):
+    token_key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+    # A token seen recently was already verified and resolved; skip the signature check and user query
+    user = _cached_user(token_key)
+    if user is not None:
+        return user
     try:
-        logger.info(f"Attempting to decode token with secret: {SUPABASE_JWT_SECRET[:5]}...")
-        # Decode without verification first to get the claims
-        unverified = jwt.decode(token, options={"verify_signature": False})
-        logger.info(f"Token claims: {unverified}")
-        
-        # Now verify with proper options
         payload = jwt.decode(
             token,
             SUPABASE_JWT_SECRET,
@@ -35,15 +87,18 @@ def get_current_user(request: Request, db=Depends(get_db)):
             }
         )
         user_id = payload["sub"]
-        logger.info(f"Token decoded successfully. User ID: {user_id}")
         
         user = db.query(User).filter_by(supabase_user_id=user_id).first()
         if not user:
             logger.error(f"User not found in database for supabase_user_id: {user_id}")
             raise HTTPException(status_code=401, detail="User not found in database")
         
-        logger.info(f"User found: {user.email} with role {user.role.value}")
+        # Detach it so it stays readable after this request's session commits or closes
+        db.expunge(user)
+        _cache_user(token_key, str(user_id), payload.get("exp"), user)
         return user
+    except HTTPException:
+        raise
     except jwt.InvalidTokenError as e:
         logger.error(f"Invalid token: {str(e)}")
         raise HTTPException(status_code=401, detail=f"Invalid token: {str(e)}")
@@ -51,8 +106,9 @@ def get_current_user(request: Request, db=Depends(get_db)):
         logger.error(f"Unexpected error: {str(e)}")
         raise HTTPException(status_code=401, detail=f"Authentication error: {str(e)}")
 
-def require_role(role: str):
-    def role_checker(user=Depends(get_current_user)):
+def require_role(role: str, allow_query_token: bool = False):
+    """Dependency requiring the user to have role. allow_query_token accepts ?access_token= (event streams only)."""
+    def role_checker(user=Depends(get_current_user_for_stream if allow_query_token else get_current_user)):
         if not user or user.role.value != role:
             logger.error(f"User {user.email if user else 'None'} does not have required role: {role}")
             raise HTTPException(
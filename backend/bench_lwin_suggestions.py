@@ -0,0 +1,88 @@
+import argparse
+import random
+import string
+import time
+import numpy as np
+import pandas as pd
+from rapidfuzz import fuzz, process
+from app.lwin import (
+    LWIN_KEY_FIELDS, LWIN_SUGGESTION_CANDIDATE_CUTOFF, LWIN_SUGGESTION_OVERFETCH, LwinSnapshot,
+    build_composite_key, build_lwin_snapshot, get_lwin_suggestions, _top_k_candidates
+)
+
+def synthetic_lwin_frame(rows: int, seed: int = 0) -> pd.DataFrame:
+    """An LWIN-shaped frame with the export's rough vocabulary sizes, for when the real export isn't at hand."""
+    rng = random.Random(seed)
+    word = lambda: ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 10)))
+    producers = [f"{rng.choice(['chateau', 'domaine', 'weingut', 'bodega', ''])} {word()} {word()}".strip() for _ in range(rows // 6)]
+    cuvees = [word() for _ in range(rows // 20)] + ['', 'grand vin', 'reserve', 'brut']
+    regions = [word() for _ in range(400)]
+    countries = ['france', 'italy', 'spain', 'germany', 'usa', 'australia', 'portugal', 'austria', 'chile', 'south africa']
+    grapes = ['', 'pinot noir', 'chardonnay', 'riesling', 'syrah', 'cabernet sauvignon', 'nebbiolo', 'tempranillo']
+    frame = pd.DataFrame({
+        'producer_norm': [rng.choice(producers) for _ in range(rows)],
+        'cuvee_norm': [rng.choice(cuvees) for _ in range(rows)],
+        'vintage_norm': [rng.choice(['', str(rng.randint(1970, 2022))]) for _ in range(rows)],
+        'region_norm': [rng.choice(regions) for _ in range(rows)],
+        'country_norm': [rng.choice(countries) for _ in range(rows)],
+        'grape_variety_norm': [rng.choice(grapes) for _ in range(rows)],
+        'colour_norm': [rng.choice(['red', 'white', 'rose']) for _ in range(rows)]
+    })
+    frame['LWIN'] = [str(1000000 + i) for i in range(rows)]
+    frame['DISPLAY_NAME'] = frame['producer_norm'] + ' ' + frame['cuvee_norm']
+    frame['composite_key'] = build_composite_key(frame)
+    return frame
+
+def _typo(text: str, rng: random.Random) -> str:
+    if len(text) < 6:
+        return text
+    i = rng.randrange(1, len(text) - 1)
+    return text[:i] + text[i + 1:]
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    return samples[len(samples) // 2], samples[int(0.95 * (len(samples) - 1))]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark LWIN suggestion candidate selection against a full-scan baseline.")
+    parser.add_argument("--synthetic", type=int, default=0, help="Use a synthetic frame of this many rows instead of the LWIN export")
+    parser.add_argument("--samples", type=int, default=200, help="Queries to time")
+    parser.add_argument("--limit", type=int, default=5, help="Suggestions per query")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    snapshot = LwinSnapshot(synthetic_lwin_frame(args.synthetic), 'synthetic') if args.synthetic else build_lwin_snapshot()
+    print(f"{len(snapshot.db)} rows, {len(snapshot.token_index.postings)} index tokens, built in {time.perf_counter() - started:.1f}s")
+
+    rng = random.Random(1)
+    pool = args.limit * LWIN_SUGGESTION_OVERFETCH
+    indexed, scan, recall = [], [], 0
+    for position in rng.sample(range(len(snapshot.db)), args.samples):
+        row = snapshot.db.iloc[position]
+        wine = {field: _typo(str(row[field + '_norm']), rng) for field in LWIN_KEY_FIELDS}
+        query = ' '.join(wine[f] for f in LWIN_KEY_FIELDS)
+
+        t = time.perf_counter()
+        candidates = _top_k_candidates(query, snapshot, None, pool)
+        indexed.append((time.perf_counter() - t) * 1000)
+        recall += position in candidates
+
+        t = time.perf_counter()
+        scores = process.cdist([query], snapshot.choices, scorer=fuzz.token_sort_ratio, dtype=np.uint8,
+                               score_cutoff=LWIN_SUGGESTION_CANDIDATE_CUTOFF, workers=-1)[0]
+        np.argpartition(scores, -pool)[-pool:]
+        scan.append((time.perf_counter() - t) * 1000)
+
+    for name, samples in (('full scan', scan), ('token index', indexed)):
+        p50, p95 = _percentiles(samples)
+        print(f"{name:12} candidates: p50 {p50:.2f} ms, p95 {p95:.2f} ms")
+    print(f"source row in the indexed pool for {recall}/{args.samples} typo'd queries")
+    if not args.synthetic:
+        started = time.perf_counter()
+        for position in rng.sample(range(len(snapshot.db)), args.samples):
+            row = snapshot.db.iloc[position]
+            get_lwin_suggestions({field: str(row[field + '_norm']) for field in LWIN_KEY_FIELDS}, limit=args.limit)
+        print(f"get_lwin_suggestions end to end: {(time.perf_counter() - started) * 1000 / args.samples:.2f} ms mean")
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.api import api_router
+from app.lwin import load_lwin_aliases
+from app.jobs import start_worker_processes
+from app.config import JOB_WORKERS
 
 app = FastAPI()
 
@@ -13,7 +16,25 @@ app.add_middleware(
     ],
     allow_credentials=True,
     allow_methods=["*"],
-    allow_headers=["*"]
+    allow_headers=["*"],
+    expose_headers=["X-Partial-Results", "X-Next-Cursor"]  # Read by the frontend on entry listings
 )
 
 app.include_router(api_router, prefix="/api")
+
+@app.on_event("startup")
+def load_aliases():
+    # Warm the in-memory alias tables so the first upload doesn't fuzzy-match already resolved wines
+    load_lwin_aliases()
+
+@app.on_event("startup")
+def start_parse_workers():
+    # Single-node deployments parse in-process; set JOB_WORKERS=0 when running worker.py on separate nodes
+    if JOB_WORKERS > 0:
+        app.state.parse_workers = start_worker_processes(JOB_WORKERS)
+
+@app.on_event("shutdown")
+def stop_parse_workers():
+    # A job cut off here keeps its lease until it lapses, then another worker reruns it
+    for process in getattr(app.state, 'parse_workers', []):
+        process.terminate()
@@ -0,0 +1,21 @@
+import os
+import tempfile
+import pytest
+
+# The app reads its settings at import time; point it at a throwaway SQLite database
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}")
+os.environ.setdefault("SUPABASE_URL", "https://test.supabase.co")
+os.environ.setdefault("SUPABASE_SERVICE_ROLE_KEY", "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.test")
+
+from app.database import SessionLocal, engine  # noqa: E402
+from app.models import Base  # noqa: E402
+
+@pytest.fixture
+def db():
+    Base.metadata.create_all(engine)
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+        Base.metadata.drop_all(engine)
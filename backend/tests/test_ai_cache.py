@@ -0,0 +1,30 @@
+from app import ai_cache, ai_parsing
+
+def test_same_wine_is_sent_and_stored_once(monkeypatch):
+    sent, stored = [], {}
+    monkeypatch.setattr(ai_parsing, 'get_cached_ai_results', lambda texts, version: {})
+    monkeypatch.setattr(ai_parsing, 'store_ai_results', lambda results, version: stored.update(results))
+    monkeypatch.setattr(ai_parsing, '_parse_wine_text_uncached', lambda text, budget=None: sent.append(text) or {'producer': 'Krug'})
+    texts = ['Krug Grande Cuvée 310', 'KRUG  grande cuvée 310', 'Krug Grande Cuvée 310']
+    assert ai_parsing.parse_wine_batch(texts) == [{'producer': 'Krug'}] * 3
+    assert sent == ['Krug Grande Cuvée 310']
+    assert list(stored) == ['Krug Grande Cuvée 310']
+
+def test_texts_sharing_a_key_become_one_row(monkeypatch):
+    executed = []
+
+    class Session:
+        def execute(self, stmt):
+            executed.append(stmt.compile().params)
+        def commit(self):
+            pass
+        def rollback(self):
+            pass
+        def close(self):
+            pass
+
+    monkeypatch.setattr(ai_cache, 'SessionLocal', Session)
+    monkeypatch.setattr(ai_cache, '_maybe_evict', lambda: None)
+    ai_cache.store_ai_results({'Barolo 2015': {'a': 1}, 'barolo   2015': {'a': 2}}, 'test')
+    keys = [value for name, value in executed[0].items() if name.startswith('cache_key')]
+    assert len(keys) == 1
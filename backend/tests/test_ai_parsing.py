@@ -0,0 +1,14 @@
+import time
+from concurrent.futures import Future
+from app import ai_parsing
+
+def test_collect_shares_one_deadline_and_cancels_late_calls(monkeypatch):
+    monkeypatch.setattr(ai_parsing, 'AI_MAX_CONCURRENCY', 5)
+    done = Future()
+    done.set_result({'producer': 'Krug'})
+    hung = [Future() for _ in range(3)]
+    started = time.monotonic()
+    results = ai_parsing._collect([done] + hung, 0.2, None)
+    assert time.monotonic() - started < 0.4  # Not 0.2 per hung call
+    assert results == [{'producer': 'Krug'}, None, None, None]
+    assert all(future.cancelled() for future in hung)
@@ -0,0 +1,25 @@
+import uuid
+from app.entry_listing import list_entries_page, encode_cursor, decode_cursor
+from app.models import WineEntry
+
+def test_pages_cover_unpositioned_then_positioned_entries(db):
+    file_id, restaurant_id = uuid.uuid4(), uuid.uuid4()
+    positions = [None, None, None, 0, 1, 1, 2]
+    db.add_all([WineEntry(wine_list_file_id=file_id, restaurant_id=restaurant_id, position=p) for p in positions])
+    db.commit()
+    seen, cursor = [], None
+    while True:
+        rows, cursor = list_entries_page(db, file_id, 2, fields=['position'], cursor=cursor)
+        seen.extend((row.position, row.id) for row in rows)
+        if cursor is None:
+            break
+    assert len(seen) == len(positions) == len(set(seen))
+    # Entries saved without a position come first (in id order), then document order
+    assert [p for p, _ in seen] == positions
+    nulls = [entry_id for p, entry_id in seen if p is None]
+    assert nulls == sorted(nulls)
+
+def test_cursor_round_trips_null_positions():
+    entry_id = uuid.uuid4()
+    assert decode_cursor(encode_cursor(None, entry_id)) == (None, entry_id)
+    assert decode_cursor(encode_cursor(3, entry_id)) == (3, entry_id)
@@ -0,0 +1,18 @@
+from app import lwin
+from app.gazetteer import ProducerGazetteer
+
+def test_restaurant_alias_only_matches_for_that_restaurant(monkeypatch):
+    monkeypatch.setattr(lwin, 'LWIN_ALIAS_TABLE', {'producer': {'giacomo conterno': 'Conterno'}, 'cuvee': {}})
+    monkeypatch.setattr(lwin, 'RESTAURANT_ALIAS_TABLES', {'r1': {'producer': {'house pour': 'Domaine Leflaive'}, 'cuvee': {}}})
+    generation, aliases = lwin.get_producer_aliases()
+    assert aliases == ['giacomo conterno']
+
+    gazetteer = ProducerGazetteer()
+    gazetteer.ensure('v1', lambda: ([], []), generation, lambda: aliases)
+    for restaurant_id in ('r1', 'r2'):
+        gazetteer.ensure_restaurant(restaurant_id, generation, lambda: lwin.get_producer_aliases(restaurant_id)[1])
+
+    assert gazetteer.find_producer('House Pour Chardonnay 2020', 'r1')['value'] == 'restaurant_alias'
+    assert gazetteer.find_producer('House Pour Chardonnay 2020', 'r2') is None
+    assert gazetteer.find_producer('House Pour Chardonnay 2020') is None
+    assert gazetteer.find_producer('Giacomo Conterno Barolo 2016', 'r2')['value'] == 'alias'
@@ -0,0 +1,106 @@
+import uuid
+from datetime import datetime, timedelta
+import pytest
+from app import jobs
+from app.jobs import claim_parse_job, renew_lease, holds_lease, fail_exhausted_jobs
+from app.models import ParseJob, ParseJobStatus, WineListFile
+from app.config import JOB_MAX_ATTEMPTS
+
+# SQLite has no advisory locks or SKIP LOCKED; claim_parse_job only takes them on Postgres,
+# so these cover the queue's ordering, lease and retry rules rather than its concurrency
+
+def add_job(db, restaurant_id=None, lane='bulk', age=0, **fields):
+    wine_list = WineListFile(restaurant_id=restaurant_id or uuid.uuid4(), filename='list.pdf', file_url='list.pdf')
+    db.add(wine_list)
+    db.flush()
+    job = ParseJob(
+        wine_list_file_id=wine_list.id, restaurant_id=wine_list.restaurant_id, storage_path='list.pdf', lane=lane,
+        date_created=datetime.utcnow() - timedelta(seconds=age), **fields
+    )
+    db.add(job)
+    db.commit()
+    return job
+
+@pytest.fixture(autouse=True)
+def uncapped_lanes(monkeypatch):
+    monkeypatch.setattr(jobs, 'JOB_LANE_MAX_RUNNING', {'interactive': 0, 'bulk': 0})
+
+def test_claims_interactive_before_bulk(db):
+    bulk = add_job(db, lane='bulk', age=60)
+    interactive = add_job(db, lane='interactive', age=0)
+    assert claim_parse_job(db, 'w1').id == interactive.id
+    assert claim_parse_job(db, 'w1').id == bulk.id
+    assert claim_parse_job(db, 'w1') is None
+
+def test_claims_oldest_job_of_a_restaurant_first(db):
+    restaurant_id = uuid.uuid4()
+    newer = add_job(db, restaurant_id, age=10)
+    older = add_job(db, restaurant_id, age=20)
+    first = claim_parse_job(db, 'w1')
+    assert first.id == older.id
+    assert first.status == ParseJobStatus.running
+    assert first.worker_id == 'w1'
+    assert first.attempts == 1
+    assert first.lease_expires_at > datetime.utcnow()
+    assert claim_parse_job(db, 'w1').id == newer.id
+
+def test_restaurant_with_fewer_recent_starts_goes_next(db):
+    busy, quiet = uuid.uuid4(), uuid.uuid4()
+    add_job(db, busy, status=ParseJobStatus.done, started_at=datetime.utcnow() - timedelta(minutes=5))
+    busy_job = add_job(db, busy, age=60)
+    quiet_job = add_job(db, quiet, age=0)
+    # The busy restaurant's job is older, but it already had a job start in the fairness window
+    assert claim_parse_job(db, 'w1').id == quiet_job.id
+    assert claim_parse_job(db, 'w1').id == busy_job.id
+
+def test_restaurant_weights_scale_its_share(db, monkeypatch):
+    heavy, light = uuid.uuid4(), uuid.uuid4()
+    for restaurant_id in (heavy, light):
+        add_job(db, restaurant_id, status=ParseJobStatus.done, started_at=datetime.utcnow() - timedelta(minutes=5))
+    add_job(db, light, age=60)
+    heavy_job = add_job(db, heavy, age=0)
+    monkeypatch.setattr(jobs, 'JOB_RESTAURANT_WEIGHTS', {str(heavy): 2})
+    assert claim_parse_job(db, 'w1').id == heavy_job.id
+
+def test_lane_at_its_running_cap_is_skipped(db, monkeypatch):
+    monkeypatch.setattr(jobs, 'JOB_LANE_MAX_RUNNING', {'interactive': 0, 'bulk': 1})
+    add_job(db, lane='bulk', age=30)
+    add_job(db, lane='bulk', age=20)
+    interactive = add_job(db, lane='interactive', age=0)
+    assert claim_parse_job(db, 'w1').id == interactive.id
+    assert claim_parse_job(db, 'w1').lane == 'bulk'
+    # Bulk is at its cap of one running job; the remaining bulk job waits
+    assert claim_parse_job(db, 'w1') is None
+    assert db.get(ParseJob, interactive.id).status == ParseJobStatus.running
+
+def test_expired_lease_is_reclaimed_by_another_worker(db):
+    job_id = add_job(db).id
+    claim_parse_job(db, 'w1')
+    assert renew_lease(job_id, 'w1')
+    # A live lease isn't taken over
+    assert claim_parse_job(db, 'w2') is None
+    db.query(ParseJob).filter(ParseJob.id == job_id).update({ParseJob.lease_expires_at: datetime.utcnow() - timedelta(seconds=1)})
+    db.commit()
+    reclaimed = claim_parse_job(db, 'w2')
+    assert reclaimed.id == job_id
+    assert reclaimed.worker_id == 'w2'
+    assert reclaimed.attempts == 2
+    # The first worker can no longer renew or commit
+    assert not renew_lease(job_id, 'w1')
+    assert not holds_lease(db, job_id, 'w1')
+    assert holds_lease(db, job_id, 'w2')
+    db.rollback()
+
+def test_exhausted_job_is_failed_instead_of_reclaimed(db):
+    job = add_job(
+        db, status=ParseJobStatus.running, worker_id='w1', attempts=JOB_MAX_ATTEMPTS,
+        lease_expires_at=datetime.utcnow() - timedelta(seconds=1)
+    )
+    job_id, wine_list_id = job.id, job.wine_list_file_id
+    assert claim_parse_job(db, 'w2') is None
+    assert fail_exhausted_jobs(db) == 1
+    job = db.get(ParseJob, job_id)
+    assert job.status == ParseJobStatus.error
+    assert job.error == f"Abandoned after {JOB_MAX_ATTEMPTS} attempts"
+    assert db.get(WineListFile, wine_list_id).status.value == 'error'
+    assert fail_exhausted_jobs(db) == 0
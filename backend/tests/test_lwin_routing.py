@@ -0,0 +1,32 @@
+import pandas as pd
+from app import parsing
+from app.lwin import LwinSnapshot, route_lwin_shards
+
+def snapshot():
+    frame = pd.DataFrame({
+        'producer_norm': ['leflaive', 'margaux', 'rousseau'],
+        'region_norm': ['burgundy', 'bordeaux', 'burgundy'],
+        'country_norm': ['france'] * 3,
+        'colour_norm': ['white', 'red', 'red']
+    })
+    frame['composite_key'] = frame['producer_norm']
+    return LwinSnapshot(frame, 'test')
+
+def sampled_entry(section):
+    return {
+        'entry': {'raw_text': 'Leflaive Puligny-Montrachet 2019 240', 'section': section, 'sub_section': None},
+        'extracted': {'producer': 'Leflaive', 'cuvee': 'Puligny-Montrachet', 'vintage': '2019'},
+        'raw_text': 'Leflaive Puligny-Montrachet 2019 240'
+    }
+
+def test_section_header_routes_to_its_shard():
+    rows, route = route_lwin_shards(parsing.lwin_match_input(sampled_entry('Burgundy')), snapshot())
+    assert sorted(rows) == [0, 2]
+    assert route == 'region=burgundy'
+
+def test_initial_rules_match_with_the_section(monkeypatch):
+    matched = []
+    monkeypatch.setattr(parsing, 'match_lwin_batch', lambda wines, restaurant_id=None: matched.extend(wines) or [None] * len(wines))
+    parsing.generate_initial_rules([sampled_entry('Burgundy')])
+    assert matched[0]['section'] == 'Burgundy'
+    assert matched[0]['producer'] == 'Leflaive'
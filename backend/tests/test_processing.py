@@ -0,0 +1,49 @@
+import uuid
+from types import SimpleNamespace
+import pytest
+from app import processing
+from app.models import WineListFile, WineListFileStatus
+from app.processing import ParseCancelled, process_wine_list_file
+
+def add_wine_list(db):
+    wine_list = WineListFile(restaurant_id=uuid.uuid4(), filename='list.pdf', file_url='list.pdf')
+    db.add(wine_list)
+    db.commit()
+    return wine_list.id
+
+def failing_pipeline(monkeypatch):
+    def run_checkpointed(*args, **kwargs):
+        raise RuntimeError('OCR failed')
+    monkeypatch.setattr(processing, 'hash_file', lambda path: 'hash')
+    monkeypatch.setattr(processing, 'hash_json', lambda value: 'hash')
+    monkeypatch.setattr(processing, 'get_lwin_snapshot', lambda: SimpleNamespace(version='v1'))
+    monkeypatch.setattr(processing, 'run_checkpointed', run_checkpointed)
+
+def status_of(db, wine_list_id):
+    db.expire_all()
+    return db.query(WineListFile).get(wine_list_id).status
+
+def test_unowned_parse_does_not_mark_the_list_processing(db, monkeypatch, tmp_path):
+    failing_pipeline(monkeypatch)
+    wine_list_id = add_wine_list(db)
+    with pytest.raises(ParseCancelled):
+        process_wine_list_file(wine_list_id, uuid.uuid4(), 'list.pdf', str(tmp_path / 'list.pdf'),
+                               holds_lease=lambda session: False)
+    assert status_of(db, wine_list_id) == WineListFileStatus.uploaded
+
+def test_failure_after_the_lease_is_lost_leaves_the_status_alone(db, monkeypatch, tmp_path):
+    failing_pipeline(monkeypatch)
+    wine_list_id = add_wine_list(db)
+    checks = iter([True, False])
+    with pytest.raises(ParseCancelled):
+        process_wine_list_file(wine_list_id, uuid.uuid4(), 'list.pdf', str(tmp_path / 'list.pdf'),
+                               holds_lease=lambda session: next(checks))
+    assert status_of(db, wine_list_id) == WineListFileStatus.processing
+
+def test_failure_while_owned_marks_the_list_errored(db, monkeypatch, tmp_path):
+    failing_pipeline(monkeypatch)
+    wine_list_id = add_wine_list(db)
+    with pytest.raises(RuntimeError):
+        process_wine_list_file(wine_list_id, uuid.uuid4(), 'list.pdf', str(tmp_path / 'list.pdf'),
+                               holds_lease=lambda session: True)
+    assert status_of(db, wine_list_id) == WineListFileStatus.error
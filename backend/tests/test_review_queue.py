@@ -0,0 +1,17 @@
+import uuid
+from app.models import WineEntry
+from app.review_queue import next_review_entry
+
+def test_queue_wraps_to_skipped_entries_after_the_last(db):
+    file_id, restaurant_id = uuid.uuid4(), uuid.uuid4()
+    entries = [WineEntry(wine_list_file_id=file_id, restaurant_id=restaurant_id, row_confidence=c) for c in (0.2, 0.5, None)]
+    db.add_all(entries)
+    db.commit()
+    low, high, unscored = entries
+    assert next_review_entry(db, file_id).id == low.id
+    assert next_review_entry(db, file_id, after=low.id).id == high.id
+    assert next_review_entry(db, file_id, after=high.id).id == unscored.id
+    assert next_review_entry(db, file_id, after=unscored.id).id == low.id
+
+def test_empty_queue_has_no_next_entry(db):
+    assert next_review_entry(db, uuid.uuid4(), after=uuid.uuid4()) is None
@@ -0,0 +1,19 @@
+import argparse
+import logging
+from app.jobs import run_worker, start_worker_processes
+
+logging.basicConfig(level=logging.INFO)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run wine list parse workers against the shared job queue.")
+    parser.add_argument("--processes", type=int, default=1, help="Worker processes to run on this node")
+    parser.add_argument("--once", action="store_true", help="Drain the queue and exit instead of polling")
+    args = parser.parse_args()
+    if args.once or args.processes <= 1:
+        run_worker(once=args.once)
+        return
+    for process in start_worker_processes(args.processes):
+        process.join()
+
+if __name__ == "__main__":
+    main()
@@ -22,14 +22,15 @@ export default function RefinePage() {
     }
   }, [session?.access_token, loading, router]);
 
-  // Fetch a random entry
-  const fetchRandomEntry = useCallback(() => {
+  // Fetch the next entry from the review queue (lowest confidence first); pass the current id to skip it
+  const fetchRandomEntry = useCallback((after?: string) => {
     if (session?.access_token) {
       setEntryLoading(true);
       setEntryError(null);
       axios
         .post(`/api/wine-lists/${fileId}/refinement/random`, {}, {
-          headers: { Authorization: `Bearer ${session?.access_token}` }
+          headers: { Authorization: `Bearer ${session?.access_token}` },
+          params: after ? { after } : undefined
         })
         .then((res) => {
           setEntry(res.data);
@@ -111,7 +112,7 @@ export default function RefinePage() {
 
   // Next entry
   const handleNext = () => {
-    fetchRandomEntry();
+    fetchRandomEntry(entry?.id);
   };
 
   if (entryLoading) return <div className="p-8">Loading...</div>;